@@ -1,13 +1,16 @@
-import copy
 import sys
 from datetime import datetime, timedelta
 
 import numpy as np
 import pandas as pd
-import peakutils as pk
 import plotly.graph_objs as go
 import plotly.offline as py
-from netCDF4 import Dataset, date2num, num2date
+from netCDF4 import Dataset
+
+from divebomb import kernels
+from divebomb.plotting import get_phase_trace
+from divebomb.preprocessing import (datetime_to_num, get_sampling_interval,
+                                    num_to_datetime)
 
 units = 'seconds since 1970-01-01'
 
@@ -51,25 +54,70 @@ class DeepDive:
 
     """
 
+    # The columns of the profile table and their types, in table order
+    profile_schema = (('max_depth', np.float64), ('min_depth', np.float64),
+                      ('dive_start', np.float64), ('dive_end', np.float64),
+                      ('td_total_duration', np.float64),
+                      ('depth_variance', np.float64),
+                      ('average_vertical_velocity', np.float64),
+                      ('average_descent_velocity', np.float64),
+                      ('average_ascent_velocity', np.float64),
+                      ('number_of_descent_transitions', np.float64),
+                      ('number_of_ascent_transitions', np.float64),
+                      ('total_descent_distance_traveled', np.float64),
+                      ('total_ascent_distance_traveled', np.float64),
+                      ('overall_change_in_depth', np.float64),
+                      ('td_time_at_depth', np.float64),
+                      ('td_time_pre_depth', np.float64),
+                      ('td_time_post_depth', np.float64),
+                      ('peaks', np.float64), ('no_skew', np.float64),
+                      ('right_skew', np.float64), ('left_skew', np.float64))
+
+    # The features that are only computed when they are requested or used,
+    # and the method computing each of them
+    lazy_features = {
+        'depth_variance': 'get_depth_variance',
+        'average_vertical_velocity': 'get_average_vertical_velocity',
+        'average_descent_velocity': 'get_average_descent_velocity',
+        'average_ascent_velocity': 'get_average_ascent_velocity',
+        'number_of_descent_transitions': 'get_number_of_descent_transitions',
+        'number_of_ascent_transitions': 'get_number_of_ascent_transitions',
+        'total_descent_distance_traveled': 'get_descent_vertical_distance',
+        'total_ascent_distance_traveled': 'get_ascent_vertical_distance',
+        'overall_change_in_depth': 'get_overall_change_in_depth',
+        'peaks': 'get_peaks'
+    }
+
     def __init__(self,
                  data,
                  columns={
                      'depth': 'depth',
                      'time': 'time'
                  },
-                 at_depth_threshold=0.15):
+                 at_depth_threshold=0.15,
+                 features=None):
         """
         :param data: the time and depth values for the dive
         :param columns: a dictionary of column mappings for the data
         :param at_depth_threshold: a value from 0 - 1 indicating distance from
             the bottom of the dive at which the animal is considered to be at
             depth
+        :param features: a list of the ``lazy_features`` to compute, the
+            others are computed when they are first used, ``None`` computes
+            all of them
         """
 
         if data[columns['time']].dtypes != np.float64:
-            data.time = date2num(data.time.tolist(), units=units)
-
-        self.data = data.sort_values('time').reset_index(drop=True)
+            data = data.assign(time=datetime_to_num(data.time, units=units))
+
+        # Sorted data, like the slices of ``prepare_dive_data()``, is kept as
+        # a view instead of being copied
+        if not data.time.is_monotonic_increasing:
+            data = data.sort_values('time')
+        self.data = data.set_axis(pd.RangeIndex(len(data)), axis=0,
+                                  copy=False)
+        self._phase_arrays = None
+        self._features = features
         for k, v in columns.items():
             if k != v:
                 self.data[k] = self.data[v]
@@ -80,45 +128,99 @@ class DeepDive:
         self.dive_start = self.data.time.min()
         self.dive_end = self.data.time.max()
         self.td_total_duration = self.data.time.max() - self.data.time.min()
-        self.depth_variance = np.std(self.data.depth)
-        self.average_vertical_velocity = np.absolute(
-            ((self.data.depth.diff() / self.data.time.diff()))).mean()
-        self.average_descent_velocity = self.get_average_descent_velocity()
-        self.average_ascent_velocity = self.get_average_ascent_velocity()
-
-        self.number_of_descent_transitions = \
-            len(self.data[(self.data.depth.diff() /
-                           self.data.time.diff()) > 0])
-
-        self.number_of_ascent_transitions = \
-            len(self.data[(self.data.depth.diff() /
-                           self.data.time.diff()) < 0])
-
-        self.total_descent_distance_traveled =  \
-            self.get_descent_vertical_distance()
+        self._evaluate('depth_variance', 'average_vertical_velocity',
+                       'average_descent_velocity', 'average_ascent_velocity',
+                       'number_of_descent_transitions',
+                       'number_of_ascent_transitions',
+                       'total_descent_distance_traveled',
+                       'total_ascent_distance_traveled',
+                       'overall_change_in_depth')
+        self.td_time_at_depth = None
+        self.td_time_pre_depth = None
+        self.td_time_post_depth = None
+        self._evaluate('peaks')
+        self.no_skew = 0
+        self.right_skew = 0
+        self.left_skew = 0
+        self.profile(at_depth_threshold)
 
-        self.total_ascent_distance_traveled =   \
-            self.get_ascent_vertical_distance()
+    def profile(self, at_depth_threshold=0.15):
+        """
+        Profiles the time spent before, at, and after depth for an
+        ``at_depth_threshold``. The values that do not depend on the threshold
+        are computed once and reused, so the same dive can be profiled again
+        at other thresholds cheaply.
 
-        self.overall_change_in_depth = self.data.depth.diff().sum()
+        :param at_depth_threshold: a value from 0 - 1 indicating distance from
+            the bottom of the dive at which the animal is considered to be at
+            depth
+        """
+        self._at_depth_threshold = at_depth_threshold
         self.td_time_at_depth = self.get_time_at_depth(at_depth_threshold)
         self.td_time_pre_depth = self.get_time_pre_depth(at_depth_threshold)
         self.td_time_post_depth = self.get_time_post_depth(at_depth_threshold)
-        self.peaks = self.get_peaks()
         self.no_skew = 0
         self.right_skew = 0
         self.left_skew = 0
         self.set_skew()
 
+    def _evaluate(self, *features):
+        """
+        Computes the features that were requested, all of them if no features
+        were requested.
+        """
+        for feature in features:
+            if self._features is None or feature in self._features:
+                getattr(self, feature)
+
+    def __getattr__(self, name):
+        """
+        Computes a lazy feature the first time it is used, it is only called
+        for attributes that are not set.
+        """
+        method = type(self).lazy_features.get(name)
+        if method is None or 'data' not in self.__dict__:
+            raise AttributeError(name)
+        value = getattr(self, method)()
+        self.__dict__.setdefault(name, value)
+        return self.__dict__[name]
+
+    def get_phase_arrays(self):
+        """
+        Computes the threshold independent arrays used to find the time at
+        depth. The arrays are computed once and cached on the dive.
+
+        :return: a dictionary of the cached arrays
+        """
+        if self._phase_arrays is None:
+            time = self.data.time.values
+            self._phase_arrays = {
+                'depth': self.data.depth.values,
+                'time': time,
+                'time_diff': np.append(np.nan, np.diff(time))
+            }
+        return self._phase_arrays
+
+    def get_at_depth_indices(self, at_depth_threshold=0.15):
+        """
+        :param at_depth_threshold: a value from 0 - 1 indicating distance from
+            the bottom of the dive at which the animal is considered to be at
+            depth
+        :return: the indices of the points at depth, excluding the first one
+        """
+        depth = self.get_phase_arrays()['depth']
+        return np.flatnonzero(depth > (self.max_depth - (
+            (self.max_depth - self.min_depth) * at_depth_threshold)))[1:]
+
     def get_peaks(self):
         """
         :return: number of peaks found within a dive
         """
         peak_thres = (1 - (self.data.depth.min() / self.data.depth.max()))
-        peaks = pk.indexes(
+        peaks = kernels.peak_indexes(
             self.data.depth * (-1),
             thres=min([0.1, peak_thres]),
-            min_dist=max((10 / self.data.time.diff().mean()), 3))
+            min_dist=max((10 / get_sampling_interval(self.data)), 3))
         self.peaks = len(peaks)
         return self.peaks
 
@@ -141,16 +243,10 @@ class DeepDive:
         :return: the duration at depth in seconds
         """
         time = 0
-        dive = self.data.copy(deep=True)
-        dive['time_diff'] = dive.time.diff()
-        time_data = dive[
-            dive.depth > (dive.depth.max() - (
-                (dive.depth.max() - dive.depth.min()) * at_depth_threshold)
-            )
-        ].tail(-1)
-        if len(time_data) != 0:
-            time = time_data.time_diff.sum()
-        del dive
+        time_diff = self.get_phase_arrays()['time_diff']
+        at_depth = self.get_at_depth_indices(at_depth_threshold)
+        if len(at_depth) != 0:
+            time = np.nansum(time_diff[at_depth])
         return time
 
     def get_time_pre_depth(self, at_depth_threshold=0.15):
@@ -161,17 +257,12 @@ class DeepDive:
         :return: the duration before depth in seconds
         """
         time = 0
-        dive = self.data.copy(deep=True)
-        dive['time_diff'] = dive.time.diff()
-        at_depth_data = dive[
-            dive.depth > (dive.depth.max() - (
-                (dive.depth.max() - dive.depth.min()) * at_depth_threshold)
-            )
-        ].tail(-1)
-        time_data = dive[dive.time < at_depth_data.time.min()]
-        if len(time_data) != 0:
-            time = time_data.time_diff.sum()
-        del dive
+        arrays = self.get_phase_arrays()
+        at_depth = self.get_at_depth_indices(at_depth_threshold)
+        if len(at_depth) != 0:
+            pre_depth = arrays['time'] < arrays['time'][at_depth].min()
+            if pre_depth.any():
+                time = np.nansum(arrays['time_diff'][pre_depth])
         return time
 
     def get_time_post_depth(self, at_depth_threshold=0.15):
@@ -182,74 +273,108 @@ class DeepDive:
         :return: the duration after depth in seconds
         """
         time = 0
-        dive = self.data.copy(deep=True)
-        dive['time_diff'] = dive.time.diff()
-        at_depth_data = dive[
-            dive.depth > (dive.depth.max() - (
-                (dive.depth.max() - dive.depth.min()) * at_depth_threshold)
-            )
-        ].tail(-1)
-        time_data = dive[dive.time > at_depth_data.time.max()]
-        if len(time_data) != 0:
-            time = time_data.time_diff.sum()
-        del dive
+        arrays = self.get_phase_arrays()
+        at_depth = self.get_at_depth_indices(at_depth_threshold)
+        if len(at_depth) != 0:
+            post_depth = arrays['time'] > arrays['time'][at_depth].max()
+            if post_depth.any():
+                time = np.nansum(arrays['time_diff'][post_depth])
         return time
 
+    def get_depth_variance(self):
+        """
+        :return: the standard variance in depth during the dive in meters
+        """
+        return np.std(self.data.depth)
+
+    def get_average_vertical_velocity(self):
+        """
+        :return: the mean absolute vertical velocity in m/s
+        """
+        return np.absolute(
+            ((self.data.depth.diff() / self.data.time.diff()))).mean()
+
+    def get_number_of_descent_transitions(self):
+        """
+        :return: the number of times the animal moves downwards
+        """
+        return len(self.data[(self.data.depth.diff() /
+                              self.data.time.diff()) > 0])
+
+    def get_number_of_ascent_transitions(self):
+        """
+        :return: the number of times the animal moves upwards
+        """
+        return len(self.data[(self.data.depth.diff() /
+                              self.data.time.diff()) < 0])
+
+    def get_overall_change_in_depth(self):
+        """
+        :return: the sum of the changes in depth during the dive in meters
+        """
+        return self.data.depth.diff().sum()
+
     def get_descent_vertical_distance(self):
         """
         :return: the total vertical distance travelled upwards in meters
         """
-        dive = self.data.copy(deep=True)
-        dive['depth_diff'] = dive.depth.diff()
-        distance = np.absolute(dive[(dive.depth_diff > 0)].depth_diff.sum())
-        del dive
-        return distance
+        depth_diff = np.diff(self.data.depth.values)
+        return np.absolute(depth_diff[depth_diff > 0].sum())
 
     def get_ascent_vertical_distance(self):
         """
         :return: the total vertical distance travelled downwards in meters
         """
-        dive = self.data.copy(deep=True)
-        dive['depth_diff'] = dive.depth.diff()
-        distance = np.absolute(dive[(dive.depth_diff < 0)].depth_diff.sum())
-        del dive
-        return distance
+        depth_diff = np.diff(self.data.depth.values)
+        return np.absolute(depth_diff[depth_diff < 0].sum())
+
+    def _get_velocity(self):
+        """
+        :return: a numpy array of the vertical velocity between each point in
+            m/s
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.diff(self.data.depth.values) / np.diff(
+                self.data.time.values)
 
     def get_average_ascent_velocity(self):
         """
         :return: the average upwards velocity in m/s
         """
-        dive = self.data.copy(deep=True)
-        dive['velocity'] = dive.depth.diff() / dive.time.diff()
-        velocity = np.absolute(dive[dive.velocity < 0].velocity.mean())
-        del dive
-        return velocity
+        velocity = self._get_velocity()
+        return np.absolute(velocity[velocity < 0].mean()) \
+            if (velocity < 0).any() else np.nan
 
     def get_average_descent_velocity(self):
         """
         :return: the average downwards velocity in m/s
         """
-        dive = self.data.copy(deep=True)
-        dive['velocity'] = dive.depth.diff() / dive.time.diff()
-        velocity = np.absolute(dive[dive.velocity > 0].velocity.mean())
-        del dive
-        return velocity
+        velocity = self._get_velocity()
+        return np.absolute(velocity[velocity > 0].mean()) \
+            if (velocity > 0).any() else np.nan
 
     def to_dict(self):
         """
 
         :return: a dictionary of the dive profile
         """
-        dive = copy.deepcopy(self.__dict__)
-        del dive['data']
-        return dive
-
-    def plot(self):
+        # The values are scalars so they do not need to be copied
+        return {
+            key: value
+            for key, value in self.__dict__.items()
+            if key != 'data' and not key.startswith('_')
+        }
+
+    def get_figure(self, max_points=None, downsample_method='lttb'):
         """
-        :return: a plotly graph showing the phases of the dive
+        :param max_points: the maximum number of points per phase, ``None``
+            plots every point
+        :param downsample_method: either ``lttb`` or ``minmax``
+        :return: a plotly figure of the phases of the dive
         """
         # Set the data to plot the segments of the dive
-        dive = self.data.copy(deep=True)
+        at_depth_threshold = self._at_depth_threshold
+        dive = self.data.copy(deep=False)
         dive['time_diff'] = dive.time.diff()
 
         at_depth_data = dive[dive.depth > (dive.depth.max() - (
@@ -261,33 +386,39 @@ class DeepDive:
             (dive.depth.max() - dive.depth.min()) * at_depth_threshold))) &
             (dive.time >= at_depth_data.time.max())]
 
-        pre_depth_data = pre_depth_data.append(at_depth_data.head(1))
-        post_depth_data = post_depth_data.append(at_depth_data.tail(1))
+        pre_depth_data = pd.concat([pre_depth_data, at_depth_data.head(1)])
+        post_depth_data = pd.concat([post_depth_data, at_depth_data.tail(1)])
         post_depth_data.sort_values('time', inplace=True)
 
-        pre_depth = go.Scatter(
-            x=num2date(pre_depth_data.time.tolist(), units=units),
-            y=pre_depth_data.depth,
-            mode='lines+markers',
-            name='Pre Depth')
+        pre_depth = get_phase_trace(pre_depth_data.time, pre_depth_data.depth,
+                                    'Pre Depth', units, mode='lines+markers',
+                                    max_points=max_points,
+                                    method=downsample_method)
 
-        at_depth = go.Scatter(
-            x=num2date(at_depth_data.time.tolist(), units=units),
-            y=at_depth_data.depth,
-            mode='lines+markers',
-            name='At Depth')
+        at_depth = get_phase_trace(at_depth_data.time, at_depth_data.depth,
+                                   'At Depth', units, mode='lines+markers',
+                                   max_points=max_points,
+                                   method=downsample_method)
 
-        post_depth = go.Scatter(
-            x=num2date(post_depth_data.time.tolist(), units=units),
-            y=post_depth_data.depth,
-            mode='lines+markers',
-            name='Post Depth')
+        post_depth = get_phase_trace(post_depth_data.time,
+                                     post_depth_data.depth, 'Post Depth',
+                                     units, mode='lines+markers',
+                                     max_points=max_points,
+                                     method=downsample_method)
 
         layout = go.Layout(
             title='Dive starting at {}'.format(
-                num2date(self.dive_start, units=units)),
+                pd.Timestamp(num_to_datetime(self.dive_start, units=units))),
             xaxis=dict(title='Time'),
             yaxis=dict(title='Depth in Meters', autorange='reversed'))
         plot_data = [pre_depth, post_depth, at_depth]
-        fig = go.Figure(data=plot_data, layout=layout)
-        return py.iplot(fig)
+        return go.Figure(data=plot_data, layout=layout)
+
+    def plot(self, max_points=None, downsample_method='lttb'):
+        """
+        :param max_points: the maximum number of points per phase, ``None``
+            plots every point
+        :param downsample_method: either ``lttb`` or ``minmax``
+        :return: a plotly graph showing the phases of the dive
+        """
+        return py.iplot(self.get_figure(max_points, downsample_method))
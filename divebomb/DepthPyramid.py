@@ -0,0 +1,166 @@
+import json
+import os
+
+import numpy as np
+
+from divebomb.preprocessing import datetime_to_num, time_units
+
+pyramid_folder = 'depth_pyramid'
+pyramid_filename = 'pyramid.json'
+
+
+class DepthPyramid:
+    """
+    A multi-resolution summary of the depth record of a whole deployment.
+    Level ``0`` holds the samples, and every level above it holds the
+    minimum and maximum depth of ``factor`` bins of the level below, up to a
+    level of at most ``min_bins`` bins. Each level is saved in its own
+    ``.npy`` file and memory mapped when the pyramid is loaded, so reading a
+    time range only reads the part of the one level it needs.
+
+    :ivar factor: the number of bins of a level merged into a bin of the
+        level above
+    :ivar units: the time units of the times
+    :ivar sizes: the number of bins of each level
+    """
+
+    def __init__(self, levels, factor=4, units=time_units):
+        """
+        :param levels: a list of the levels, level ``0`` is a ``2 x n`` array
+            of the times and depths, the others are ``3 x n`` arrays of the
+            bin start times, minimum depths, and maximum depths
+        :param factor: the number of bins of a level merged into a bin of the
+            level above
+        :param units: the time units of the times
+        """
+        self.levels = levels
+        self.factor = factor
+        self.units = units
+        self.sizes = [level.shape[1] for level in levels]
+
+    @classmethod
+    def from_data(cls,
+                  data,
+                  columns={
+                      'depth': 'depth',
+                      'time': 'time'
+                  },
+                  factor=4,
+                  min_bins=1000,
+                  units=time_units):
+        """
+        :param data: a Pandas DataFrame of the whole deployment
+        :param columns: a dictionary of the column names of the depth and time
+        :param factor: the number of bins of a level merged into a bin of the
+            level above
+        :param min_bins: the pyramid stops at the first level with at most
+            this many bins
+        :param units: the time units the times are converted to
+
+        :return: a ``DepthPyramid`` of the depth record
+        """
+        if factor < 2:
+            raise ValueError('factor must be at least 2')
+        time = datetime_to_num(data[columns['time']], units=units)
+        depth = np.asarray(data[columns['depth']], dtype=np.float64)
+        keep = ~np.isnan(time)
+        time, depth = time[keep], depth[keep]
+        if len(time) > 1 and np.any(np.diff(time) < 0):
+            order = np.argsort(time, kind='stable')
+            time, depth = time[order], depth[order]
+
+        levels = [np.vstack([time, depth])]
+        start, minimum, maximum = time, depth, depth
+        while len(start) > min_bins:
+            edges = np.arange(0, len(start), factor)
+            start = start[edges]
+            minimum = np.fmin.reduceat(minimum, edges)
+            maximum = np.fmax.reduceat(maximum, edges)
+            levels.append(np.vstack([start, minimum, maximum]))
+        return cls(levels, factor=factor, units=units)
+
+    @classmethod
+    def load(cls, folder):
+        """
+        :param folder: the path to the folder the pyramid was saved in
+
+        :return: the ``DepthPyramid`` saved in the folder, with its levels
+            memory mapped
+        """
+        folder = os.path.join(folder, pyramid_folder)
+        with open(os.path.join(folder, pyramid_filename)) as f:
+            settings = json.load(f)
+        levels = [
+            np.load(os.path.join(folder, 'level_%02d.npy' % level),
+                    mmap_mode='r') for level in range(settings['levels'])
+        ]
+        return cls(levels, factor=settings['factor'], units=settings['units'])
+
+    def save(self, folder):
+        """
+        :param folder: the path to the folder to save the pyramid in, it is
+            saved in a ``depth_pyramid`` subfolder
+        """
+        folder = os.path.join(folder, pyramid_folder)
+        os.makedirs(folder, exist_ok=True)
+        for level, values in enumerate(self.levels):
+            np.save(os.path.join(folder, 'level_%02d.npy' % level),
+                    np.ascontiguousarray(values))
+        with open(os.path.join(folder, pyramid_filename), 'w') as f:
+            json.dump(
+                {
+                    'levels': len(self.levels),
+                    'factor': self.factor,
+                    'units': self.units,
+                    'sizes': self.sizes
+                }, f)
+
+    @property
+    def time_range(self):
+        """
+        :return: the first and last time of the record
+        """
+        time = self.levels[0][0]
+        if not len(time):
+            return np.nan, np.nan
+        return float(time[0]), float(time[-1])
+
+    def get_level(self, start=None, end=None, max_points=2000):
+        """
+        Picks the finest level with at most ``max_points`` bins between
+        ``start`` and ``end``. Only the times of the levels are searched to
+        pick it.
+
+        :param start: the start of the range in ``units``, ``None`` for the
+            start of the record
+        :param end: the end of the range in ``units``, ``None`` for the end
+            of the record
+        :param max_points: the maximum number of bins in the range
+
+        :return: the number of the level and the first and last bin of the
+            range in it
+        """
+        for level, values in enumerate(self.levels):
+            time = values[0]
+            first = 0 if start is None else max(
+                int(np.searchsorted(time, start, 'right')) - 1, 0)
+            last = len(time) if end is None else int(
+                np.searchsorted(time, end, 'right'))
+            if last - first <= max_points or level == len(self.levels) - 1:
+                return level, first, last
+
+    def get_range(self, start=None, end=None, max_points=2000):
+        """
+        :param start: the start of the range in ``units``, ``None`` for the
+            start of the record
+        :param end: the end of the range in ``units``, ``None`` for the end
+            of the record
+        :param max_points: the maximum number of bins to return
+
+        :return: the times, minimum depths, and maximum depths of the bins of
+            the range as numpy arrays, the minimum and maximum depth are the
+            same on level ``0``
+        """
+        level, first, last = self.get_level(start, end, max_points)
+        values = np.array(self.levels[level][:, first:last])
+        return values[0], values[1], values[-1]
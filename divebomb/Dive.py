@@ -1,17 +1,27 @@
-import copy
 import sys
 from datetime import datetime, timedelta
 
 import numpy as np
 import pandas as pd
-import peakutils as pk
 import plotly.graph_objs as go
 import plotly.offline as py
-from netCDF4 import Dataset, date2num, num2date
+from netCDF4 import Dataset
+
+from divebomb import kernels
+from divebomb.plotting import get_phase_trace
+from divebomb.preprocessing import (datetime_to_num, get_sampling_interval,
+                                    num_to_datetime)
 
 units = 'seconds since 1970-01-01'
 
 
+class InsufficientDiveData(Exception):
+    """
+    Raised while profiling a dive that does not have enough points to find
+    its phases.
+    """
+
+
 class Dive:
     """
     :ivar max_depth: the max depth in the dive
@@ -42,6 +52,44 @@ class Dive:
 
     """
 
+    # The attributes that depend on the at depth threshold
+    _threshold_attributes = ('td_descent_duration', 'td_ascent_duration',
+                             'td_surface_duration', 'bottom_variance',
+                             'dive_variance', 'descent_velocity',
+                             'ascent_velocity', 'td_dive_duration', 'no_skew',
+                             'right_skew', 'left_skew', 'peaks',
+                             'insufficient_data')
+
+    # The columns of the profile table and their types, in table order
+    profile_schema = (('surface_threshold', np.float64),
+                      ('max_depth', np.float64), ('dive_start', np.float64),
+                      ('dive_end', np.float64), ('bottom_start', np.float64),
+                      ('td_bottom_duration', np.float64),
+                      ('bottom_difference', np.float64),
+                      ('td_total_duration', np.float64),
+                      ('td_descent_duration', np.float64),
+                      ('td_ascent_duration', np.float64),
+                      ('td_surface_duration', np.float64),
+                      ('dive_variance', np.float64),
+                      ('bottom_variance', np.float64),
+                      ('descent_velocity', np.float64),
+                      ('ascent_velocity', np.float64),
+                      ('td_dive_duration', np.float64),
+                      ('no_skew', np.float64), ('right_skew', np.float64),
+                      ('left_skew', np.float64), ('peaks', np.float64),
+                      ('insufficient_data', np.bool_))
+
+    # The features that are only computed when they are requested or used,
+    # and the method computing each of them
+    lazy_features = {
+        'bottom_variance': 'set_bottom_variance',
+        'dive_variance': 'set_bottom_variance',
+        'bottom_difference': 'set_bottom_variance',
+        'descent_velocity': 'get_descent_velocity',
+        'ascent_velocity': 'get_ascent_velocity',
+        'peaks': 'get_peaks'
+    }
+
     def __init__(self,
                  data,
                  columns={
@@ -49,7 +97,8 @@ class Dive:
                      'time': 'time'
                  },
                  surface_threshold=0,
-                 at_depth_threshold=0.15):
+                 at_depth_threshold=0.15,
+                 features=None):
         """
         :param data: the time and depth values for the dive
         :param columns: a dictionary of column mappings for the data
@@ -57,13 +106,23 @@ class Dive:
         :param th_threshold: a value from 0 - 1 indicating distance from
             the bottom of the dive at which the animal is considered to be at
             depth
+        :param features: a list of the ``lazy_features`` to compute, the
+            others are computed when they are first used, ``None`` computes
+            all of them
         """
 
         if data[columns['time']].dtypes != np.float64:
-            data.time = date2num(data.time.tolist(), units=units)
-
-        self.data = data.sort_values('time').reset_index(drop=True)
+            data = data.assign(time=datetime_to_num(data.time, units=units))
+
+        # Sorted data, like the slices of ``prepare_dive_data()``, is kept as
+        # a view instead of being copied
+        if not data.time.is_monotonic_increasing:
+            data = data.sort_values('time')
+        self.data = data.set_axis(pd.RangeIndex(len(data)), axis=0,
+                                  copy=False)
         self.surface_threshold = surface_threshold
+        self._phase_arrays = None
+        self._features = features
 
         for k, v in columns.items():
             if k != v:
@@ -77,15 +136,38 @@ class Dive:
         self.td_bottom_duration = None
         self.bottom_difference = None
         self.td_total_duration = self.dive_end - self.dive_start
+        self.profile(at_depth_threshold)
+
+    def profile(self, at_depth_threshold=0.15):
+        """
+        Profiles the phases of the dive for an ``at_depth_threshold``. The
+        values that do not depend on the threshold are computed once and
+        reused, so the same dive can be profiled again at other thresholds
+        cheaply. Only the requested ``features`` of the dive are computed.
+
+        :param at_depth_threshold: a value from 0 - 1 indicating distance from
+            the bottom of the dive at which the animal is considered to be at
+            depth
+        """
+        self._at_depth_threshold = at_depth_threshold
+        self.bottom_start = None
+        self.td_bottom_duration = None
+        self.bottom_difference = None
+        for attribute in self._threshold_attributes:
+            self.__dict__.pop(attribute, None)
+        if self._features is not None:
+            for attribute in self.lazy_features:
+                self.__dict__.pop(attribute, None)
+
         try:
             self.td_descent_duration = self.get_descent_duration(
                 at_depth_threshold)
             self.td_ascent_duration = self.get_ascent_duration(
                 at_depth_threshold)
             self.td_surface_duration = self.get_surface_duration()
-            self.bottom_variance = self.set_bottom_variance()
-            self.descent_velocity = self.get_descent_velocity()
-            self.ascent_velocity = self.get_ascent_velocity()
+            self._evaluate('bottom_variance', 'dive_variance',
+                           'bottom_difference', 'descent_velocity',
+                           'ascent_velocity')
 
             self.td_dive_duration = self.td_total_duration -    \
                 self.td_surface_duration
@@ -93,11 +175,81 @@ class Dive:
             self.right_skew = 0
             self.left_skew = 0
             self.set_skew()
-            self.peaks = self.get_peaks(surface_threshold)
+            self._evaluate('peaks')
             self.insufficient_data = False
-        except:
+        except InsufficientDiveData:
             self.insufficient_data = True
 
+    def _evaluate(self, *features):
+        """
+        Computes the features that were requested, all of them if no features
+        were requested.
+        """
+        for feature in features:
+            if self._features is None or feature in self._features:
+                getattr(self, feature)
+
+    def __getattr__(self, name):
+        """
+        Computes a lazy feature the first time it is used, it is only called
+        for attributes that are not set.
+        """
+        method = type(self).lazy_features.get(name)
+        if method is None or '_at_depth_threshold' not in self.__dict__ or \
+                self.__dict__.get('insufficient_data'):
+            raise AttributeError(name)
+        value = getattr(self, method)()
+        # Some methods set several features at once
+        self.__dict__.setdefault(name, value)
+        return self.__dict__[name]
+
+    def get_phase_arrays(self):
+        """
+        Computes the threshold independent arrays used to find the phases of
+        the dive: the standard deviation of the depth expanding forward from
+        the start of the dive and backwards from the crest of the ascent, and
+        the sample by sample depth comparisons. The arrays are computed once
+        and cached on the dive.
+
+        :return: a dictionary of the cached arrays
+        """
+        if self._phase_arrays is not None:
+            return self._phase_arrays
+
+        depth = self.data.depth.values
+        time = self.data.time.values
+        std_dev = kernels.expanding_std(depth)
+
+        # A point is a possible bottom start when the standard deviation
+        # stops growing or the next point is shallower.
+        descent_candidates = np.zeros(len(depth), dtype=bool)
+        descent_candidates[1:] = std_dev[1:] <= std_dev[:-1]
+        descent_candidates[0] = std_dev[0] <= 0
+        descent_candidates[:-1] |= depth[:-1] >= depth[1:]
+
+        # Find the crest of the dive in reversed values
+        end_index = kernels.find_crest(depth, self.surface_threshold)
+        ascent_candidates = None
+        if end_index < 0:
+            end_index = None
+        else:
+            reversed_std_dev = kernels.expanding_std(
+                depth[end_index::-1])[::-1]
+            previous_std_dev = np.append(reversed_std_dev[1:end_index], 0)
+            ascent_candidates = reversed_std_dev[:end_index] < \
+                previous_std_dev
+            ascent_candidates[1:] |= depth[1:end_index] >= \
+                depth[:end_index - 1]
+
+        self._phase_arrays = {
+            'depth': depth,
+            'time': time,
+            'descent_candidates': descent_candidates,
+            'end_index': end_index,
+            'ascent_candidates': ascent_candidates
+        }
+        return self._phase_arrays
+
     def get_descent_duration(self, at_depth_threshold=0.15):
         """
         :param at_depth_threshold: a value from 0 - 1 indicating distance from
@@ -105,20 +257,15 @@ class Dive:
             depth
         :return: the descent duration in seconds
         """
-        std_dev = 0
-        for i, r in self.data.iterrows():
-            next_std_dev = np.std(self.data.loc[:i, 'depth'])
-            if ((i + 1) not in self.data.index
-                or (next_std_dev <= std_dev or self.data.loc[i, 'depth'] >=
-                    self.data.loc[(i + 1), 'depth']
-                    ) and self.data.loc[i, 'depth'] > (self.max_depth
-                                                       * (1 - at_depth_threshold))):
-                self.bottom_start = self.data.loc[i, 'time']
-                return (self.data.loc[i, 'time'] - self.data.loc[0, 'time'])
-                break
-            else:
-                std_dev = next_std_dev
-        return self.td_descent_duration
+        arrays = self.get_phase_arrays()
+        depth = arrays['depth']
+        time = arrays['time']
+
+        i = kernels.find_bottom_start(
+            arrays['descent_candidates'], depth,
+            self.max_depth * (1 - at_depth_threshold))
+        self.bottom_start = time[i]
+        return (time[i] - time[0])
 
     def get_ascent_duration(self, at_depth_threshold=0.15):
         """
@@ -129,39 +276,32 @@ class Dive:
             depth
         :return: the ascent duration in seconds
         """
-        end_index = -1
-        std_dev = 0
-
-        # Find the crest of the dive in reversed values
-        for i, r in self.data.sort_values('time', ascending=False).iterrows():
-            if self.data.loc[(i - 1), 'depth'] > self.surface_threshold:
-                end_index = i
-                break
+        arrays = self.get_phase_arrays()
+        depth = arrays['depth']
+        time = arrays['time']
+        end_index = arrays['end_index']
+        if end_index is None:
+            raise InsufficientDiveData('the animal never leaves the surface')
 
         # Finds the the change in standard deviation to determine the end of
         # the bottom of the divide.
-        for i, r in self.data[:end_index].sort_values(
-                'time', ascending=False).iterrows():
-            next_std_dev = np.std(self.data.loc[i:end_index, 'depth'])
-            if ((next_std_dev < std_dev or
-                 self.data.loc[i, 'depth']
-                 >= self.data.loc[(i - 1), 'depth']) and
-                    self.data.loc[i, 'depth']
-                    > (self.max_depth * (1 - at_depth_threshold))) or     \
-                    self.data.loc[i, 'depth'] > (self.max_depth * 0.90):
-                self.td_bottom_duration = self.data.loc[i, 'time'] -    \
-                    self.bottom_start
-                if (end_index > 0):
-                    return (self.data.loc[end_index, 'time']
-                            - self.data.loc[i, 'time'])
-
-                break
-            else:
-                std_dev = next_std_dev
-        return self.td_ascent_duration
-
-    # Get the surface duration by subtracting the ascent, descent, and bottom
-    # durations.
+        i = kernels.find_bottom_end(arrays['ascent_candidates'], depth,
+                                    end_index,
+                                    self.max_depth * (1 - at_depth_threshold),
+                                    self.max_depth * 0.90)
+        if i == -2:
+            # The first point has no previous depth to compare against
+            raise InsufficientDiveData('the bottom ends at the first point')
+        elif i == -1:
+            raise InsufficientDiveData('the bottom of the dive has no end')
+
+        self.td_bottom_duration = time[i] - self.bottom_start
+        # Checked here rather than by the features using the bottom, so the
+        # dive is classified the same whichever features are computed
+        if self.td_bottom_duration < 0:
+            raise InsufficientDiveData('the bottom of the dive has no points')
+        return (time[end_index] - time[i])
+
     def get_surface_duration(self):
         """
         :return: the surface duration in seconds
@@ -242,10 +382,14 @@ class Dive:
         else:
             self.no_skew = 1
 
-    def get_peaks(self, surface_threshold=0):
+    def get_peaks(self, surface_threshold=None):
         """
+        :param surface_threshold: the depth the peaks have to be deeper than,
+            defaults to the ``surface_threshold`` of the dive
         :return: number of peaks found within a dive
         """
+        if surface_threshold is None:
+            surface_threshold = self.surface_threshold
         self.peaks = 0
         # Get and set the bottom data
         bottom_data = self.data[(self.data.time >= self.bottom_start) & (
@@ -258,10 +402,10 @@ class Dive:
             ) / (bottom_data.depth.max() - bottom_data.depth.min())), 0.5)
         else:
             threshold = 0.5
-        peaks = pk.indexes(
+        peaks = kernels.peak_indexes(
             bottom_data.depth * (-1),
             thres=threshold,
-            min_dist=max((10 / self.data.time.diff().mean()), 3))
+            min_dist=max((10 / get_sampling_interval(self.data)), 3))
 
         peak_data = bottom_data[(bottom_data.index.isin(peaks)) & (
             bottom_data.depth > surface_threshold)]
@@ -273,32 +417,36 @@ class Dive:
         """
         :return: a dictionary of the dive profile
         """
-        dive = copy.deepcopy(self.__dict__)
-        del dive['data']
-        return dive
+        # The values are scalars so they do not need to be copied
+        return {
+            key: value
+            for key, value in self.__dict__.items()
+            if key != 'data' and not key.startswith('_')
+        }
 
     # Used to plot the dive
-    def plot(self):
+    def get_figure(self, max_points=None, downsample_method='lttb'):
         """
-        :return: a plotly graph showing the phases of the dive
+        :param max_points: the maximum number of points per phase, ``None``
+            plots every point
+        :param downsample_method: either ``lttb`` or ``minmax``
+        :return: a plotly figure of the phases of the dive
         """
         # Get and set the descent data
         descent_data = self.data[self.data.time <= self.bottom_start]
-        descent = go.Scatter(
-            x=num2date(descent_data.time.tolist(), units=units),
-            y=descent_data.depth,
-            mode='lines+markers',
-            name='Descent')
+        descent = get_phase_trace(descent_data.time, descent_data.depth,
+                                  'Descent', units, mode='lines+markers',
+                                  max_points=max_points,
+                                  method=downsample_method)
 
         # Get and set the bottom data
         bottom_data = self.data[(self.data.time >= self.bottom_start) & (
             self.data.time <= (self.bottom_start + self.td_bottom_duration))]
 
-        bottom = go.Scatter(
-            x=num2date(bottom_data.time.tolist(), units=units),
-            y=bottom_data.depth,
-            mode='lines+markers',
-            name='Bottom')
+        bottom = get_phase_trace(bottom_data.time, bottom_data.depth, 'Bottom',
+                                 units, mode='lines+markers',
+                                 max_points=max_points,
+                                 method=downsample_method)
 
         # Get and set the ascent data
         ascent_data = self.data[
@@ -307,27 +455,33 @@ class Dive:
             & (self.data.time
                <= (self.data.time.max() - self.td_surface_duration))
         ]
-        ascent = go.Scatter(
-            x=num2date(ascent_data.time.tolist(), units=units),
-            y=ascent_data.depth,
-            mode='lines+markers',
-            name='Ascent')
+        ascent = get_phase_trace(ascent_data.time, ascent_data.depth, 'Ascent',
+                                 units, mode='lines+markers',
+                                 max_points=max_points,
+                                 method=downsample_method)
 
         # Get and set the surface data
         surface_data = self.data[self.data.time >= (
             self.data.time.max() - self.td_surface_duration)]
 
-        surface = go.Scatter(
-            x=num2date(surface_data.time.tolist(), units=units),
-            y=surface_data.depth,
-            mode='lines+markers',
-            name='Surface')
+        surface = get_phase_trace(surface_data.time, surface_data.depth,
+                                  'Surface', units, mode='lines+markers',
+                                  max_points=max_points,
+                                  method=downsample_method)
 
         layout = go.Layout(
             title='Dive starting at {}'.format(
-                num2date(self.dive_start, units=units)),
+                pd.Timestamp(num_to_datetime(self.dive_start, units=units))),
             xaxis=dict(title='Time'),
             yaxis=dict(title='Depth in Meters', autorange='reversed'))
         plot_data = [descent, bottom, ascent, surface]
-        fig = go.Figure(data=plot_data, layout=layout)
-        return py.iplot(fig)
+        return go.Figure(data=plot_data, layout=layout)
+
+    def plot(self, max_points=None, downsample_method='lttb'):
+        """
+        :param max_points: the maximum number of points per phase, ``None``
+            plots every point
+        :param downsample_method: either ``lttb`` or ``minmax``
+        :return: a plotly graph showing the phases of the dive
+        """
+        return py.iplot(self.get_figure(max_points, downsample_method))
@@ -0,0 +1,184 @@
+import glob
+import os
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from netCDF4 import Dataset
+
+# Archives shared between calls, keyed by folder
+_archives = {}
+
+
+def get_dive_archive(folder):
+    """
+    :param folder: the path to the results folder contianing the cluster
+        folders
+
+    :return: a ``DiveArchive`` for the folder that is shared between calls so
+        its cache is reused
+    """
+    folder = os.path.abspath(folder)
+    if folder not in _archives:
+        _archives[folder] = DiveArchive(folder)
+    return _archives[folder]
+
+
+class DiveArchive:
+    """
+    Reads the per dive netCDF files of an export folder. The files are read
+    concurrently with a thread pool and the most recently used dives are kept
+    in a least recently used cache, so browsing the same dives again does
+    not go back to the file system. The dives are returned as numpy arrays.
+
+    HDF5 is not thread safe, so the threads read the raw bytes of the files
+    concurrently and only the decoding of the bytes is serialized.
+
+    :ivar folder: the path to the results folder
+    :ivar cache_size: the number of dives kept in the cache
+    :ivar validate: whether the modification time of a file is checked before
+        a cached dive is returned
+    """
+
+    def __init__(self, folder, max_workers=8, cache_size=1024, validate=True):
+        """
+        :param folder: the path to the results folder contianing the cluster
+            folders
+        :param max_workers: the number of threads used to read the files
+        :param cache_size: the number of dives kept in the cache
+        :param validate: whether the modification time of a file is checked
+            before a cached dive is returned, so re-exported dives are read
+            again
+        """
+        self.folder = folder
+        self.cache_size = cache_size
+        self.validate = validate
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._netcdf_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def get_filename(self, cluster, dive_id):
+        """
+        :param cluster: the number of the cluster of the dive
+        :param dive_id: the number of of the dive
+
+        :return: the path to the netCDF file of the dive
+        """
+        return '%s/cluster_%d/dive_%05d.nc' % (self.folder, cluster, dive_id)
+
+    def list_dives(self):
+        """
+        :return: a Pandas DataFrame of the ``cluster`` and ``dive_id`` of every
+            dive file in the folder
+        """
+        pattern = re.compile(r'cluster_(\d+)[\\/]dive_(\d+)\.nc$')
+        dives = []
+        for filename in glob.glob(
+                os.path.join(self.folder, 'cluster_*', 'dive_*.nc')):
+            match = pattern.search(filename)
+            if match:
+                dives.append({
+                    'cluster': int(match.group(1)),
+                    'dive_id': int(match.group(2))
+                })
+        dives = pd.DataFrame(dives, columns=['cluster', 'dive_id'])
+        return dives.sort_values('dive_id').reset_index(drop=True)
+
+    def _read_file(self, filename):
+        """
+        :param filename: the path to the netCDF file of a dive
+
+        :return: a dictionary with the ``time`` and ``depth`` arrays and the
+            ``attributes`` of the dive
+        """
+        with open(filename, 'rb') as f:
+            memory = f.read()
+
+        with self._netcdf_lock:
+            rootgrp = Dataset('inmemory.nc', memory=memory)
+            rootgrp.set_auto_mask(False)
+            dive = {
+                'time': np.asarray(rootgrp.variables['time'][:]),
+                'depth': np.asarray(rootgrp.variables['depth'][:]),
+                'attributes': rootgrp.__dict__
+            }
+            rootgrp.close()
+        return dive
+
+    def read_dive(self, cluster, dive_id):
+        """
+        :param cluster: the number of the cluster of the dive
+        :param dive_id: the number of of the dive
+
+        :return: a dictionary with the ``time`` and ``depth`` arrays and the
+            ``attributes`` of the dive
+        """
+        filename = self.get_filename(cluster, dive_id)
+        modified = os.path.getmtime(filename) if self.validate else None
+
+        with self._cache_lock:
+            if filename in self._cache:
+                cached_modified, dive = self._cache[filename]
+                if cached_modified == modified:
+                    self._cache.move_to_end(filename)
+                    return dive
+
+        dive = self._read_file(filename)
+
+        with self._cache_lock:
+            self._cache[filename] = (modified, dive)
+            self._cache.move_to_end(filename)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return dive
+
+    def read_attributes(self, cluster, dive_id):
+        """
+        :param cluster: the number of the cluster of the dive
+        :param dive_id: the number of of the dive
+
+        :return: a dictionary of the attributes of the dive
+        """
+        return self.read_dive(cluster, dive_id)['attributes']
+
+    def read_dives(self, clusters, dive_ids):
+        """
+        Reads many dives concurrently.
+
+        :param clusters: a list of the cluster of each dive
+        :param dive_ids: a list of the dive ids
+
+        :return: a list of dictionaries with the ``time`` and ``depth`` arrays
+            and the ``attributes`` of each dive, in the order requested
+        """
+        return list(
+            self._executor.map(self.read_dive, list(clusters),
+                               list(dive_ids)))
+
+    def read_cluster(self, cluster):
+        """
+        :param cluster: the number of the cluster
+
+        :return: a list of the dives in the cluster, see ``read_dives()``
+        """
+        dives = self.list_dives()
+        dives = dives[dives.cluster == cluster]
+        return self.read_dives(dives.cluster, dives.dive_id)
+
+    def clear(self):
+        """
+        Empties the cache.
+        """
+        with self._cache_lock:
+            self._cache.clear()
+
+    def close(self):
+        """
+        Empties the cache and stops the threads.
+        """
+        self.clear()
+        self._executor.shutdown()
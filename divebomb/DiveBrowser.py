@@ -0,0 +1,206 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import plotly.offline as py
+
+from divebomb.DeepDive import DeepDive
+from divebomb.Dive import Dive
+
+
+class DiveBrowser:
+    """
+    Profiles and draws the dives shown by the ``ipython_display_mode`` slider
+    of ``profile_dives()``. The profiled dives and their figures are kept in
+    a least recently used cache, and the dives next to the one shown are
+    profiled in a background thread while it is being looked at, so moving
+    the slider back and forth does not profile the same dives again.
+
+    :ivar cache_size: the number of dives kept in the cache
+    :ivar prefetch: the number of dives on each side of the shown dive that
+        are prepared in the background
+    """
+
+    def __init__(self,
+                 data,
+                 starts,
+                 type='Dive',
+                 surface_threshold=0,
+                 at_depth_threshold=0.15,
+                 cache_size=64,
+                 prefetch=2,
+                 max_points=None,
+                 downsample_method='lttb'):
+        """
+        :param data: the data sorted by time, see
+            ``divebomb.prepare_dive_data()``
+        :param starts: the dive starts from
+            ``divebomb.get_dive_starting_points()``
+        :param type: either ``Dive`` or ``DeepDive``
+        :param surface_threshold: the threshold at which is considered surface
+            for surfacing animals
+        :param at_depth_threshold: a value from 0 - 1 indicating distance from
+            the bottom of the dive at which the animal is considered to be at
+            depth
+        :param cache_size: the number of dives kept in the cache
+        :param prefetch: the number of dives on each side of the shown dive
+            that are prepared in the background, ``0`` disables it
+        :param max_points: the maximum number of points per phase in the
+            figures, ``None`` plots every point
+        :param downsample_method: either ``lttb`` or ``minmax``
+        """
+        self.data = data
+        self.starts = starts
+        self.type = type
+        self.surface_threshold = surface_threshold
+        self.at_depth_threshold = at_depth_threshold
+        self.cache_size = cache_size
+        self.prefetch = prefetch
+        self.max_points = max_points
+        self.downsample_method = downsample_method
+        self._cache = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def _profile(self, index):
+        """
+        :param index: the index of the dive in the starts
+
+        :return: the ``Dive`` or ``DeepDive`` profile and its figure, ``None``
+            if the dive has insufficient data
+        """
+        dive_data = self.data[self.starts.loc[index, 'start_block']:self.
+                              starts.loc[index, 'end_block']]
+        if self.type.lower() == 'deepdive':
+            dive_profile = DeepDive(dive_data,
+                                    at_depth_threshold=self.at_depth_threshold)
+        else:
+            dive_profile = Dive(dive_data,
+                                surface_threshold=self.surface_threshold,
+                                at_depth_threshold=self.at_depth_threshold)
+
+        figure = None
+        # Only the surfacing dives can have insufficient data
+        if not getattr(dive_profile, 'insufficient_data', False):
+            figure = dive_profile.get_figure(self.max_points,
+                                             self.downsample_method)
+        return dive_profile, figure
+
+    def _store(self, index, dive):
+        """
+        Adds a profiled dive to the cache and drops the least recently used
+        dives.
+        """
+        with self._lock:
+            self._pending.pop(index, None)
+            self._cache[index] = dive
+            self._cache.move_to_end(index)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _prefetch(self, index):
+        """
+        Cancels the background profiles of the dives that are no longer
+        within ``prefetch`` of ``index`` and profiles the dives around it that
+        are not cached in the background, the closest first.
+        """
+        with self._lock:
+            # The done futures left in pending are the failed prefetches
+            for neighbour, future in list(self._pending.items()):
+                if abs(neighbour - index) > self.prefetch and \
+                        (future.cancel() or future.done()):
+                    del self._pending[neighbour]
+
+        for offset in range(1, self.prefetch + 1):
+            for neighbour in (index + offset, index - offset):
+                if neighbour not in self.starts.index:
+                    continue
+                with self._lock:
+                    # Only the dive being profiled can be left from before
+                    if neighbour in self._cache or \
+                            neighbour in self._pending or \
+                            len(self._pending) > 2 * self.prefetch:
+                        continue
+                    self._pending[neighbour] = self._executor.submit(
+                        self._prefetch_dive, neighbour)
+
+    def _prefetch_dive(self, index):
+        """
+        Profiles a dive in the background thread and caches it.
+        """
+        dive = self._profile(index)
+        self._store(index, dive)
+        return dive
+
+    def get_dive(self, index):
+        """
+        :param index: the index of the dive in the starts
+
+        :return: the ``Dive`` or ``DeepDive`` profile of the dive and its
+            figure, ``None`` if the dive has insufficient data
+        """
+        index = int(index)
+        with self._lock:
+            dive = self._cache.get(index)
+            if dive is not None:
+                self._cache.move_to_end(index)
+            future = self._pending.get(index)
+            # A prefetch that has not started would wait behind the others,
+            # the dive is profiled in this thread instead
+            if dive is None and future is not None and future.cancel():
+                del self._pending[index]
+                future = None
+
+        if dive is None and future is not None:
+            try:
+                dive = future.result()
+            except Exception:
+                # Profile it again in this thread so the error is shown
+                with self._lock:
+                    self._pending.pop(index, None)
+        if dive is None:
+            dive = self._profile(index)
+            self._store(index, dive)
+
+        self._prefetch(index)
+        return dive
+
+    def display(self, index):
+        """
+        Shows a dive, used as the callback of the slider.
+
+        :param index: the index of the dive in the starts
+
+        :return: a dive plot from plotly
+        """
+        index = int(index)
+        print("Data Indices - " + str(self.starts.loc[index, 'start_block']) +
+              ":" + str(self.starts.loc[index, 'end_block']))
+        dive_profile, figure = self.get_dive(index)
+        if figure is not None:
+            return py.iplot(figure)
+        else:
+            print("WARNING: There was not enough data to correctly profile \
+            this dive. You may try adjusting the sensitivity or the minimal \
+            time between dives to correct this.")
+            print(dive_profile.to_dict())
+
+    def clear(self):
+        """
+        Empties the cache.
+        """
+        with self._lock:
+            self._cache.clear()
+
+    def close(self):
+        """
+        Empties the cache, cancels the prefetches, and stops the background
+        thread.
+        """
+        self.clear()
+        with self._lock:
+            for future in self._pending.values():
+                future.cancel()
+            self._pending.clear()
+        self._executor.shutdown()
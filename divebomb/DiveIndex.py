@@ -0,0 +1,262 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+index_filename = 'dive_index.npz'
+
+# The columns that are not summary features of the dive shape
+excluded_columns = [
+    'dive_id', 'cluster', 'dive_start', 'dive_end', 'bottom_start',
+    'insufficient_data', 'surface_threshold', 'segment'
+]
+
+
+class DiveIndex:
+    """
+    A similarity index of the dives of an export folder. Each dive is
+    represented by its shape, the depth divided by the max depth of the dive
+    resampled over the normalized time of the dive, and by its standardized
+    summary features. The index is saved in the export folder so the
+    queries do not read the per dive files.
+
+    :ivar dive_ids: an array of the dive ids
+    :ivar clusters: an array of the cluster of each dive
+    :ivar shapes: a matrix of the normalized shape of each dive
+    :ivar features: a matrix of the summary features of each dive
+    :ivar feature_names: the names of the summary features
+    """
+
+    def __init__(self, dive_ids, clusters, shapes, features, feature_names):
+        """
+        :param dive_ids: an array of the dive ids
+        :param clusters: an array of the cluster of each dive
+        :param shapes: a matrix of the normalized shape of each dive, see
+            ``divebomb.get_dive_shapes()``
+        :param features: a matrix of the summary features of each dive
+        :param feature_names: the names of the summary features
+        """
+        self.dive_ids = np.asarray(dive_ids, dtype=np.int64)
+        self.clusters = np.asarray(clusters, dtype=np.int64)
+        self.shapes = np.asarray(shapes, dtype=np.float64)
+        self.features = np.asarray(features, dtype=np.float64)
+        self.feature_names = list(feature_names)
+        self._set_scaled_features()
+
+    @classmethod
+    def from_dives(cls, dives, shapes):
+        """
+        :param dives: a Pandas DataFrame of the dive profiles with a
+            ``dive_id`` and a ``cluster`` column
+        :param shapes: a matrix of the normalized shape of each dive
+
+        :return: a ``DiveIndex`` of the dives
+        """
+        feature_names = [
+            column for column in dives.columns
+            if column not in excluded_columns
+            and pd.api.types.is_numeric_dtype(dives[column])
+        ]
+        return cls(dives.dive_id.values, dives.cluster.values, shapes,
+                   dives[feature_names].fillna(0).values, feature_names)
+
+    @classmethod
+    def load(cls, folder):
+        """
+        :param folder: the path to the export folder
+
+        :return: the ``DiveIndex`` saved in the folder
+        """
+        with np.load(os.path.join(folder, index_filename)) as saved:
+            return cls(saved['dive_ids'], saved['clusters'], saved['shapes'],
+                       saved['features'], saved['feature_names'].tolist())
+
+    def save(self, folder):
+        """
+        :param folder: the path to the export folder
+        """
+        np.savez(os.path.join(folder, index_filename),
+                 dive_ids=self.dive_ids,
+                 clusters=self.clusters,
+                 shapes=self.shapes,
+                 features=self.features,
+                 feature_names=np.array(self.feature_names, dtype=str))
+
+    def update(self, other):
+        """
+        Adds the dives of another index, replacing the dives with the same
+        ids.
+
+        :param other: a ``DiveIndex``
+        """
+        keep = ~np.isin(self.dive_ids, other.dive_ids)
+        features = other.features
+        if self.feature_names != other.feature_names:
+            features = pd.DataFrame(
+                other.features, columns=other.feature_names).reindex(
+                    columns=self.feature_names, fill_value=0).values
+
+        dive_ids = np.concatenate([self.dive_ids[keep], other.dive_ids])
+        order = np.argsort(dive_ids, kind='stable')
+        self.dive_ids = dive_ids[order]
+        self.clusters = np.concatenate([self.clusters[keep],
+                                        other.clusters])[order]
+        self.shapes = np.concatenate([self.shapes[keep], other.shapes])[order]
+        self.features = np.concatenate([self.features[keep],
+                                        features])[order]
+        self._set_scaled_features()
+
+    def _set_scaled_features(self):
+        """
+        Standardizes the summary features so they weigh equally in the
+        distances.
+        """
+        std = self.features.std(axis=0) if len(self.features) else 1
+        std = np.where(std > 0, std, 1)
+        mean = self.features.mean(axis=0) if len(self.features) else 0
+        self._mean = mean
+        self._std = std
+        self._scaled_features = (self.features - mean) / std
+
+    def _get_query(self, dive_id, shape, features):
+        """
+        :return: the shape, the scaled features, and the position of the
+            query dive in the index or ``None``
+        """
+        position = None
+        if dive_id is not None:
+            positions = np.flatnonzero(self.dive_ids == dive_id)
+            if not len(positions):
+                raise KeyError(dive_id)
+            position = positions[0]
+            shape = self.shapes[position]
+            features = self._scaled_features[position]
+        elif features is not None:
+            features = (np.asarray(features, dtype=np.float64) -
+                        self._mean) / self._std
+        return np.asarray(shape, dtype=np.float64), features, position
+
+    def _get_results(self, distances, candidates, k):
+        """
+        :return: a Pandas DataFrame of the ``k`` nearest candidates
+        """
+        order = np.argsort(distances, kind='stable')[:k]
+        return pd.DataFrame({
+            'dive_id': self.dive_ids[candidates[order]],
+            'cluster': self.clusters[candidates[order]],
+            'distance': distances[order]
+        })
+
+    def query(self,
+              dive_id=None,
+              shape=None,
+              features=None,
+              k=50,
+              metric='euclidean',
+              feature_weight=1.0,
+              window=0.1):
+        """
+        Finds the dives most like a dive of the index or a given shape.
+
+        :param dive_id: the id of a dive of the index to search with, it is
+            left out of the results
+        :param shape: a normalized shape to search with instead of a dive
+        :param features: the summary features of the ``shape``, in the order
+            of ``feature_names``
+        :param k: the number of dives to return
+        :param metric: ``euclidean`` or ``dtw`` for dynamic time warping of the
+            shapes
+        :param feature_weight: the weight of the summary feature distance,
+            ``0`` compares the shapes only
+        :param window: the warping window of ``dtw`` as a fraction of the
+            shape length
+        :return: a Pandas DataFrame of the ``dive_id``, ``cluster``, and
+            ``distance`` of the nearest dives
+        """
+        shape, features, position = self._get_query(dive_id, shape, features)
+        candidates = np.arange(len(self.dive_ids))
+        if position is not None:
+            candidates = candidates[candidates != position]
+
+        feature_distances = np.zeros(len(candidates))
+        if features is not None and feature_weight:
+            feature_distances = feature_weight * np.sum(
+                (self._scaled_features[candidates] - features)**2, axis=1)
+
+        if metric == 'euclidean':
+            distances = np.sum((self.shapes[candidates] - shape)**2, axis=1)
+            return self._get_results(np.sqrt(distances + feature_distances),
+                                     candidates, k)
+        elif metric == 'dtw':
+            return self._query_dtw(shape, candidates, feature_distances, k,
+                                   window)
+        raise ValueError('metric must be euclidean or dtw')
+
+    def _query_dtw(self, shape, candidates, feature_distances, k, window,
+                   batch_size=256):
+        """
+        Searches in the order of the LB_Keogh lower bound and computes the
+        exact distances in batches until the lower bound of the next batch is
+        larger than the ``k`` th best distance.
+        """
+        radius = int(np.ceil(window * len(shape)))
+        upper, lower = get_envelope(shape, radius)
+        shapes = self.shapes[candidates]
+        bounds = np.sum(
+            np.where(shapes > upper, (shapes - upper)**2, 0) +
+            np.where(shapes < lower, (lower - shapes)**2, 0),
+            axis=1) + feature_distances
+        order = np.argsort(bounds, kind='stable')
+
+        distances = np.full(len(candidates), np.inf)
+        kth_best = np.inf
+        for batch in range(0, len(order), batch_size):
+            batch_order = order[batch:batch + batch_size]
+            if bounds[batch_order[0]] > kth_best:
+                break
+            distances[batch_order] = get_dtw_distances(
+                shape, shapes[batch_order],
+                radius) + feature_distances[batch_order]
+            computed = distances[np.isfinite(distances)]
+            if len(computed) >= k:
+                kth_best = np.partition(computed, k - 1)[k - 1]
+
+        computed = np.flatnonzero(np.isfinite(distances))
+        return self._get_results(np.sqrt(distances[computed]),
+                                 candidates[computed], k)
+
+
+def get_envelope(shape, radius):
+    """
+    :param shape: a shape
+    :param radius: the warping window in points
+
+    :return: the upper and lower envelope of the shape within the window
+    """
+    padded = np.pad(shape, radius, mode='edge')
+    windows = np.lib.stride_tricks.sliding_window_view(padded,
+                                                       2 * radius + 1)
+    return windows.max(axis=1), windows.min(axis=1)
+
+
+def get_dtw_distances(shape, shapes, radius):
+    """
+    Computes the squared dynamic time warping distance between a shape and
+    many shapes at once, within a Sakoe-Chiba band.
+
+    :param shape: a shape
+    :param shapes: a matrix of shapes of the same length
+    :param radius: the warping window in points
+
+    :return: an array of the squared distances
+    """
+    n = len(shape)
+    cost = np.full((len(shapes), n + 1), np.inf)
+    cost[:, 0] = 0
+    for i in range(n):
+        previous = cost
+        cost = np.full((len(shapes), n + 1), np.inf)
+        for j in range(max(0, i - radius), min(n, i + radius + 1)):
+            cost[:, j + 1] = (shape[i] - shapes[:, j])**2 + np.minimum(
+                np.minimum(previous[:, j], previous[:, j + 1]), cost[:, j])
+    return cost[:, n]
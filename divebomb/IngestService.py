@@ -0,0 +1,384 @@
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
+
+import numpy as np
+import pandas as pd
+
+from divebomb import (assign_incremental_clusters, get_dive_starting_points,
+                      prepare_dive_data, profile_starts)
+from divebomb.preprocessing import datetime_to_num
+
+# The reasons of the HTTP status codes the service answers with
+status_reasons = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed'
+}
+
+
+def process_samples(time, depth, params, depth_range=None, flush=False):
+    """
+    Detects and profiles the dives of the samples of a tag that have not been
+    profiled yet. The last dive is still going on unless ``flush`` is set,
+    so it is kept for the next samples. Used by ``IngestService`` so it can be
+    sent to a worker process.
+
+    :param time: a numpy array of the times in seconds since 1970-01-01
+    :param depth: a numpy array of the depths
+    :param params: a dictionary of the detection and profiling arguments
+    :param depth_range: the minimum and maximum depth the sensitivity is
+        relative to, see ``get_dive_starting_points()``
+    :param flush: whether to profile the last dive too
+
+    :return: a Pandas DataFrame of the profiles of the completed dives and the
+        times and depths of the samples to keep for the next call
+    """
+    data = prepare_dive_data(pd.DataFrame({'time': time, 'depth': depth}))
+    # Peak detection needs a few points to work with
+    if len(data) < 3:
+        return pd.DataFrame(), data.time.values, data.depth.values
+
+    starts = get_dive_starting_points(
+        data,
+        is_surfacing_animal=params['is_surfacing_animal'],
+        dive_detection_sensitivity=params['dive_detection_sensitivity'],
+        minimal_time_between_dives=params['minimal_time_between_dives'],
+        surface_threshold=params['surface_threshold'],
+        depth_range=depth_range,
+        sampling_interval=params['sampling_interval'])
+
+    keep = len(data)
+    if not flush and len(starts):
+        # A later, deeper peak can still replace a dive start less than
+        # minimal_time_between_dives before the last sample, so the dives
+        # ending there are kept until more samples arrive
+        ends = data.time.values[starts.end_block.values.clip(
+            max=len(data) - 1)]
+        cutoff = data.time.values[-1] - params['minimal_time_between_dives']
+        completed = int(np.searchsorted(ends[:-1] > cutoff, True))
+        keep = int(starts.start_block.iloc[completed])
+        starts = starts[:completed]
+
+    dives = pd.DataFrame()
+    if len(starts):
+        dives = profile_starts(
+            data,
+            starts,
+            type='Dive' if params['is_surfacing_animal'] else 'DeepDive',
+            surface_threshold=params['surface_threshold'],
+            at_depth_threshold=params['at_depth_threshold'],
+            features=params['features'])
+    return dives, data.time.values[keep:], data.depth.values[keep:]
+
+
+def assign_clusters(dives, model):
+    """
+    :param dives: a Pandas DataFrame of dive profiles
+    :param model: the models returned by ``fit_incremental_clusters()``
+
+    :return: the dives with a ``cluster`` column, ``None`` for the dives with
+        insufficient data
+    """
+    if 'insufficient_data' in dives.columns:
+        sufficient = ~dives.insufficient_data.values.astype(bool)
+    else:
+        sufficient = np.ones(len(dives), dtype=bool)
+    clusters = np.full(len(dives), None, dtype=object)
+    if sufficient.any():
+        clustered = pd.concat([
+            batch for batch, pca_output_matrix in assign_incremental_clusters(
+                dives[sufficient], model)
+        ])
+        clusters[sufficient] = clustered.cluster.values
+    return dives.assign(cluster=clusters)
+
+
+class TagState:
+    """
+    The samples of a tag waiting for their dive to end.
+
+    :ivar time: a numpy array of the times of the samples
+    :ivar depth: a numpy array of the depths of the samples
+    :ivar depth_range: the minimum and maximum depth of every sample of the
+        tag
+    :ivar dives: the number of dives profiled so far
+    """
+
+    def __init__(self):
+        self.time = np.empty(0)
+        self.depth = np.empty(0)
+        self.depth_range = None
+        self.dives = 0
+        self.lock = asyncio.Lock()
+
+    def add(self, time, depth):
+        """
+        :param time: a numpy array of the times of new samples
+        :param depth: a numpy array of the depths of new samples
+        """
+        self.time = np.concatenate([self.time, time])
+        self.depth = np.concatenate([self.depth, depth])
+        if len(depth):
+            minimum, maximum = np.nanmin(depth), np.nanmax(depth)
+            if self.depth_range is not None:
+                minimum = min(minimum, self.depth_range[0])
+                maximum = max(maximum, self.depth_range[1])
+            self.depth_range = (float(minimum), float(maximum))
+
+
+class IngestService:
+    """
+    A local asyncio service classifying dives as their samples arrive. The
+    samples are sent in batches per tag, and every batch returns the
+    profiles of the dives it completed, with their cluster when a model
+    from ``fit_incremental_clusters()`` is given. The batches of a tag are
+    processed in order, the tags do not wait on each other, and the
+    detection and profiling run in an executor so the event loop keeps
+    answering.
+
+    Over HTTP, ``POST /tags/<tag>/samples`` takes a JSON object with ``time``
+    (seconds since 1970-01-01 or datetime strings) and ``depth`` lists,
+    ``POST /tags/<tag>/flush`` profiles the dive still going on at the end of
+    a deployment, and ``GET /tags`` lists the tags. The answers are JSON
+    objects with a ``dives`` list.
+
+    :ivar params: a dictionary of the detection and profiling arguments
+    :ivar depth_range: the fixed depth range of the detection or ``None``
+    :ivar model: the clustering model or ``None``
+    :ivar tags: a dictionary of the ``TagState`` of each tag
+    """
+
+    def __init__(self,
+                 is_surfacing_animal=True,
+                 dive_detection_sensitivity=None,
+                 minimal_time_between_dives=120,
+                 surface_threshold=0,
+                 at_depth_threshold=0.15,
+                 depth_range=None,
+                 sampling_interval=None,
+                 features=None,
+                 model=None,
+                 executor=None):
+        """
+        :param is_surfacing_animal: a boolean indicating whether it's an
+            animal that is gauranteed to surface between dives
+        :param dive_detection_sensitivity: a value bteween 0 and 1 indicating
+            the peak detection threshold, the lower the value the deeper the
+            threshold
+        :param minimal_time_between_dives: the minimum time in seconds that
+            needs to occur before there can be a new dive segement
+        :param surface_threshold: the threshold at which is considered surface
+            for surfacing animals, default is 0
+        :param at_depth_threshold: a value from 0 - 1 indicating distance from
+            the bottom of the dive at which the animal is considered to be at
+            depth
+        :param depth_range: the minimum and maximum depth the sensitivity is
+            relative to, defaults to the range of the samples of each tag so
+            far, which can detect the first dives of a tag differently than
+            the whole record would
+        :param sampling_interval: the sampling interval in seconds,
+            calculated from the samples waiting for their dive to end if not
+            provided
+        :param features: a list of the features to profile, see
+            ``profile_dives()``
+        :param model: an optional model from ``fit_incremental_clusters()``
+            to assign the clusters of the dives
+        :param executor: the ``concurrent.futures`` executor running the
+            detection and profiling, a ``ThreadPoolExecutor`` by default. A
+            ``ProcessPoolExecutor`` spreads the tags over processes, create it
+            with the ``spawn`` or ``forkserver`` context since forking a
+            process running threads can hang the workers.
+        """
+        self.params = {
+            'is_surfacing_animal': is_surfacing_animal,
+            'dive_detection_sensitivity': dive_detection_sensitivity,
+            'minimal_time_between_dives': minimal_time_between_dives,
+            'surface_threshold': surface_threshold,
+            'at_depth_threshold': at_depth_threshold,
+            'sampling_interval': sampling_interval,
+            'features': features
+        }
+        self.depth_range = depth_range
+        self.model = model
+        self.tags = {}
+        self._executor = executor or ThreadPoolExecutor()
+
+    def _get_tag(self, tag):
+        if tag not in self.tags:
+            self.tags[tag] = TagState()
+        return self.tags[tag]
+
+    async def _process(self, tag, time=None, depth=None, flush=False):
+        state = self._get_tag(tag)
+        # The batches of a tag are processed one at a time, in order
+        async with state.lock:
+            if time is not None:
+                state.add(time, depth)
+            loop = asyncio.get_running_loop()
+            dives, state.time, state.depth = await loop.run_in_executor(
+                self._executor, process_samples, state.time, state.depth,
+                self.params, self.depth_range or state.depth_range, flush)
+            if not len(dives):
+                return []
+
+            dives.insert(0, 'tag', tag)
+            dive_ids = np.arange(len(dives)) + state.dives + 1
+            dives.insert(1, 'dive_id', dive_ids)
+            state.dives += len(dives)
+        if self.model is not None:
+            dives = await loop.run_in_executor(self._executor,
+                                               assign_clusters, dives,
+                                               self.model)
+        return get_records(dives)
+
+    async def ingest(self, tag, time, depth):
+        """
+        Adds a batch of samples of a tag.
+
+        :param tag: the id of the tag
+        :param time: the times of the samples, in seconds since 1970-01-01 or
+            datetimes
+        :param depth: the depths of the samples
+
+        :return: a list of the profiles of the dives the batch completed
+        """
+        time = datetime_to_num(np.asarray(time))
+        depth = np.asarray(depth, dtype=np.float64)
+        if len(time) != len(depth):
+            raise ValueError('time and depth must have the same length')
+        # Checked here so a bad batch is not added to the samples of the tag
+        if np.isnan(time).any():
+            raise ValueError('the time column has missing values')
+        return await self._process(tag, time, depth)
+
+    async def flush(self, tag):
+        """
+        Profiles the samples left of a tag, at the end of a deployment.
+
+        :param tag: the id of the tag
+
+        :return: a list of the profiles of the remaining dives
+        """
+        if tag not in self.tags:
+            raise KeyError(tag)
+        return await self._process(tag, flush=True)
+
+    async def handle(self, reader, writer):
+        """
+        Answers the HTTP requests of a connection.
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, path, version = request_line.decode().split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode().partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(
+                    int(headers.get('content-length', 0)))
+
+                status, answer = await self.route(method, path, body)
+                payload = json.dumps(answer).encode()
+                writer.write(('HTTP/1.1 %d %s\r\n'
+                              'Content-Type: application/json\r\n'
+                              'Content-Length: %d\r\n\r\n' %
+                              (status, status_reasons[status],
+                               len(payload))).encode() + payload)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method, path, body):
+        """
+        :param method: the HTTP method
+        :param path: the path of the request
+        :param body: the body of the request
+
+        :return: the HTTP status code and the JSON answer
+        """
+        parts = [unquote(part) for part in path.strip('/').split('/')]
+        try:
+            if parts == ['tags']:
+                if method != 'GET':
+                    return 405, {'error': 'use GET'}
+                return 200, {
+                    'tags': [{
+                        'tag': tag,
+                        'dives': state.dives,
+                        'pending_samples': len(state.time)
+                    } for tag, state in self.tags.items()]
+                }
+            if len(parts) == 3 and parts[0] == 'tags' and \
+                    parts[2] in ['samples', 'flush']:
+                if method != 'POST':
+                    return 405, {'error': 'use POST'}
+                if parts[2] == 'flush':
+                    if parts[1] not in self.tags:
+                        return 404, {'error': 'unknown tag %s' % parts[1]}
+                    return 200, {'dives': await self.flush(parts[1])}
+                samples = json.loads(body or b'{}')
+                return 200, {
+                    'dives': await self.ingest(parts[1], samples['time'],
+                                               samples['depth'])
+                }
+        except KeyError as e:
+            return 400, {'error': 'missing %s' % e}
+        except (TypeError, ValueError) as e:
+            return 400, {'error': str(e)}
+        return 404, {'error': 'unknown path %s' % path}
+
+    async def start(self, host='127.0.0.1', port=8080):
+        """
+        :param host: the address to listen on, only this machine by default
+        :param port: the port to listen on
+
+        :return: the ``asyncio`` server
+        """
+        return await asyncio.start_server(self.handle, host, port)
+
+    def serve(self, host='127.0.0.1', port=8080):
+        """
+        Runs the service until it is interrupted.
+
+        :param host: the address to listen on, only this machine by default
+        :param port: the port to listen on
+        """
+
+        async def serve_forever():
+            server = await self.start(host, port)
+            async with server:
+                await server.serve_forever()
+
+        try:
+            asyncio.run(serve_forever())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._executor.shutdown()
+
+
+def get_records(dives):
+    """
+    :param dives: a Pandas DataFrame of dive profiles
+
+    :return: a list of a dictionary per dive with JSON serializable values,
+        missing values are ``None``
+    """
+    dives = dives.astype(object).where(dives.notna(), None)
+    return [{
+        key: value.item() if isinstance(value, np.generic) else value
+        for key, value in record.items()
+    } for record in dives.to_dict(orient='records')]
@@ -0,0 +1,300 @@
+import hashlib
+import json
+import os
+
+import pandas as pd
+
+from divebomb import (cluster_dives, export_to_netcdf, get_dive_starting_points,
+                      prepare_dive_data, profile_starts,
+                      split_insufficient_dives)
+from divebomb.preprocessing import correct_depth_offset
+
+pipeline_key_filename = 'pipeline_key.txt'
+
+# The parameters each stage depends on, a stage is run again when one of
+# them or a stage before it changes
+stage_params = {
+    'correct': ('correct', 'correction_window', 'correction_method'),
+    'detect': ('is_surfacing_animal', 'dive_detection_sensitivity',
+               'minimal_time_between_dives', 'surface_threshold',
+               'depth_range', 'sampling_interval'),
+    'profile': ('at_depth_threshold', 'features'),
+    'cluster': ('pca_components', 'n_clusters', 'attributes'),
+    'export': ('folder', 'encoding')
+}
+
+default_params = {
+    'correct': False,
+    'correction_window': 3600,
+    'correction_method': 'max',
+    'is_surfacing_animal': True,
+    'dive_detection_sensitivity': None,
+    'minimal_time_between_dives': 120,
+    'surface_threshold': 0,
+    'depth_range': None,
+    'sampling_interval': None,
+    'at_depth_threshold': 0.15,
+    'features': None,
+    'pca_components': 8,
+    'n_clusters': None,
+    'attributes': None,
+    'folder': None,
+    'encoding': 'default'
+}
+
+
+class Pipeline:
+    """
+    Runs the stages of ``profile_cluster_export()``, the depth correction,
+    the dive detection, the profiling, the clustering, and the export, and
+    caches the output of each stage. The output of a stage is keyed by the
+    data, the parameters of the stage, and the key of the stage before it,
+    so changing a parameter only runs that stage and the stages after it
+    again. The outputs are kept in memory and, with a ``cache_folder``,
+    pickled to disk so they are reused between sessions.
+
+    :ivar params: a dictionary of the parameters of the stages
+    :ivar cache_folder: the folder the outputs are pickled to, ``None`` only
+        keeps them in memory
+    :ivar executed: the stages that were run, not read from the cache, by
+        the last call
+    """
+
+    stages = ('correct', 'detect', 'profile', 'cluster', 'export')
+
+    def __init__(self,
+                 data,
+                 columns={
+                     'depth': 'depth',
+                     'time': 'time'
+                 },
+                 cache_folder=None,
+                 **params):
+        """
+        :param data: a dataframe needing a time and a depth column
+        :param columns: column renaming dictionary if needed
+        :param cache_folder: a folder to pickle the outputs of the stages to
+        :param params: the parameters of the stages, see ``set_params()``
+        """
+        self.data = data[[columns['time'], columns['depth']]].rename(
+            columns={
+                columns['time']: 'time',
+                columns['depth']: 'depth'
+            })
+        self.cache_folder = cache_folder
+        self.params = dict(default_params)
+        self.executed = []
+        self._outputs = {}
+        self._prepared = {}
+        self._data_key = '%016x' % int(
+            pd.util.hash_pandas_object(self.data, index=False).sum())
+        self.set_params(**params)
+
+    def set_params(self, **params):
+        """
+        Changes the parameters of the stages, the stages that depend on them
+        are run again by the next call.
+
+        :param correct: whether to correct the depth offset first, see
+            ``preprocessing.correct_depth_offset()``
+        :param correction_window: the ``window`` of the depth correction
+        :param correction_method: the ``method`` of the depth correction
+        :param params: the other arguments of ``get_dive_starting_points()``,
+            ``profile_dives()``, ``cluster_dives()``, and
+            ``export_to_netcdf()``: ``is_surfacing_animal``,
+            ``dive_detection_sensitivity``, ``minimal_time_between_dives``,
+            ``surface_threshold``, ``depth_range``, ``sampling_interval``,
+            ``at_depth_threshold``, ``features``, ``pca_components``,
+            ``n_clusters``, ``attributes``, ``folder``, and ``encoding``
+        """
+        unknown = [name for name in params if name not in default_params]
+        if unknown:
+            raise ValueError('unknown pipeline parameters: %s' %
+                             ', '.join(unknown))
+        self.params.update(params)
+
+    def get_key(self, stage):
+        """
+        :param stage: the name of a stage
+
+        :return: the cache key of the output of the stage
+        """
+        key = self._data_key
+        for name in self.stages[:self.stages.index(stage) + 1]:
+            values = {param: self.params[param] for param in stage_params[name]}
+            key = hashlib.sha1(
+                json.dumps([name, key, values], sort_keys=True,
+                           default=str).encode()).hexdigest()[:16]
+        return key
+
+    def _get_filename(self, stage, key):
+        return os.path.join(self.cache_folder, '%s_%s.pkl' % (stage, key))
+
+    def _read_cache(self, stage, key):
+        """
+        :return: the cached output of the stage or ``None``
+        """
+        if (stage, key) in self._outputs:
+            return self._outputs[(stage, key)]
+        if self.cache_folder is not None:
+            filename = self._get_filename(stage, key)
+            if os.path.exists(filename):
+                output = pd.read_pickle(filename)
+                self._outputs[(stage, key)] = output
+                return output
+        return None
+
+    def _write_cache(self, stage, key, output):
+        """
+        Keeps the output in memory and pickles it to the cache folder. The
+        output of a stage replaces its previous outputs in memory.
+        """
+        for cached in [cached for cached in self._outputs
+                       if cached[0] == stage]:
+            del self._outputs[cached]
+        self._outputs[(stage, key)] = output
+        if self.cache_folder is not None:
+            os.makedirs(self.cache_folder, exist_ok=True)
+            filename = self._get_filename(stage, key)
+            # Written then renamed so an interrupted write is never read
+            pd.to_pickle(output, filename + '.tmp')
+            os.replace(filename + '.tmp', filename)
+
+    def get(self, stage):
+        """
+        Runs a stage, and the stages before it, unless their outputs are
+        cached.
+
+        :param stage: the name of a stage
+
+        :return: the output of the stage, the corrected data of ``correct``,
+            the dive starts of ``detect``, the dive profiles and insufficient
+            dives of ``profile``, the clustered dives, PCA loadings matrix,
+            and PCA output matrix of ``cluster``, and the export folder of
+            ``export``
+        """
+        if stage not in self.stages:
+            raise ValueError('stage must be one of %s' % ', '.join(
+                self.stages))
+        key = self.get_key(stage)
+        if stage == 'export':
+            return self._export(key)
+        if stage == 'correct' and not self.params['correct']:
+            return self.data
+
+        output = self._read_cache(stage, key)
+        if output is None:
+            output = getattr(self, '_' + stage)()
+            self._write_cache(stage, key, output)
+            self.executed.append(stage)
+        return output
+
+    def get_data(self):
+        """
+        :return: the data, corrected if ``correct`` is set, sorted by time,
+            see ``prepare_dive_data()``
+        """
+        key = self.get_key('correct')
+        if key not in self._prepared:
+            self._prepared = {key: prepare_dive_data(self.get('correct'))}
+        return self._prepared[key]
+
+    def run(self, stage='export'):
+        """
+        Runs the stages up to and including ``stage``, reusing the cached
+        outputs.
+
+        :param stage: the last stage to run, the export is skipped if no
+            ``folder`` is set
+
+        :return: the data, the dive profiles, the PCA loadings matrix, the
+            PCA output matrix, and the insufficient dives, like
+            ``profile_cluster_export()``, with ``None`` for the outputs of
+            the stages that were not run
+        """
+        self.executed = []
+        if stage == 'export' and self.params['folder'] is None:
+            stage = 'cluster'
+        self.get(stage)
+
+        data = self.get_data()
+        dives, loadings, pca_output_matrix, insufficient_dives = \
+            None, None, None, None
+        if self.stages.index(stage) >= self.stages.index('profile'):
+            dives, insufficient_dives = self.get('profile')
+        if self.stages.index(stage) >= self.stages.index('cluster'):
+            dives, loadings, pca_output_matrix = self.get('cluster')
+        return data, dives, loadings, pca_output_matrix, insufficient_dives
+
+    def clear(self):
+        """
+        Empties the memory cache, the cache folder is kept.
+        """
+        self._outputs = {}
+        self._prepared = {}
+
+    def _correct(self):
+        # The export overwrites its folder, so the auxillary file of the
+        # correction is kept with the cache
+        aux_file = 'corrected_depth_auxillary_data.nc'
+        if self.cache_folder is not None:
+            os.makedirs(self.cache_folder, exist_ok=True)
+            aux_file = os.path.join(self.cache_folder, aux_file)
+        return correct_depth_offset(self.data.copy(),
+                                    window=self.params['correction_window'],
+                                    method=self.params['correction_method'],
+                                    aux_file=aux_file)
+
+    def _detect(self):
+        return get_dive_starting_points(
+            self.get_data(),
+            is_surfacing_animal=self.params['is_surfacing_animal'],
+            dive_detection_sensitivity=self.params[
+                'dive_detection_sensitivity'],
+            minimal_time_between_dives=self.params[
+                'minimal_time_between_dives'],
+            surface_threshold=self.params['surface_threshold'],
+            depth_range=self.params['depth_range'],
+            sampling_interval=self.params['sampling_interval'])
+
+    def _profile(self):
+        dives = profile_starts(
+            self.get_data(),
+            self.get('detect'),
+            type='Dive' if self.params['is_surfacing_animal'] else 'DeepDive',
+            surface_threshold=self.params['surface_threshold'],
+            at_depth_threshold=self.params['at_depth_threshold'],
+            features=self.params['features'])
+        dives, insufficient_dives, sufficient = split_insufficient_dives(dives)
+        return dives, insufficient_dives
+
+    def _cluster(self):
+        dives, insufficient_dives = self.get('profile')
+        return cluster_dives(dives,
+                             pca_components=self.params['pca_components'],
+                             n_clusters=self.params['n_clusters'],
+                             attributes=self.params['attributes'])
+
+    def _export(self, key):
+        """
+        Exports the clustered dives unless the folder already holds the
+        export of the same key.
+        """
+        folder = self.params['folder']
+        if folder is None:
+            raise ValueError('the pipeline needs a folder to export to')
+        key_file = os.path.join(folder, pipeline_key_filename)
+        if os.path.exists(key_file):
+            with open(key_file) as f:
+                if f.read().strip() == key:
+                    return folder
+
+        dives, loadings, pca_output_matrix = self.get('cluster')
+        insufficient_dives = self.get('profile')[1]
+        export_to_netcdf(folder, self.get_data(), dives, loadings,
+                         pca_output_matrix, insufficient_dives,
+                         encoding=self.params['encoding'])
+        with open(key_file, 'w') as f:
+            f.write(key + '\n')
+        self.executed.append('export')
+        return folder
@@ -1,9 +1,11 @@
 import __future__
 
+import json
 import math
 import os
 import shutil
 import sys
+from concurrent.futures import ProcessPoolExecutor
 
 import ipywidgets as widgets
 import numpy as np
@@ -14,13 +16,27 @@ import plotly.offline as py
 import xarray as xr
 from ipywidgets import Layout, fixed, interact, interact_manual, interactive
 from netCDF4 import Dataset, date2num, num2date
-from sklearn.cluster import AgglomerativeClustering
-from sklearn.decomposition import PCA
+from scipy.signal import peak_prominences
+from sklearn.cluster import AgglomerativeClustering, MiniBatchKMeans
+from sklearn.decomposition import PCA, IncrementalPCA
 from sklearn.mixture import GaussianMixture
 from sklearn.preprocessing import StandardScaler
 
+try:
+    import dask
+except ImportError:
+    dask = None
+
+from divebomb import kernels
 from divebomb.DeepDive import DeepDive
 from divebomb.Dive import Dive
+from divebomb.DiveArchive import DiveArchive
+from divebomb.DiveBrowser import DiveBrowser
+from divebomb.DiveIndex import DiveIndex, index_filename
+from divebomb.preprocessing import (datetime_to_num, get_sampling_interval,
+                                    get_variable_encoding,
+                                    get_xarray_encoding, split_on_gaps,
+                                    time_in_seconds)
 
 __author__ = "Alex Nunes"
 __credits__ = ["Alex Nunes", "Fran Broell"]
@@ -83,7 +99,104 @@ def display_dive(index,
         print(dive_profile.to_dict())
 
 
-def cluster_dives(dives, pca_components=8, n_clusters=None, attributes=None):
+# The columns that are never used for clustering
+excluded_cluster_columns = [
+    'dive_start', 'dive_end', 'insufficient_data', 'surface_threshold',
+    'segment', 'dive_id', 'cluster'
+]
+
+
+def get_cluster_columns(columns, attributes=None):
+    """
+    :param columns: the columns of the dive profiles
+    :param attributes: A list of variable/columns to use, all the columns
+        that describe the dive are used if not provided
+
+    :return: the list of columns used for clustering, in the order of
+        ``columns``
+    """
+    return [
+        column for column in columns
+        if column not in excluded_cluster_columns and (
+            attributes is None or column in attributes)
+    ]
+
+
+def get_pca_loadings(pca, columns):
+    """
+    :param pca: a fitted ``PCA`` or ``IncrementalPCA``
+    :param columns: the names of the clustered columns
+
+    :return: the PCA loadings matrix with a ``component`` column and a
+        ``PC_<n>`` column per principal component
+    """
+    loadings = pd.DataFrame(pca.components_).T
+    loadings.columns = ['PC_' + str(column) for column in loadings.columns]
+    loadings.insert(0, 'component', list(columns))
+    return loadings
+
+
+def get_optimal_n_clusters(X):
+    """
+    Finds the optimal number of clusters using Gaussian Mixed Models and the
+    Bayesion Information Criterion.
+
+    :param X: the PCA output matrix
+
+    :return: the number of clusters
+    """
+    n_components = np.arange(1, 11)
+    models = [
+        GaussianMixture(n, covariance_type='full', random_state=0).fit(X)
+        for n in n_components
+    ]
+    bics = [m.bic(X) for m in models]
+    diffs = np.diff(bics).tolist()
+    return diffs.index(max(diffs[4:]))
+
+
+def get_pca_matrix(dives, pca_components=8, attributes=None, shapes=None):
+    """
+    Scales the clustered columns of the dives, and the dive shapes, and
+    reduces them with Principal Component Analysis, as done by
+    ``cluster_dives()``.
+
+    :param dives: a pandas DataFrame of dive attributes
+    :param pca_components: the number of components for dimensionality
+        reduction, reduced to the number of columns if there are fewer
+    :param attributes: A list of variable/columns to use during the process
+    :param shapes: an optional matrix of dive shapes with one row per dive
+
+    :return: the PCA output as a numpy array, the fitted ``PCA``, and the
+        names of the clustered columns
+    """
+    # Subset the data
+    dataset = dives[get_cluster_columns(dives.columns, attributes)].fillna(0)
+
+    cluster_columns = dataset.columns.tolist()
+    X = dataset.values
+    if shapes is not None:
+        shapes = np.asarray(shapes, dtype=np.float64)
+        X = np.hstack([X, np.nan_to_num(shapes)])
+        cluster_columns = cluster_columns + [
+            'shape_%d' % i for i in range(shapes.shape[1])
+        ]
+
+    # Scale all values
+    sc_X = StandardScaler()
+    X = sc_X.fit_transform(X)
+
+    # Apply principle component analysis
+    if pca_components > len(cluster_columns):
+        print("You can't have more PCA components than attributes, reducing pca_components to " +
+              str(len(cluster_columns)) + ".")
+        pca_components = len(cluster_columns)
+    pca = PCA(n_components=pca_components)
+    X = pca.fit_transform(X)
+    return X, pca, cluster_columns
+
+
+def cluster_dives(dives, pca_components=8, n_clusters=None, attributes=None, shapes=None):
     """
     This function takes advantage of sklearn and reduces the dimensionality
     with Principal Component Analysis, finds the optimal number of n_clusters
@@ -96,57 +209,33 @@ def cluster_dives(dives, pca_components=8, n_clusters=None, attributes=None):
     :param n_clusters: An override for the number of clusters to find when clustering
     :param attributes: A list of variable/columns to use during the process. This can
         be a subset of the columns in the data.
+    :param shapes: a matrix of dive shapes with one row per dive, usually from
+        ``profile_dives()`` with ``shape_points``, clustered alongside the
+        attributes as ``shape_0``, ``shape_1``, etc. Use an empty list of
+        ``attributes`` to cluster on the shapes only.
 
     :return: the clustered dives, the PCA loadings matrix,
              and the PCA output matrix
 
     """
-    # Subset the data
-
-    dataset = dives.fillna(0).copy(deep=True)
-
-    if 'dive_start' in dataset.columns:
-        dataset.drop('dive_start', axis=1, inplace=True)
-
-    if 'dive_end' in dataset.columns:
-        dataset.drop('dive_end', axis=1, inplace=True)
-
-    if 'insufficient_data' in dataset.columns:
-        dataset.drop('insufficient_data', axis=1, inplace=True)
-
-    if 'surface_threshold' in dataset.columns:
-        dataset.drop('surface_threshold', axis=1, inplace=True)
-    if attributes is not None:
-        for column in dataset.columns:
-            if column not in attributes:
-                dataset.drop(column, axis=1, inplace=True)
-
-    cluster_columns = dataset.columns.tolist()
-    print("Clustering on " + ', '.join(cluster_columns[:-1]) +
-          ' and ' + cluster_columns[-1])
+    attribute_columns = get_cluster_columns(dives.columns, attributes)
+    if shapes is not None:
+        shape_points = np.shape(shapes)[1]
+        if len(attribute_columns):
+            print("Clustering on " + ', '.join(attribute_columns) + ' and ' +
+                  str(shape_points) + ' dive shape points')
+        else:
+            print("Clustering on " + str(shape_points) + ' dive shape points')
+    else:
+        print("Clustering on " + ', '.join(attribute_columns[:-1]) +
+              ' and ' + attribute_columns[-1])
     try:
-        # Scale all values
-        X = dataset.values
-        sc_X = StandardScaler()
-        X = sc_X.fit_transform(X)
-
-        # Apply principle component analysis
-        if pca_components > len(dataset.columns):
-            print("You can't have more PCA components than attributes, reducing pca_components to " +
-                  str(len(dataset.columns)) + ".")
-            pca_components = len(dataset.columns)
-        pca = PCA(n_components=pca_components)
-        X = pca.fit_transform(X)
+        X, pca, cluster_columns = get_pca_matrix(
+            dives, pca_components=pca_components, attributes=attributes,
+            shapes=shapes)
 
         # Get the loadings matrix
-        loadings = pd.DataFrame(pca.components_).T
-        loadings.reset_index(inplace=True)
-        column_heading = ['component']
-        for column in loadings.columns:
-            if column != 'index':
-                column_heading.append('PC_' + str(column))
-        loadings.columns = column_heading
-        loadings['component'] = dataset.columns
+        loadings = get_pca_loadings(pca, cluster_columns)
 
         # Get the PCA output matrix
         pca_output_matrix = pd.DataFrame(X)
@@ -157,31 +246,400 @@ def cluster_dives(dives, pca_components=8, n_clusters=None, attributes=None):
         pca_output_matrix.columns = column_heading
 
         if n_clusters is None:
-                # Find the optimal number of clusters
-            n_components = np.arange(1, 11)
-            models = [
-                GaussianMixture(n, covariance_type='full',
-                                random_state=0).fit(X)
-                for n in n_components
-            ]
-            bics = y = [m.bic(X) for m in models]
-            diffs = np.diff(bics).tolist()
-            n_clusters = (diffs.index(max(diffs[4:])))
+            n_clusters = get_optimal_n_clusters(X)
 
         # Apply Agglomerative clustering
         hc = AgglomerativeClustering(
             n_clusters=n_clusters, affinity='euclidean', linkage='ward')
         y_hc = hc.fit_predict(X)
-        dataset['cluster'] = y_hc
 
-        clustered_dives = dives.join(dataset[['cluster']])
+        clustered_dives = dives.join(
+            pd.DataFrame({'cluster': y_hc}, index=dives.index))
         return clustered_dives, loadings, pca_output_matrix
     except ValueError as e:
-        if len(X) < 10:
+        if len(dives) < 10:
             sys.exit("It is possible not enough dives were extracted to apply clustering. Try lowering the `dive_detection_sensitivity` value: https://divebomb.readthedocs.io/en/latest/divebomb.html#dive-detection")
 
 
-def export_dives(dives, data, folder, is_surface_events=False):
+def _fit_stability_replicates(X, labels, n_clusters, seeds, sample_fraction,
+                              replace):
+    """
+    Clusters resampled dives and compares them to the reference clusters,
+    used by ``cluster_stability()`` so it can be sent to a worker process.
+
+    :param X: the PCA output matrix of all the dives
+    :param labels: the reference cluster of each dive, numbered from 0
+    :param n_clusters: the number of clusters of each replicate
+    :param seeds: a list of the ``SeedSequence`` of each replicate
+    :param sample_fraction: the fraction of the dives drawn per replicate
+    :param replace: whether the dives are drawn with replacement, the
+        repeated dives are clustered with their copies
+
+    :return: for each dive, the number of reference peers clustered with it
+        and the number of reference peers drawn with it, and for each
+        reference cluster, the sum of its best Jaccard similarities, the
+        number of replicates it was dissolved in, and the number of
+        replicates it was drawn in
+    """
+    n = len(X)
+    n_reference = labels.max() + 1
+    co_assigned = np.zeros(n)
+    peers = np.zeros(n)
+    jaccard = np.zeros(n_reference)
+    dissolved = np.zeros(n_reference)
+    drawn = np.zeros(n_reference)
+    for seed in seeds:
+        random = np.random.default_rng(seed)
+        draw = np.sort(
+            random.choice(n, int(round(sample_fraction * n)),
+                          replace=replace))
+        replicate = AgglomerativeClustering(
+            n_clusters=n_clusters, linkage='ward').fit_predict(X[draw])
+        # A dive drawn more than once is clustered with all its copies but
+        # compared once, with the cluster of its first copy
+        sample, first = np.unique(draw, return_index=True)
+        replicate = replicate[first]
+
+        # The contingency table of the reference and replicate clusters
+        table = np.zeros((n_reference, n_clusters))
+        np.add.at(table, (labels[sample], replicate), 1)
+        reference_sizes = table.sum(axis=1)
+        replicate_sizes = table.sum(axis=0)
+
+        co_assigned[sample] += table[labels[sample], replicate] - 1
+        peers[sample] += reference_sizes[labels[sample]] - 1
+
+        union = reference_sizes[:, None] + replicate_sizes[None, :] - table
+        similarity = np.divide(table, union, out=np.zeros_like(table),
+                               where=union > 0).max(axis=1)
+        in_sample = reference_sizes > 0
+        jaccard[in_sample] += similarity[in_sample]
+        dissolved[in_sample] += similarity[in_sample] < 0.5
+        drawn[in_sample] += 1
+    return co_assigned, peers, jaccard, dissolved, drawn
+
+
+def cluster_stability(dives,
+                      n_replicates=100,
+                      pca_components=8,
+                      n_clusters=None,
+                      attributes=None,
+                      shapes=None,
+                      sample_fraction=0.8,
+                      replace=False,
+                      n_jobs=None,
+                      random_state=0):
+    """
+    Measures how stable the clusters of ``cluster_dives()`` are by clustering
+    resampled dives again and again. The dives are scaled and reduced with
+    PCA once, and each replicate runs the Agglomerative clustering on the
+    drawn rows of that matrix in a pool of processes.
+
+    Each dive is scored by how often it is clustered with the dives of its
+    own cluster when both are drawn, and each cluster by the mean Jaccard
+    similarity with its best matching replicate cluster. Clusters scoring
+    below 0.5 are usually dissolved by resampling and not to be trusted.
+    Ward clustering needs memory quadratic in the number of drawn dives, so
+    a smaller ``sample_fraction`` keeps large tables fast.
+
+    :param dives: a pandas DataFrame of dive attributes, with a ``cluster``
+        column to assess, otherwise the dives are clustered first
+    :param n_replicates: the number of resampled clusterings
+    :param pca_components: the number of components for dimensionality
+        reduction
+    :param n_clusters: the number of clusters of each replicate, defaults to
+        the number of clusters of the dives
+    :param attributes: A list of variable/columns to use during the process
+    :param shapes: an optional matrix of dive shapes with one row per dive,
+        see ``cluster_dives()``
+    :param sample_fraction: the fraction of the dives drawn per replicate
+    :param replace: whether the dives are drawn with replacement, as in a
+        bootstrap, instead of subsampled. The repeated draws are kept in the
+        replicate clustering and each drawn dive is counted once when the
+        clusters are compared. ``sample_fraction=1`` is the usual bootstrap.
+    :param n_jobs: the number of processes to use, ``None`` uses every CPU
+        and ``1`` runs the replicates in this process
+    :param random_state: the seed of the resampling, the results do not
+        depend on ``n_jobs``
+
+    :return: the dives with a ``co_assignment`` column of the fraction of
+        times each dive was clustered with its cluster, and a dataframe of the
+        ``cluster``, ``dives``, ``stability``, and ``dissolved`` (the
+        fraction of replicates with a Jaccard similarity below 0.5) of each
+        cluster
+    """
+    if 'cluster' not in dives.columns:
+        dives, loadings, pca_output_matrix = cluster_dives(
+            dives, pca_components=pca_components, n_clusters=n_clusters,
+            attributes=attributes, shapes=shapes)
+    X, pca, cluster_columns = get_pca_matrix(
+        dives, pca_components=pca_components, attributes=attributes,
+        shapes=shapes)
+
+    clusters, labels = np.unique(dives.cluster.values, return_inverse=True)
+    if n_clusters is None:
+        n_clusters = len(clusters)
+
+    # Each replicate has its own seed so the results do not depend on how
+    # the replicates are split between the processes
+    seeds = np.random.SeedSequence(random_state).spawn(n_replicates)
+    if n_jobs == 1:
+        results = [
+            _fit_stability_replicates(X, labels, n_clusters, seeds,
+                                      sample_fraction, replace)
+        ]
+    else:
+        # A few batches per process so the matrix is sent once per batch
+        n_batches = min(n_replicates, 4 * (n_jobs or os.cpu_count() or 1))
+        batches = [seeds[batch::n_batches] for batch in range(n_batches)]
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(
+                executor.map(_fit_stability_replicates,
+                             [X] * n_batches, [labels] * n_batches,
+                             [n_clusters] * n_batches, batches,
+                             [sample_fraction] * n_batches,
+                             [replace] * n_batches))
+    co_assigned, peers, jaccard, dissolved, drawn = [
+        np.sum(totals, axis=0) for totals in zip(*results)
+    ]
+
+    dives = dives.copy()
+    dives['co_assignment'] = np.divide(co_assigned, peers,
+                                       out=np.full(len(dives), np.nan),
+                                       where=peers > 0)
+    stability = np.divide(jaccard, drawn, out=np.full(len(clusters), np.nan),
+                          where=drawn > 0)
+    cluster_stability = pd.DataFrame({
+        'cluster': clusters,
+        'dives': np.bincount(labels, minlength=len(clusters)),
+        'stability': stability,
+        'dissolved': np.divide(dissolved, drawn,
+                               out=np.full(len(clusters), np.nan),
+                               where=drawn > 0)
+    })
+    return dives, cluster_stability
+
+
+def iter_dive_batches(dives, batch_size=10000):
+    """
+    Reads dive profiles in batches.
+
+    :param dives: a Pandas DataFrame, the path to a CSV or Parquet file, the
+        path to a folder of CSV or Parquet files (such as a partitioned Parquet
+        dataset or one table per animal), a list of any of these, or a
+        function returning an iterable of DataFrames
+    :param batch_size: the number of rows in a batch read from a DataFrame
+        or a CSV file
+
+    :return: a generator of Pandas DataFrames
+    """
+    if callable(dives):
+        for batch in dives():
+            yield batch
+    elif isinstance(dives, pd.DataFrame):
+        for start in range(0, len(dives), batch_size):
+            yield dives.iloc[start:start + batch_size]
+    elif isinstance(dives, str) and os.path.isdir(dives):
+        for root, folders, files in sorted(os.walk(dives)):
+            folders.sort()
+            for filename in sorted(files):
+                if filename.endswith(('.csv', '.parquet')):
+                    for batch in iter_dive_batches(
+                            os.path.join(root, filename), batch_size):
+                        yield batch
+    elif isinstance(dives, str) and dives.endswith('.parquet'):
+        for batch in iter_dive_batches(pd.read_parquet(dives), batch_size):
+            yield batch
+    elif isinstance(dives, str):
+        for batch in pd.read_csv(dives, chunksize=batch_size):
+            yield batch
+    else:
+        for source in dives:
+            for batch in iter_dive_batches(source, batch_size):
+                yield batch
+
+
+def _iter_feature_batches(dives, columns, batch_size, min_rows):
+    """
+    :return: a generator of the feature matrices of the dives in batches of
+        ``batch_size`` rows, the last batch has at least ``min_rows`` rows
+        unless there are fewer dives
+    """
+    size = max(batch_size, min_rows)
+    buffer = np.empty((0, len(columns)))
+    for batch in iter_dive_batches(dives, batch_size):
+        buffer = np.vstack([
+            buffer,
+            batch.reindex(columns=columns).fillna(0).values.astype(np.float64)
+        ])
+        while len(buffer) >= size + min_rows:
+            yield buffer[:size]
+            buffer = buffer[size:]
+    if len(buffer):
+        yield buffer
+
+
+def fit_incremental_clusters(dives,
+                             pca_components=8,
+                             n_clusters=None,
+                             attributes=None,
+                             batch_size=10000,
+                             sample_size=10000,
+                             random_state=0):
+    """
+    Fits the scaling, the Principal Component Analysis, and the clusters from
+    batches of dives, so the full feature matrix is never in memory. The
+    scaling is fitted with ``StandardScaler.partial_fit``, the PCA with
+    ``IncrementalPCA``, and the clusters with ``MiniBatchKMeans``, each in
+    one pass over the batches.
+
+    :param dives: the dive profiles, see ``iter_dive_batches()``. A generator
+        can only be read once, pass a function returning the generator instead.
+    :param pca_components: the number of components for dimensionality
+        reduction
+    :param n_clusters: the number of clusters, if not provided it is chosen
+        with the Bayesion Information Criterion from a random sample of
+        ``sample_size`` dives
+    :param attributes: A list of variable/columns to use during the process
+    :param batch_size: the number of dives read at a time
+    :param sample_size: the number of dives used to choose ``n_clusters``
+    :param random_state: the seed of the sampling and of the clustering
+
+    :return: a dictionary of the ``columns``, ``scaler``, ``pca``, and
+        ``kmeans`` models, and the PCA loadings matrix
+    """
+    columns = None
+    for batch in iter_dive_batches(dives, batch_size):
+        columns = get_cluster_columns(batch.columns, attributes)
+        break
+    if not columns:
+        raise ValueError('there are no dives or attributes to cluster')
+
+    if pca_components > len(columns):
+        print("You can't have more PCA components than attributes, reducing pca_components to " +
+              str(len(columns)) + ".")
+        pca_components = len(columns)
+    print("Clustering on " + ', '.join(columns[:-1]) + ' and ' + columns[-1])
+
+    # Fit the scaling and keep a random sample of the dives
+    random = np.random.RandomState(random_state)
+    scaler = StandardScaler()
+    sample = np.empty((0, len(columns)))
+    sample_keys = np.empty(0)
+    for X in _iter_feature_batches(dives, columns, batch_size, 1):
+        scaler.partial_fit(X)
+        if n_clusters is None:
+            sample = np.vstack([sample, X])
+            sample_keys = np.append(sample_keys, random.random_sample(len(X)))
+            if len(sample) > sample_size:
+                kept = np.argpartition(sample_keys, sample_size)[:sample_size]
+                sample = sample[kept]
+                sample_keys = sample_keys[kept]
+
+    pca = IncrementalPCA(n_components=pca_components)
+    for X in _iter_feature_batches(dives, columns, batch_size,
+                                   pca_components):
+        pca.partial_fit(scaler.transform(X))
+
+    if n_clusters is None:
+        n_clusters = get_optimal_n_clusters(
+            pca.transform(scaler.transform(sample)))
+
+    kmeans = MiniBatchKMeans(n_clusters=n_clusters,
+                             random_state=random_state,
+                             n_init=3)
+    for X in _iter_feature_batches(dives, columns, batch_size,
+                                   3 * n_clusters):
+        kmeans.partial_fit(pca.transform(scaler.transform(X)))
+
+    model = {
+        'columns': columns,
+        'scaler': scaler,
+        'pca': pca,
+        'kmeans': kmeans
+    }
+    return model, get_pca_loadings(pca, columns)
+
+
+def assign_incremental_clusters(dives, model, batch_size=10000):
+    """
+    Assigns the clusters of a model from ``fit_incremental_clusters()`` batch
+    by batch.
+
+    :param dives: the dive profiles, see ``iter_dive_batches()``
+    :param model: the models returned by ``fit_incremental_clusters()``
+    :param batch_size: the number of dives read at a time
+
+    :return: a generator of the clustered batches of dives and their PCA
+        output matrices
+    """
+    for batch in iter_dive_batches(dives, batch_size):
+        X = batch.reindex(columns=model['columns']).fillna(0).values.astype(
+            np.float64)
+        X = model['pca'].transform(model['scaler'].transform(X))
+        batch = batch.assign(cluster=model['kmeans'].predict(X))
+        pca_output_matrix = pd.DataFrame(
+            X, columns=['PC_' + str(i) for i in range(X.shape[1])])
+        yield batch, pca_output_matrix
+
+
+def cluster_dives_incremental(dives,
+                              pca_components=8,
+                              n_clusters=None,
+                              attributes=None,
+                              batch_size=10000,
+                              sample_size=10000,
+                              output_file=None,
+                              random_state=0):
+    """
+    Clusters dive profiles that are read in batches, see
+    ``fit_incremental_clusters()``. Unlike ``cluster_dives()`` the clusters
+    are found with mini batch k-means instead of agglomerative clustering.
+
+    :param dives: the dive profiles, see ``iter_dive_batches()``
+    :param pca_components: the number of components for dimensionality
+        reduction
+    :param n_clusters: the number of clusters, chosen from a sample of the
+        dives if not provided
+    :param attributes: A list of variable/columns to use during the process
+    :param batch_size: the number of dives read at a time
+    :param sample_size: the number of dives used to choose ``n_clusters``
+    :param output_file: a CSV file the clustered dives are written to batch by
+        batch instead of being returned
+    :param random_state: the seed of the sampling and of the clustering
+
+    :return: the clustered dives, the PCA loadings matrix, and the PCA output
+        matrix, or the ``output_file`` and the PCA loadings matrix if the
+        dives were written to it
+    """
+    model, loadings = fit_incremental_clusters(dives,
+                                               pca_components=pca_components,
+                                               n_clusters=n_clusters,
+                                               attributes=attributes,
+                                               batch_size=batch_size,
+                                               sample_size=sample_size,
+                                               random_state=random_state)
+    batches = assign_incremental_clusters(dives, model, batch_size=batch_size)
+
+    if output_file is not None:
+        if os.path.exists(output_file):
+            os.remove(output_file)
+        for batch, pca_output_matrix in batches:
+            batch.to_csv(output_file, mode='a', index=False,
+                         header=not os.path.exists(output_file))
+        return output_file, loadings
+
+    clustered_dives = []
+    pca_output_matrices = []
+    for batch, pca_output_matrix in batches:
+        clustered_dives.append(batch)
+        pca_output_matrices.append(pca_output_matrix)
+    return (pd.concat(clustered_dives, ignore_index=True), loadings,
+            pd.concat(pca_output_matrices, ignore_index=True))
+
+
+def export_dives(dives, data, folder, is_surface_events=False,
+                 encoding='default'):
     """
     This function exports each dive to its own netCDF file grouped by cluster
 
@@ -191,122 +649,427 @@ def export_dives(dives, data, folder, is_surface_events=False):
         folders
     :param is_surface_events: a boolean indicating if the dive profiles are
         entirely surface events
+    :param encoding: the netCDF encoding preset or dictionary, see
+        ``preprocessing.get_encoding_policy()``
 
+    The dives are numbered by their ``dive_id`` column if there is one,
+    otherwise by their position in the index.
     """
     for index, dive in dives.iterrows():
+        dive_id = int(dive.dive_id) if 'dive_id' in dive else index + 1
         filename = '%s/cluster_%d/dive_%05d.nc' % (folder, dive.cluster,
-                                                   (index + 1))
+                                                   dive_id)
         rootgrp = Dataset(filename, 'w')
-        rootgrp.setncattr('dive_id', index + 1)
+        rootgrp.setncattr('dive_id', dive_id)
         rootgrp.setncattr('is_surface_event', int(is_surface_events))
         rootgrp.setncattr('time_units', units)
         for key, value in dive.to_dict().items():
             try:
-                if value.is_integer():
+                if isinstance(value, (int, np.integer)) or \
+                        value.is_integer():
                     rootgrp.setncattr(key, int(value))
                 else:
                     rootgrp.setncattr(key, value)
             except TypeError:
                 rootgrp.setncattr(key, str(value))
-        rootgrp.createDimension('time', None)
-
-        time = rootgrp.createVariable("time", "f8", ("time", ), zlib=True)
+        dive_data = data[rootgrp.dive_start:rootgrp.dive_end]
+        rootgrp.createDimension('time', len(dive_data))
+        # A dimension of length 0 is unlimited
+        variable_encoding = get_variable_encoding(
+            len(dive_data), encoding=encoding, unlimited=not len(dive_data))
+
+        time = rootgrp.createVariable("time", "f8", ("time", ),
+                                      **variable_encoding)
         time.units = units
-        depth = rootgrp.createVariable("depth", "f8", ("time", ), zlib=True)
+        depth = rootgrp.createVariable("depth", "f8", ("time", ),
+                                       **variable_encoding)
 
-        time[:] = data[rootgrp.dive_start:rootgrp.dive_end].time.tolist()
-        depth[:] = data[rootgrp.dive_start:rootgrp.dive_end].depth.tolist()
+        time[:] = dive_data.time.values
+        depth[:] = dive_data.depth.values
 
         rootgrp.close()
 
 
-def export_to_csv(folder, dives, loadings, pca_output_matrix, insufficient_dives=None):
+manifest_filename = 'export_manifest.csv'
+checkpoint_filename = 'checkpoint.json'
+manifest_columns = ['dive_id', 'dive_start', 'dive_end', 'cluster',
+                    'fingerprint']
+
+
+def read_export_manifest(folder):
+    """
+    Reads the manifest of the dives already exported to a folder. Folders
+    exported before manifests were written are read from their summary file.
+
+    :param folder: the path of the export folder
+
+    :return: a Pandas DataFrame with the ``dive_id``, ``dive_start``,
+        ``dive_end``, ``cluster``, and ``fingerprint`` of each exported dive
+    """
+    filename = os.path.join(folder, manifest_filename)
+    if os.path.exists(filename):
+        manifest = pd.read_csv(filename, dtype={'fingerprint': str})
+        manifest['fingerprint'] = manifest.fingerprint.fillna('')
+        return manifest
+
+    summary = read_export_summary(folder)
+    if summary is None:
+        return pd.DataFrame(columns=manifest_columns)
+    manifest = summary.reindex(columns=manifest_columns)
+    manifest['fingerprint'] = ''
+    return manifest
+
+
+def read_export_summary(folder, filename='all_profiled_dives'):
+    """
+    :param folder: the path of the export folder
+    :param filename: the name of the summary file without the extension
+
+    :return: a Pandas DataFrame of the summary, with a ``dive_id`` column for
+        the profiled dives, or ``None`` if the folder has no summary
+    """
+    path = os.path.join(folder, filename)
+    if os.path.exists(path + '.csv'):
+        summary = pd.read_csv(path + '.csv')
+    elif os.path.exists(path + '.nc'):
+        with xr.open_dataset(path + '.nc', decode_times=False) as dataset:
+            summary = dataset.load().to_dataframe().reset_index(drop=True)
+    else:
+        return None
+
+    if filename == 'all_profiled_dives' and 'dive_id' not in summary:
+        summary['dive_id'] = summary.index + 1
+    return summary
+
+
+def get_dive_fingerprints(dives):
+    """
+    :param dives: a Pandas DataFrame of dive profiles
+
+    :return: an array of hashes of the profile of each dive, used to find the
+        dives that changed since they were exported
+    """
+    profiles = dives.drop(columns=['dive_id', 'cluster'], errors='ignore')
+    hashes = pd.util.hash_pandas_object(profiles[sorted(profiles.columns)],
+                                        index=False)
+    return np.array(['%016x' % value for value in hashes.values])
+
+
+def get_export_manifest(dives, fingerprints=None):
+    """
+    :param dives: a Pandas DataFrame of the dive profiles and clusters with a
+        ``dive_id`` column
+    :param fingerprints: the fingerprints of the dives, calculated with
+        ``get_dive_fingerprints()`` if not provided
+
+    :return: the manifest rows of the dives
+    """
+    if fingerprints is None:
+        fingerprints = get_dive_fingerprints(dives)
+    return pd.DataFrame({
+        'dive_id': dives.dive_id.values,
+        'dive_start': dives.dive_start.values,
+        'dive_end': dives.dive_end.values,
+        'cluster': dives.cluster.values,
+        'fingerprint': fingerprints
+    })
+
+
+def get_export_changes(dives, manifest):
+    """
+    Gives each dive the ``dive_id`` it was exported with before, matched on
+    its ``dive_start``, and numbers new dives after the largest exported id.
+    When the manifest repeats a ``dive_start`` the last of its dives is
+    matched.
+
+    :param dives: a Pandas DataFrame of the dive profiles and clusters
+    :param manifest: the manifest of the exported dives, see
+        ``read_export_manifest()``
+
+    :return: the dives with a ``dive_id`` column, a boolean array of the dives
+        that are new or changed, the updated manifest, and a list of the
+        previous ``(cluster, dive_id)`` of the dives that moved to another
+        cluster
+    """
+    dives = dives.copy()
+    # Older summaries, or starts truncated to the same second, can repeat a
+    # dive_start, the last exported dive is the one matched
+    previous = manifest.drop_duplicates('dive_start',
+                                        keep='last').set_index('dive_start')
+    ids = previous.dive_id.reindex(dives.dive_start.values).values.astype(
+        float)
+    new = np.isnan(ids)
+
+    next_id = manifest.dive_id.max() + 1 if len(manifest) else 1
+    new_ids = np.empty(new.sum())
+    new_ids[np.argsort(dives.dive_start.values[new], kind='stable')] = \
+        np.arange(next_id, next_id + new.sum())
+    ids[new] = new_ids
+    dives['dive_id'] = ids.astype(int)
+
+    fingerprints = get_dive_fingerprints(dives)
+    previous_clusters = previous.cluster.reindex(
+        dives.dive_start.values).values
+    changed = new | (previous.fingerprint.reindex(
+        dives.dive_start.values).values != fingerprints) | \
+        (previous_clusters != dives.cluster.values)
+
+    moved = (~new) & (previous_clusters != dives.cluster.values)
+    moved_dives = list(
+        zip(previous_clusters[moved].astype(int), dives.dive_id.values[moved]))
+
+    manifest = pd.concat(
+        [manifest, get_export_manifest(dives, fingerprints)],
+        ignore_index=True)
+    manifest = manifest.drop_duplicates('dive_id', keep='last')
+    manifest = manifest.sort_values('dive_id').reset_index(drop=True)
+    return dives, changed, manifest, moved_dives
+
+
+def merge_export_summary(folder, rows, key, filename):
+    """
+    :param folder: the path of the export folder
+    :param rows: a Pandas DataFrame of the new and updated rows
+    :param key: the column identifying a row
+    :param filename: the name of the summary file without the extension
+
+    :return: the existing summary with the rows added or replaced, sorted by
+        ``key``
+    """
+    summary = read_export_summary(folder, filename)
+    if summary is None:
+        return rows.sort_values(key).reset_index(drop=True)
+    summary = pd.concat([summary, rows], ignore_index=True)
+    summary = summary.drop_duplicates(key, keep='last')
+    return summary.sort_values(key).reset_index(drop=True)
+
+
+def read_export_pca_output(folder):
+    """
+    :param folder: the path of the export folder
+
+    :return: a Pandas DataFrame of the PCA output matrix of the exported dives
+        with a ``dive_id`` column, or ``None`` if the folder has none
+    """
+    csv_filename = os.path.join(folder, 'pca_output_matrix.csv')
+    nc_filename = os.path.join(folder, 'pca_matrices_data.nc')
+    if os.path.exists(csv_filename):
+        pca_output_matrix = pd.read_csv(csv_filename)
+    elif os.path.exists(nc_filename):
+        with Dataset(nc_filename) as pca_group:
+            pca_output = pca_group.groups['pca_output']
+            pca_output_matrix = pd.DataFrame({
+                name: np.ma.filled(variable[:].astype(np.float64), np.nan)
+                for name, variable in pca_output.variables.items()
+            })
+    else:
+        return None
+
+    # Exports written before the dive_id was kept have a row per dive of the
+    # summary, in the same order
+    if 'dive_id' not in pca_output_matrix:
+        summary = read_export_summary(folder)
+        if summary is None or len(summary) != len(pca_output_matrix):
+            raise ValueError('the PCA output matrix of %s does not line up '
+                             'with its dives, export them again with '
+                             'mode="w"' % folder)
+        pca_output_matrix.insert(0, 'dive_id', summary.dive_id.values)
+    pca_output_matrix['dive_id'] = pca_output_matrix.dive_id.astype(int)
+    return pca_output_matrix
+
+
+def get_export_pca_output(folder, dives, pca_output_matrix, mode='w'):
+    """
+    :param folder: the path of the export folder
+    :param dives: the exported dives with their ``dive_id``
+    :param pca_output_matrix: the PCA output matrix of the dives, one row per
+        dive in the same order
+    :param mode: ``a`` to merge the rows with the PCA output matrix already
+        exported to the folder, replacing the rows of the same ``dive_id``
+
+    :return: the PCA output matrix with a ``dive_id`` column, sorted by
+        ``dive_id`` like the summary of the dives
+    """
+    if len(pca_output_matrix) != len(dives):
+        raise ValueError('the PCA output matrix needs one row per dive, it '
+                         'has %d rows for %d dives' %
+                         (len(pca_output_matrix), len(dives)))
+    rows = pca_output_matrix.drop(columns='dive_id', errors='ignore')
+    rows.insert(0, 'dive_id', dives.dive_id.values.astype(int))
+    previous = read_export_pca_output(folder) if mode == 'a' else None
+    if previous is not None:
+        rows = pd.concat([previous, rows], ignore_index=True)
+        rows = rows.drop_duplicates('dive_id', keep='last')
+    return rows.sort_values('dive_id').reset_index(drop=True)
+
+
+def export_to_csv(folder, dives, loadings, pca_output_matrix, insufficient_dives=None, mode='w'):
     """
     Will output dive profiles, loadings, PCA Matrix, and inssufficent dive into
     the indicated folder as CSVs.
 
     :param folder: the path to export all files to, the folder will be
-        overwritten
+        overwritten unless ``mode`` is ``a``
     :param dives: a Pandas DataFrame of the dive profiles and clusters, usually
         generated from ``cluster_dives()``
     :param loadings: a Pandas DataFrame of the Principle Component Analysis
         loadings from ``cluster_dives()``
     :param pca_output_matrix: a Pandas DataFrame of the Principle Component
-        Analysis results from ``cluster_dives()``
+        Analysis results from ``cluster_dives()``, one row per dive. It is
+        exported with the ``dive_id`` of the dives.
     :param insufficent_dives: a Pandas DataFrame of dives that could not be
         profiled from ``cluster_dives()``
+    :param mode: ``w`` to overwrite the folder or ``a`` to add the dives to a
+        previous export, keeping the ``dive_id`` of the dives already exported
+        and replacing the rows of the dives that changed in the summary and
+        the PCA output
     """
     # Export the dives to CSV
-    if os.path.exists(folder):
-        shutil.rmtree(folder)
-    os.makedirs(folder)
-    dives['dive_id'] = dives.index + 1
+    if mode == 'a':
+        os.makedirs(folder, exist_ok=True)
+        dives, changed, manifest, moved_dives = get_export_changes(
+            dives, read_export_manifest(folder))
+        pca_output_matrix = get_export_pca_output(
+            folder, dives, pca_output_matrix, mode)
+        dives = merge_export_summary(folder, dives[changed], 'dive_id',
+                                     'all_profiled_dives')
+        if insufficient_dives is not None and not insufficient_dives.empty:
+            insufficient_dives = merge_export_summary(
+                folder, insufficient_dives, 'dive_start', 'insufficient_dives')
+            insufficient_dives = insufficient_dives[
+                ~insufficient_dives.dive_start.isin(dives.dive_start)]
+    else:
+        dives['dive_id'] = dives.index + 1
+        pca_output_matrix = get_export_pca_output(
+            folder, dives, pca_output_matrix)
+        if os.path.exists(folder):
+            shutil.rmtree(folder)
+        os.makedirs(folder)
+        manifest = get_export_manifest(dives)
+
     dives.to_csv(folder + '/all_profiled_dives.csv', index=False)
     loadings.to_csv(folder + '/pca_loadings.csv', index=False)
     pca_output_matrix.to_csv(folder + '/pca_output_matrix.csv', index=False)
     if insufficient_dives is not None and not insufficient_dives.empty:
         insufficient_dives.to_csv(
             folder + '/insufficient_dives.csv', index=False)
+    # The manifest is written last so an interrupted export is redone
+    manifest.to_csv(os.path.join(folder, manifest_filename), index=False)
     print(f"Files have been exported to {os.getcwd()}/{folder}")
 
 
-def export_to_netcdf(folder, data, dives, loadings, pca_output_matrix, insufficient_dives=None):
+def export_to_netcdf(folder, data, dives, loadings, pca_output_matrix, insufficient_dives=None, encoding='default', mode='w', shape_points=32):
     """
     Will output dive profiles, loadings, PCA Matrix, and inssufficent dive into
     the indicated folder as netCDF files. Additionally subfolders will be output
     by cluster with separate files for each dive.
 
     :param folder: the path to export all files to, the folder will be
-        overwritten
+        overwritten unless ``mode`` is ``a``
     :param dives: a Pandas DataFrame of the dive profiles and clusters, usually
         generated from ``cluster_dives()``
     :param loadings: a Pandas DataFrame of the Principle Component Analysis
         loadings from ``cluster_dives()``
     :param pca_output_matrix: a Pandas DataFrame of the Principle Component
-        Analysis results from ``cluster_dives()``
+        Analysis results from ``cluster_dives()``, one row per dive. It is
+        exported with the ``dive_id`` of the dives.
     :param insufficent_dives: a Pandas DataFrame of dives that could not be
         profiled from ``cluster_dives()``
+    :param encoding: the netCDF encoding preset or dictionary used for every
+        file, see ``preprocessing.get_encoding_policy()``
+    :param mode: ``w`` to overwrite the folder or ``a`` to add the dives to a
+        previous export. In ``a`` mode only the files of new dives and of
+        dives whose profile or cluster changed are written, the ``dive_id`` of
+        the dives already exported is kept, and the summaries and the PCA
+        output are updated.
+    :param shape_points: the number of points of the dive shapes in the
+        similarity index saved in the folder (see ``DiveIndex``), ``None``
+        does not build the index
     """
-    # Export the dives to netCDF
-    if os.path.exists(folder):
-        shutil.rmtree(folder)
-    os.makedirs(folder)
+    # The dives and the data given are not changed
+    dives = dives.assign(dive_start=dives.dive_start.astype(int),
+                         dive_end=dives.dive_end.astype(int))
 
-    for cluster in dives.cluster.unique():
-        os.makedirs(folder + '/cluster_' + str(cluster))
+    # Export the dives to netCDF
+    if mode == 'a':
+        os.makedirs(folder, exist_ok=True)
+        dives, changed, manifest, moved_dives = get_export_changes(
+            dives, read_export_manifest(folder))
+        pca_output_matrix = get_export_pca_output(
+            folder, dives, pca_output_matrix, mode)
+        for cluster, dive_id in moved_dives:
+            filename = '%s/cluster_%d/dive_%05d.nc' % (folder, cluster,
+                                                       dive_id)
+            if os.path.exists(filename):
+                os.remove(filename)
+    else:
+        dives['dive_id'] = dives.index + 1
+        pca_output_matrix = get_export_pca_output(
+            folder, dives, pca_output_matrix)
+        if os.path.exists(folder):
+            shutil.rmtree(folder)
+        os.makedirs(folder)
+        changed = np.ones(len(dives), dtype=bool)
+        manifest = get_export_manifest(dives)
+
+    for cluster in dives.cluster[changed].unique():
+        os.makedirs(folder + '/cluster_' + str(cluster), exist_ok=True)
 
     # export the dives
-    data.set_index('time', inplace=True, drop=False)
-
-    dives.dive_start = dives.dive_start.astype(int)
-    dives.dive_end = dives.dive_end.astype(int)
-
-    data.time = data.time.astype(int)
-    export_dives(dives, data, folder)
+    data = data.set_index('time', drop=False)
+    data['time'] = data.time.astype(int)
+    export_dives(dives[changed], data, folder, encoding=encoding)
+
+    # Index the shapes and features of the exported dives
+    if shape_points is not None:
+        dive_index = DiveIndex.from_dives(
+            dives[changed], get_export_shapes(data, dives[changed],
+                                              shape_points))
+        if mode == 'a' and os.path.exists(
+                os.path.join(folder, index_filename)):
+            previous_index = DiveIndex.load(folder)
+            previous_index.update(dive_index)
+            dive_index = previous_index
+        dive_index.save(folder)
 
     # Export the PCA Matrices
     pca_group = Dataset(folder + '/pca_matrices_data.nc', 'w')
     pca_loadings = pca_group.createGroup('pca_loadings')
     pca_output = pca_group.createGroup('pca_output')
 
-    pca_group.createDimension('order', None)
+    # The loadings and the output have a row per attribute and per dive, so
+    # each group has its own dimension
+    pca_loadings.createDimension('order', None)
+    pca_output.createDimension('order', None)
 
-    str_max = (loadings.component.str.len()).max()
-    components = pca_loadings.createVariable(
-        "component", str, ('order', ), zlib=True)
-    components = np.array(loadings.component.tolist(), 'S' + str(int(str_max)))
+    components = pca_loadings.createVariable("component", str, ('order', ))
+    components[:] = np.array(loadings.component.tolist(), dtype=object)
     pc = {}
     for column in loadings.iloc[:, 1:].columns:
         pc[column] = pca_loadings.createVariable(
-            column, 'f8', ('order', ), zlib=True)
+            column, 'f8', ('order', ),
+            **get_variable_encoding(len(loadings), encoding=encoding,
+                                    unlimited=True))
         pc[column][:] = loadings[column].tolist()
 
     for column in pca_output_matrix.columns:
         pc[column] = pca_output.createVariable(
-            column, 'f8', ('order', ), zlib=True)
-        pc[column][:] = loadings[column].tolist()
+            column, 'i4' if column == 'dive_id' else 'f8', ('order', ),
+            **get_variable_encoding(len(pca_output_matrix), encoding=encoding,
+                                    unlimited=True))
+        pc[column][:] = pca_output_matrix[column].values
     pca_group.close()
 
+    if mode == 'a':
+        dives = merge_export_summary(folder, dives[changed], 'dive_id',
+                                     'all_profiled_dives')
+        if insufficient_dives is not None:
+            insufficient_dives = merge_export_summary(
+                folder, insufficient_dives, 'dive_start',
+                'insufficent_data_dives')
+            insufficient_dives = insufficient_dives[
+                ~insufficient_dives.dive_start.isin(dives.dive_start)]
+
     # Write an overall summary netcdf
     xarray_data = xr.Dataset(dives)
     if 'bottom_start' in xarray_data.variables:
@@ -314,7 +1077,8 @@ def export_to_netcdf(folder, data, dives, loadings, pca_output_matrix, insuffici
     xarray_data.variables['dive_end'].attrs = {'units': units}
     xarray_data.variables['dive_start'].attrs = {'units': units}
     xarray_data.to_netcdf(
-        os.path.join(folder, "all_profiled_dives.nc"), mode='w')
+        os.path.join(folder, "all_profiled_dives.nc"), mode='w',
+        encoding=get_xarray_encoding(xarray_data, encoding))
     xarray_data.close()
 
     # Write an overall summary netcdf
@@ -325,8 +1089,12 @@ def export_to_netcdf(folder, data, dives, loadings, pca_output_matrix, insuffici
         xarray_data.variables['dive_end'].attrs = {'units': units}
         xarray_data.variables['dive_start'].attrs = {'units': units}
         xarray_data.to_netcdf(
-            os.path.join(folder, "insufficent_data_dives.nc"), mode='w')
+            os.path.join(folder, "insufficent_data_dives.nc"), mode='w',
+            encoding=get_xarray_encoding(xarray_data, encoding))
         xarray_data.close()
+
+    # The manifest is written last so an interrupted export is redone
+    manifest.to_csv(os.path.join(folder, manifest_filename), index=False)
     print(f"Files have been exported to {os.getcwd()}/{folder}")
 
 
@@ -344,12 +1112,59 @@ def clean_dive_data(data, columns={'depth': 'depth', 'time': 'time'}):
             data.drop(v, axis=1)
     # Convert time to seconds since
     if data[columns['time']].dtypes != np.float64:
-        data[columns['time']] = date2num(
-            pd.to_datetime(data[columns['time']]).tolist(), units=units)
+        data[columns['time']] = datetime_to_num(data[columns['time']],
+                                                units=units)
 
     return data
 
 
+def prepare_dive_data(data, columns={'depth': 'depth', 'time': 'time'}):
+    """
+    Validates the data and sorts it by time once, so the dive detection and
+    every dive profile can share it without copying it. The columns are
+    stored in one read-only float64 array and data that is already sorted is
+    not sorted again.
+
+    :param data: a Pandas DataFrame consisting of a time and a depth column
+    :param columns: column renaming dictionary if needed
+
+    :return: a Pandas DataFrame sorted by time with ``time`` in seconds since
+        1970-01-01, ``depth``, and the other numeric columns of the data as
+        float64
+    """
+    # Data that has already been prepared, or a slice of it, is used as it is
+    if list(data.columns[:2]) == ['time', 'depth'] and \
+            (data.dtypes == np.float64).all() and \
+            not data.values.flags.writeable and \
+            data.time.is_monotonic_increasing:
+        return data
+
+    time = data[columns['time']]
+    if time.dtypes != np.float64:
+        time = datetime_to_num(time, units=units)
+    names = ['time', 'depth'] + [
+        column for column in data.columns
+        if column not in ['time', 'depth'] + list(columns.values())
+        and pd.api.types.is_numeric_dtype(data[column])
+    ]
+
+    values = np.empty((len(names), len(data)))
+    values[0] = time
+    values[1] = data[columns['depth']]
+    for i, column in enumerate(names[2:], 2):
+        values[i] = data[column]
+    if np.isnan(values[0]).any():
+        raise ValueError('the time column has missing values')
+
+    # Only sort when the data is out of order
+    if not pd.Series(values[0], copy=False).is_monotonic_increasing:
+        values = values[:, np.argsort(values[0], kind='stable')]
+
+    # The dives are slices of this array, make sure none of them change it
+    values.flags.writeable = False
+    return pd.DataFrame(values.T, columns=names, copy=False)
+
+
 def get_dive_starting_points(data,
                              dive_detection_sensitivity,
                              is_surfacing_animal=True,
@@ -358,7 +1173,9 @@ def get_dive_starting_points(data,
                              columns={
                                  'depth': 'depth',
                                  'time': 'time'
-                             }):
+                             },
+                             depth_range=None,
+                             sampling_interval=None):
     """
     :param data: a dataframe needing a time and a depth column
     :param is_surfacing_animal: a boolean indicating whether it's an animal
@@ -370,25 +1187,68 @@ def get_dive_starting_points(data,
     :param surface_threshold: the threshold at which is considered surface for
         surfacing animals, default is 0
     :param columns: column renaming dictionary if needed
+    :param depth_range: the minimum and maximum depth the sensitivity is
+        relative to, defaults to the range of the data. Pass the range of the
+        whole record when the data is only part of it.
+    :param sampling_interval: the sampling interval in seconds, calculated
+        from the data if not provided
     """
 
-    # drop all columns in the dataframe that aren't time or depth
-    data = clean_dive_data(data, columns=columns)
-
-    data = data.sort_values(by=columns['time']).reset_index(drop=True)
-    data['time_diff'] = data.time.diff()
+    data = prepare_dive_data(data, columns=columns)
 
     if is_surfacing_animal and dive_detection_sensitivity is None:
         dive_detection_sensitivity = 0.98
     elif dive_detection_sensitivity is None:
         dive_detection_sensitivity = 0.5
 
-    starts = pku.indexes(
+    if sampling_interval is None:
+        sampling_interval = get_sampling_interval(data)
+    threshold = dive_detection_sensitivity
+    if depth_range is not None:
+        min_depth, max_depth = depth_range
+        threshold = dive_detection_sensitivity * (max_depth - min_depth) - \
+            max_depth
+    starts = kernels.peak_indexes(
         (data.depth * -1),
-        thres=dive_detection_sensitivity,
-        min_dist=(minimal_time_between_dives / data.time.diff().mean()))
-    starts = np.insert(starts, 0, 0)
+        thres=threshold,
+        min_dist=(minimal_time_between_dives / sampling_interval),
+        thres_abs=depth_range is not None)
+
+    return get_dive_blocks(data,
+                           starts,
+                           is_surfacing_animal=is_surfacing_animal,
+                           surface_threshold=surface_threshold,
+                           sampling_interval=sampling_interval)
+
+
+def get_dive_blocks(data,
+                    peaks,
+                    is_surfacing_animal=True,
+                    surface_threshold=0,
+                    sampling_interval=None):
+    """
+    Turns the detected peaks into the start and end blocks of each dive.
+
+    :param data: a cleaned dataframe sorted by time, the ``time_diff``
+        column is calculated if it is missing
+    :param peaks: the indices of the detected dive starts
+    :param is_surfacing_animal: a boolean indicating whether it's an animal
+        that is gaurantedd to surface between dives
+    :param surface_threshold: the threshold at which is considered surface for
+        surfacing animals, default is 0
+    :param sampling_interval: the sampling interval of the data in seconds,
+        calculated from the data if not provided
+
+    :return: a dataframe of the dive starts with the ``start_block`` and
+        ``end_block`` indices
+    """
+    if sampling_interval is None:
+        sampling_interval = get_sampling_interval(data)
+
+    starts = np.insert(peaks, 0, 0)
     starts = data[data.index.isin(starts)]
+    if 'time_diff' not in starts.columns:
+        starts['time_diff'] = data.time.diff()[starts.index]
 
     starts['start_block'] = starts.index
     starts['end_block'] = starts.start_block.shift(-1) + 1
@@ -396,9 +1256,11 @@ def get_dive_starting_points(data,
     starts.end_block = starts.end_block.astype(int)
 
     # This line specidifcally looks for larg time gaps in the data and ignores
-    # them using the index
-    starts.loc[starts.time_diff.shift(-1) > starts.time_diff.mode()[0],
-               'end_block'] = starts.end_block - 1
+    # them using the index, a single dive has no gaps to look at
+    time_diff_mode = starts.time_diff.mode()
+    if len(time_diff_mode):
+        starts.loc[starts.time_diff.shift(-1) > time_diff_mode[0],
+                   'end_block'] = starts.end_block - 1
 
     if is_surfacing_animal:
         starts['new_start'] = None
@@ -417,7 +1279,7 @@ def get_dive_starting_points(data,
                 elif not pre_dive_data.empty:
                     starts.loc[index, 'start_block'] = pre_dive_data.index[0]
 
-            if data.time.diff().mean() >= 10:
+            if sampling_interval >= 10:
                 starts.loc[index, 'new_start'] = sub_data[sub_data.depth >
                                                           surface_threshold].head(1).index.min() - 1
 
@@ -425,6 +1287,9 @@ def get_dive_starting_points(data,
 
         starts.loc[~starts.new_start.isnull(
         ), 'start_block'] = starts.new_start
+        # A record starting below the surface has no sample before its first
+        # dive, keep it at the first sample instead of dropping it
+        starts.start_block = starts.start_block.clip(lower=0)
 
         starts = data[data.index.isin(starts.start_block)]
 
@@ -434,12 +1299,180 @@ def get_dive_starting_points(data,
 
         starts.end_block.fillna(data.index.max(), inplace=True)
         starts.end_block = starts.end_block.astype(int)
-        starts.start_block = starts.start_block.clip(lower=0)
 
     starts.reset_index(drop=True, inplace=True)
     return starts
 
 
+def get_candidate_peaks(data, columns={'depth': 'depth', 'time': 'time'}):
+    """
+    Finds every candidate dive start once, with its height and prominence,
+    so that ``dive_detection_sensitivity`` and ``minimal_time_between_dives``
+    can be tuned by filtering the candidates instead of running the peak
+    detection again for every value.
+
+    :param data: a dataframe needing a time and a depth column
+    :param columns: column renaming dictionary if needed
+
+    :return: a dataframe of the candidate peaks with their ``index`` in the
+        data, ``time``, ``depth``, normalized ``height`` (the sensitivity
+        below which the peak is kept), and ``prominence`` in meters, and the
+        cleaned data sorted by time
+    """
+    data = prepare_dive_data(data, columns=columns)
+    data['time_diff'] = data.time.diff()
+
+    y = (data.depth * -1).values
+    peaks = pku.indexes(y, thres=0, min_dist=1)
+
+    candidates = pd.DataFrame()
+    candidates['index'] = peaks
+    candidates['time'] = data.time.values[peaks]
+    candidates['depth'] = data.depth.values[peaks]
+    candidates['height'] = (y[peaks] - y.min()) / (y.max() - y.min())
+    candidates['prominence'] = peak_prominences(y, peaks)[0]
+    return candidates, data
+
+
+def filter_candidate_peaks(data,
+                           candidates,
+                           dive_detection_sensitivity,
+                           minimal_time_between_dives=120):
+    """
+    Applies the same threshold and minimum distance rules as the peak
+    detection in ``get_dive_starting_points()`` to the candidate peaks.
+
+    :param data: the cleaned data returned by ``get_candidate_peaks()``
+    :param candidates: the candidate peaks returned by
+        ``get_candidate_peaks()``
+    :param dive_detection_sensitivity: a value bteween 0 and 1 indicating the
+        peak detection threshold, the lower the value the deeper the threshold
+    :param minimal_time_between_dives: the minimum time in seconds that needs
+        to occur before there can be a new dive segement
+
+    :return: an array of the indices of the dive starts in the data
+    """
+    y_min = -data.depth.max()
+    y_max = -data.depth.min()
+    min_dist = minimal_time_between_dives / get_sampling_interval(data)
+    return _filter_peaks(candidates['index'].values,
+                         candidates.depth.values * -1,
+                         dive_detection_sensitivity * (y_max - y_min) + y_min,
+                         int(min_dist))
+
+
+def _filter_peaks(peaks, heights, threshold, min_dist):
+    """
+    :param peaks: the sorted indices of the candidate peaks
+    :param heights: the values of the signal at the candidate peaks
+    :param threshold: the absolute threshold a peak has to be above
+    :param min_dist: the minimum distance in samples between two peaks
+
+    :return: the indices of the peaks that are kept, favouring the highest
+        peaks when two are closer than ``min_dist``
+    """
+    above = heights > threshold
+    return kernels.suppress_peaks(peaks[above], heights[above], min_dist)
+
+
+def get_dive_starts_from_candidates(data,
+                                    candidates,
+                                    dive_detection_sensitivity,
+                                    is_surfacing_animal=True,
+                                    minimal_time_between_dives=120,
+                                    surface_threshold=0):
+    """
+    Gives the same dive starts as ``get_dive_starting_points()`` using the
+    precomputed candidate peaks.
+
+    :param data: the cleaned data returned by ``get_candidate_peaks()``
+    :param candidates: the candidate peaks returned by
+        ``get_candidate_peaks()``
+    :param dive_detection_sensitivity: a value bteween 0 and 1 indicating the
+        peak detection threshold, the lower the value the deeper the threshold
+    :param is_surfacing_animal: a boolean indicating whether it's an animal
+        that is gaurantedd to surface between dives
+    :param minimal_time_between_dives: the minimum time in seconds that needs
+        to occur before there can be a new dive segement
+    :param surface_threshold: the threshold at which is considered surface for
+        surfacing animals, default is 0
+
+    :return: a dataframe of the dive starts
+    """
+    peaks = filter_candidate_peaks(data, candidates,
+                                   dive_detection_sensitivity,
+                                   minimal_time_between_dives)
+    return get_dive_blocks(data,
+                           peaks,
+                           is_surfacing_animal=is_surfacing_animal,
+                           surface_threshold=surface_threshold)
+
+
+def get_dive_detection_curve(data,
+                             dive_detection_sensitivities=np.arange(
+                                 0.5, 1, 0.01),
+                             minimal_times_between_dives=[120],
+                             is_surfacing_animal=True,
+                             surface_threshold=0,
+                             columns={
+                                 'depth': 'depth',
+                                 'time': 'time'
+                             }):
+    """
+    Counts the dives found for every combination of
+    ``dive_detection_sensitivity`` and ``minimal_time_between_dives``. The
+    peak detection is only run once and each combination only filters the
+    candidate peaks. For surfacing animals only the segments deeper than the
+    ``surface_threshold`` are counted.
+
+    :param data: a dataframe needing a time and a depth column
+    :param dive_detection_sensitivities: a list of values bteween 0 and 1
+        indicating the peak detection threshold
+    :param minimal_times_between_dives: a list of the minimum times in seconds
+        that needs to occur before there can be a new dive segement
+    :param is_surfacing_animal: a boolean indicating whether it's an animal
+        that is gaurantedd to surface between dives
+    :param surface_threshold: the threshold at which is considered surface for
+        surfacing animals, default is 0
+    :param columns: column renaming dictionary if needed
+
+    :return: a dataframe with the number of dives for each
+        ``dive_detection_sensitivity`` and ``minimal_time_between_dives``
+    """
+    candidates, data = get_candidate_peaks(data, columns=columns)
+
+    depth = data.depth.values
+    y_min = -np.max(depth)
+    y_max = -np.min(depth)
+    sampling_interval = get_sampling_interval(data)
+    peaks = candidates['index'].values
+    heights = candidates.depth.values * -1
+
+    curve = []
+    for minimal_time_between_dives in minimal_times_between_dives:
+        min_dist = int(minimal_time_between_dives / sampling_interval)
+        for dive_detection_sensitivity in dive_detection_sensitivities:
+            threshold = dive_detection_sensitivity * (y_max - y_min) + y_min
+            starts = np.union1d([0], _filter_peaks(peaks, heights, threshold,
+                                                   min_dist))
+            if is_surfacing_animal:
+                # The deepest point of each segment, including the first
+                # point of the next segment
+                max_depths = np.maximum.reduceat(depth, starts)
+                max_depths[:-1] = np.maximum(max_depths[:-1],
+                                             depth[starts[1:]])
+                number_of_dives = np.sum(max_depths > surface_threshold)
+            else:
+                number_of_dives = len(starts)
+            curve.append({
+                'dive_detection_sensitivity': dive_detection_sensitivity,
+                'minimal_time_between_dives': minimal_time_between_dives,
+                'number_of_dives': number_of_dives
+            })
+
+    return pd.DataFrame(curve)
+
+
 def profile_dives(data,
                   columns={
                       'depth': 'depth',
@@ -450,7 +1483,13 @@ def profile_dives(data,
                   minimal_time_between_dives=120,
                   surface_threshold=0,
                   ipython_display_mode=False,
-                  at_depth_threshold=0.15):
+                  at_depth_threshold=0.15,
+                  depth_range=None,
+                  sampling_interval=None,
+                  shape_points=None,
+                  checkpoint_folder=None,
+                  checkpoint_batch_size=1000,
+                  features=None):
     """
     Calls the other functions to split and profile each dive. This function
     uses the ``divebomb.Dive`` or ``divebomb.DeepDive`` class to profile the
@@ -467,17 +1506,39 @@ def profile_dives(data,
     :param surface_threshold: the threshold at which is considered surface for
         surfacing animals, default is 0
     :param ipython_display_mode: whether or not to display the dives
-
-    :return: two dataframes for the dive profiles, inssufficient dives, and the original data
+    :param depth_range: the minimum and maximum depth the detection
+        sensitivity is relative to, see ``get_dive_starting_points()``
+    :param sampling_interval: the sampling interval in seconds, calculated
+        from the data if not provided
+    :param shape_points: if provided, the depth of every dive is also
+        resampled to this many points over the normalized time of the dive,
+        see ``get_dive_shapes()``
+    :param checkpoint_folder: if provided, the profiles are saved to this
+        folder in batches as they are completed, and a run that is started
+        again with the same data and arguments skips the saved batches, see
+        ``profile_checkpointed()``
+    :param checkpoint_batch_size: the number of dives in a saved batch
+    :param features: a list of the features needed, such as the
+        ``attributes`` later passed to ``cluster_dives()``, the costly
+        features of the ``lazy_features`` of ``Dive`` or ``DeepDive`` that are
+        not listed are not computed or returned, ``None`` computes every
+        feature
+
+    :return: two dataframes for the dive profiles, inssufficient dives, and the data
+        sorted by time (see ``prepare_dive_data()``), followed by the dive
+        shapes of the profiled dives if ``shape_points`` is provided, one row
+        per row of the dive profiles
     """
-    data = data.copy(deep=True)
+    # The dives are read-only views of the sorted data
+    data = prepare_dive_data(data, columns=columns)
     starts = get_dive_starting_points(
         data,
         is_surfacing_animal=is_surfacing_animal,
         minimal_time_between_dives=minimal_time_between_dives,
         dive_detection_sensitivity=dive_detection_sensitivity,
         surface_threshold=surface_threshold,
-        columns=columns)
+        depth_range=depth_range,
+        sampling_interval=sampling_interval)
 
     type = 'Dive'
     if not is_surfacing_animal:
@@ -487,48 +1548,679 @@ def profile_dives(data,
     # the index.
     if ipython_display_mode:
         py.init_notebook_mode()
+        browser = DiveBrowser(data,
+                              starts,
+                              type=type,
+                              surface_threshold=surface_threshold,
+                              at_depth_threshold=at_depth_threshold)
         return interact(
-            display_dive,
+            browser.display,
             index=widgets.IntSlider(
                 min=0,
                 max=starts.index.max(),
                 step=1,
                 value=0,
-                layout=Layout(width='100%')),
-            data=fixed(data),
-            starts=fixed(starts),
-            type=fixed(type),
-            surface_threshold=fixed(surface_threshold),
-            at_depth_threshold=fixed(at_depth_threshold))
+                layout=Layout(width='100%')))
     else:
-        dives = pd.DataFrame()
-        if type == 'DeepDive':
-            for index, row in starts.iterrows():
-                dive_profile = DeepDive(
-                    data[starts.loc[index, 'start_block']:starts.loc[
-                        index, 'end_block']],
-                    at_depth_threshold=at_depth_threshold)
-                dives = dives.append(dive_profile.to_dict(), ignore_index=True)
+        if checkpoint_folder is not None:
+            dives = profile_checkpointed(data,
+                                         starts,
+                                         checkpoint_folder,
+                                         batch_size=checkpoint_batch_size,
+                                         type=type,
+                                         surface_threshold=surface_threshold,
+                                         at_depth_threshold=at_depth_threshold,
+                                         features=features)
         else:
-            for index, row in starts.iterrows():
-                dive_profile = Dive(
-                    data[starts.loc[index, 'start_block']:starts.loc[
-                        index, 'end_block']],
-                    surface_threshold=surface_threshold,
-                    at_depth_threshold=at_depth_threshold)
-                dives = dives.append(dive_profile.to_dict(), ignore_index=True)
+            dives = profile_starts(data,
+                                   starts,
+                                   type=type,
+                                   surface_threshold=surface_threshold,
+                                   at_depth_threshold=at_depth_threshold,
+                                   features=features)
 
         # Pull out insufficient dives
-        insufficient_dives = None
-        if 'insufficient_data' in dives.columns:
-            insufficient_dives = dives[dives.insufficient_data == True].reset_index(
-                drop=True)
-            dives = dives[dives.insufficient_data
-                          == False].reset_index(drop=True)
+        dives, insufficient_dives, sufficient = split_insufficient_dives(dives)
 
+        if shape_points is not None:
+            shapes = get_dive_shapes(data, starts, shape_points=shape_points)
+            return dives, insufficient_dives, data, shapes[sufficient]
         return dives, insufficient_dives, data
 
 
+def profile_starts(data,
+                   starts,
+                   type='Dive',
+                   surface_threshold=0,
+                   at_depth_threshold=0.15,
+                   features=None):
+    """
+    Profiles the dives between the start and end blocks of the starts.
+
+    :param data: the data sorted by time, see ``prepare_dive_data()``
+    :param starts: the dive starts from ``get_dive_starting_points()``
+    :param type: either ``Dive`` or ``DeepDive``
+    :param surface_threshold: the threshold at which is considered surface for
+        surfacing animals, default is 0
+    :param at_depth_threshold: a value from 0 - 1 indicating distance from the
+        bottom of the dive at which the animal is considered to be at depth
+    :param features: a list of the features needed, the ``lazy_features`` of
+        the profile class that are not listed are left out, ``None`` computes
+        every feature
+
+    :return: a dataframe of the dive profiles with the columns of the
+        ``profile_schema`` of the profile class, including the insufficient
+        dives
+    """
+    if type == 'DeepDive':
+        profile_class = DeepDive
+        kwargs = {'at_depth_threshold': at_depth_threshold}
+    else:
+        profile_class = Dive
+        kwargs = {
+            'surface_threshold': surface_threshold,
+            'at_depth_threshold': at_depth_threshold
+        }
+
+    schema = profile_class.profile_schema
+    if features is not None:
+        features = list(features)
+        names = [column for column, dtype in schema]
+        unknown = [feature for feature in features if feature not in names]
+        if unknown:
+            raise ValueError('unknown %s features: %s' %
+                             (profile_class.__name__, ', '.join(unknown)))
+        schema = [(column, dtype) for column, dtype in schema
+                  if column not in profile_class.lazy_features
+                  or column in features]
+        kwargs['features'] = features
+
+    # The values of the dives are written into columns allocated once, the
+    # values a dive does not have are left missing
+    dives = {
+        column: np.zeros(len(starts), dtype=dtype) if dtype == np.bool_ else
+        np.full(len(starts), np.nan, dtype=dtype)
+        for column, dtype in schema
+    }
+    start_blocks = starts.start_block.values.astype(np.int64)
+    end_blocks = starts.end_block.values.astype(np.int64)
+    for i in range(len(starts)):
+        dive_profile = profile_class(data[start_blocks[i]:end_blocks[i]],
+                                     **kwargs)
+        for column, value in dive_profile.to_dict().items():
+            if column in dives and value is not None:
+                dives[column][i] = value
+    return pd.DataFrame(dives)
+
+
+def split_insufficient_dives(dives):
+    """
+    :param dives: a dataframe of dive profiles from ``profile_starts()``
+
+    :return: the profiles of the sufficient dives, the profiles of the
+        insufficient dives or ``None`` if the profiles have no
+        ``insufficient_data`` column, and a boolean array of the sufficient
+        dives
+    """
+    if 'insufficient_data' not in dives.columns:
+        return dives, None, np.ones(len(dives), dtype=bool)
+
+    insufficient = dives.insufficient_data.values.astype(bool)
+    order = np.argsort(insufficient, kind='stable')
+    number_sufficient = len(dives) - np.count_nonzero(insufficient)
+    dives = dives.take(order)
+    return (dives[:number_sufficient].reset_index(drop=True),
+            dives[number_sufficient:].reset_index(drop=True), ~insufficient)
+
+
+def get_checkpoint_settings(data, starts, batch_size, **kwargs):
+    """
+    :param data: the data sorted by time, see ``prepare_dive_data()``
+    :param starts: the dive starts from ``get_dive_starting_points()``
+    :param batch_size: the number of dives in a saved batch
+    :param kwargs: the profiling arguments
+
+    :return: a dictionary identifying a checkpointed run, the dives and
+        arguments have to be the same for the saved batches to be used
+    """
+    dives = pd.DataFrame({
+        'start_block': starts.start_block.values.astype(np.int64),
+        'end_block': starts.end_block.values.astype(np.int64),
+        'start_time': data.time.values[starts.start_block.values.astype(
+            np.int64)]
+    })
+    settings = dict(kwargs)
+    settings['batch_size'] = int(batch_size)
+    settings['number_of_dives'] = len(dives)
+    settings['fingerprint'] = '%016x' % int(
+        pd.util.hash_pandas_object(dives, index=False).sum())
+    return settings
+
+
+def profile_checkpointed(data,
+                         starts,
+                         folder,
+                         batch_size=1000,
+                         type='Dive',
+                         surface_threshold=0,
+                         at_depth_threshold=0.15,
+                         features=None):
+    """
+    Profiles the dives in batches and saves each completed batch to a folder,
+    so a run that is interrupted can be started again without losing the
+    finished work. The batches that are already saved are read instead of
+    being profiled again. Each batch is written to a temporary file and then
+    renamed, so an interrupted write never leaves a partial batch.
+
+    :param data: the data sorted by time, see ``prepare_dive_data()``
+    :param starts: the dive starts from ``get_dive_starting_points()``
+    :param folder: the folder the batches are saved to, it is created if it
+        does not exist
+    :param batch_size: the number of dives in a batch
+    :param type: either ``Dive`` or ``DeepDive``
+    :param surface_threshold: the threshold at which is considered surface for
+        surfacing animals, default is 0
+    :param at_depth_threshold: a value from 0 - 1 indicating distance from the
+        bottom of the dive at which the animal is considered to be at depth
+    :param features: a list of the features needed, see ``profile_starts()``
+
+    :return: a dataframe of the dive profiles, including the insufficient
+        dives
+    """
+    os.makedirs(folder, exist_ok=True)
+    kwargs = {}
+    if features is not None:
+        kwargs['features'] = sorted(features)
+    settings = get_checkpoint_settings(data,
+                                       starts,
+                                       batch_size,
+                                       type=type,
+                                       surface_threshold=float(
+                                           surface_threshold),
+                                       at_depth_threshold=float(
+                                           at_depth_threshold),
+                                       **kwargs)
+    settings_file = os.path.join(folder, checkpoint_filename)
+    if os.path.exists(settings_file):
+        with open(settings_file) as f:
+            if json.load(f) != settings:
+                raise ValueError(
+                    'the checkpoint in %s is from a different run, remove '
+                    'the folder to start over' % folder)
+    else:
+        with open(settings_file, 'w') as f:
+            json.dump(settings, f, indent=2)
+
+    batches = []
+    for batch, start in enumerate(range(0, len(starts), batch_size)):
+        filename = os.path.join(folder, 'batch_%05d.pkl' % batch)
+        if os.path.exists(filename):
+            batches.append(pd.read_pickle(filename))
+            continue
+
+        dives = profile_starts(data,
+                               starts[start:start + batch_size],
+                               type=type,
+                               surface_threshold=surface_threshold,
+                               at_depth_threshold=at_depth_threshold,
+                               features=features)
+        dives.to_pickle(filename + '.tmp')
+        os.replace(filename + '.tmp', filename)
+        batches.append(dives)
+
+    if not batches:
+        return pd.DataFrame()
+    return pd.concat(batches, ignore_index=True, sort=False)
+
+
+def get_dive_shapes(data,
+                    starts,
+                    shape_points=32,
+                    normalize_depth=False,
+                    columns={
+                        'depth': 'depth',
+                        'time': 'time'
+                    }):
+    """
+    Resamples the depth of every dive to the same number of points over the
+    normalized time of the dive, from the start to the end of the dive. All
+    the dives are interpolated in one batch from their offsets in the data.
+
+    :param data: a dataframe sorted by time with a time and a depth column
+    :param starts: the dive starts from ``get_dive_starting_points()``, the
+        dives are the rows from ``start_block`` up to ``end_block``
+    :param shape_points: the number of points in each dive shape
+    :param normalize_depth: whether the depth of each dive is divided by the
+        max depth of the dive
+    :param columns: column renaming dictionary if needed
+
+    :return: a numpy array with a row of ``shape_points`` depths per dive
+    """
+    time = time_in_seconds(data[columns['time']])
+    depth = data[columns['depth']].values.astype(np.float64)
+    start = starts.start_block.values.astype(np.int64)
+    end = np.minimum(starts.end_block.values.astype(np.int64), len(depth))
+    last = np.maximum(end - 1, start)
+
+    # The time of each point of each dive
+    progress = np.linspace(0, 1, shape_points)
+    duration = time[last] - time[start]
+    query = time[start][:, np.newaxis] + \
+        duration[:, np.newaxis] * progress[np.newaxis, :]
+
+    # Interpolate between the samples before and after each point, staying
+    # inside the dive
+    right = np.searchsorted(time, query, side='left')
+    right = np.clip(right, (start + 1)[:, np.newaxis], last[:, np.newaxis])
+    left = np.maximum(right - 1, start[:, np.newaxis])
+    span = time[right] - time[left]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weight = np.where(span > 0, (query - time[left]) / span, 0)
+    weight = np.clip(weight, 0, 1)
+    shapes = depth[left] + (depth[right] - depth[left]) * weight
+
+    if normalize_depth and len(start):
+        # The max depth of each dive from the start and end pairs, the padding
+        # allows a dive to end at the last sample
+        padded = np.append(depth, -np.inf)
+        max_depth = np.maximum.reduceat(
+            padded, np.column_stack([start, end]).ravel())[::2]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            shapes = np.where(max_depth[:, np.newaxis] > 0,
+                              shapes / max_depth[:, np.newaxis], 0)
+    return shapes
+
+
+def get_export_shapes(data, dives, shape_points=32):
+    """
+    :param data: a dataframe sorted by time with a time and a depth column
+    :param dives: a Pandas DataFrame of dive profiles
+    :param shape_points: the number of points in each dive shape
+
+    :return: the shapes of the dives from their ``dive_start`` to their
+        ``dive_end`` with the depth divided by the max depth of the dive, see
+        ``get_dive_shapes()``
+    """
+    time = time_in_seconds(data.time)
+    starts = pd.DataFrame({
+        'start_block': np.searchsorted(time, dives.dive_start.values, 'left'),
+        'end_block': np.searchsorted(time, dives.dive_end.values, 'right')
+    })
+    return get_dive_shapes(data, starts, shape_points=shape_points,
+                           normalize_depth=True)
+
+
+def _profile_segment(segment, kwargs):
+    """
+    Profiles one segment of the data, used by ``profile_segments()`` so it
+    can be sent to a worker process.
+
+    :param segment: a dataframe of a contiguous segment of the data
+    :param kwargs: the keyword arguments for ``profile_dives()``
+
+    :return: the dive profiles and insufficient dives of the segment
+    """
+    dives, insufficient_dives, data = profile_dives(segment, **kwargs)
+    return dives, insufficient_dives
+
+
+def profile_segments(data,
+                     gap_threshold=None,
+                     n_jobs=None,
+                     columns={
+                         'depth': 'depth',
+                         'time': 'time'
+                     },
+                     is_surfacing_animal=True,
+                     dive_detection_sensitivity=None,
+                     minimal_time_between_dives=120,
+                     surface_threshold=0,
+                     at_depth_threshold=0.15,
+                     checkpoint_folder=None,
+                     checkpoint_batch_size=1000,
+                     features=None):
+    """
+    Splits the data at gaps longer than ``gap_threshold`` and profiles each
+    contiguous segment independently in a pool of processes. The results are
+    merged and sorted by ``dive_start`` so the dive ids (the index + 1) are
+    consistent across the whole record. A ``segment`` column records which
+    segment each dive came from.
+
+    :param data: a dataframe needing a time and a depth column
+    :param gap_threshold: the time (in seconds) between two samples that
+        splits the data, see ``preprocessing.get_sampling_segments()``
+    :param n_jobs: the number of processes to use, ``None`` uses every CPU
+        and ``1`` profiles the segments in this process
+    :param columns: column renaming dictionary if needed
+    :param is_surfacing_animal: a boolean indicating whether it's an animal
+        that is gauranteed to surface between dives
+    :param dive_detection_sensitivity: a value bteween 0 and 1 indicating the
+        peak detection threshold, the lower the value the deeper the threshold
+    :param minimal_time_between_dives: the minimum time in seconds that needs
+        to occur before there can be a new dive segement
+    :param surface_threshold: the threshold at which is considered surface for
+        surfacing animals, default is 0
+    :param at_depth_threshold: a value from 0 - 1 indicating distance from the
+        bottom of the dive at which the animal is considered to be at depth
+    :param checkpoint_folder: a folder to save the profiles to in batches so
+        an interrupted run can be started again, each segment is saved in a
+        ``segment_<number>`` sub folder, see ``profile_dives()``
+    :param checkpoint_batch_size: the number of dives in a saved batch
+    :param features: a list of the features needed, see ``profile_dives()``
+
+    :return: two dataframes for the dive profiles, inssufficient dives, and
+        the original data
+    """
+    data = prepare_dive_data(data, columns=columns)
+    segments = split_on_gaps(data, gap_threshold=gap_threshold)
+    # Peak detection needs a few points to work with
+    segments = [segment for segment in segments if len(segment) > 2]
+
+    kwargs = {
+        'is_surfacing_animal': is_surfacing_animal,
+        'dive_detection_sensitivity': dive_detection_sensitivity,
+        'minimal_time_between_dives': minimal_time_between_dives,
+        'surface_threshold': surface_threshold,
+        'at_depth_threshold': at_depth_threshold,
+        'checkpoint_batch_size': checkpoint_batch_size,
+        'features': features
+    }
+    segment_kwargs = []
+    for segment in range(len(segments)):
+        segment_kwargs.append(dict(kwargs))
+        if checkpoint_folder is not None:
+            segment_kwargs[-1]['checkpoint_folder'] = os.path.join(
+                checkpoint_folder, 'segment_%05d' % segment)
+
+    if n_jobs == 1:
+        results = [
+            _profile_segment(segment, kwargs)
+            for segment, kwargs in zip(segments, segment_kwargs)
+        ]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(executor.map(_profile_segment, segments,
+                                        segment_kwargs))
+
+    all_dives = []
+    all_insufficient_dives = []
+    for segment, (dives, insufficient_dives) in enumerate(results):
+        dives['segment'] = segment
+        all_dives.append(dives)
+        if insufficient_dives is not None:
+            insufficient_dives['segment'] = segment
+            all_insufficient_dives.append(insufficient_dives)
+
+    dives = pd.concat(all_dives, ignore_index=True, sort=False)
+    dives = dives.sort_values('dive_start').reset_index(drop=True)
+    insufficient_dives = None
+    if all_insufficient_dives:
+        insufficient_dives = pd.concat(all_insufficient_dives,
+                                       ignore_index=True, sort=False)
+        insufficient_dives = insufficient_dives.sort_values(
+            'dive_start').reset_index(drop=True)
+
+    data = pd.concat(segments, ignore_index=True)
+    return dives, insufficient_dives, data
+
+
+def profile_xarray_chunks(dataset,
+                          chunk_size=1000000,
+                          overlap=10000,
+                          scheduler='threads',
+                          columns={
+                              'depth': 'depth',
+                              'time': 'time'
+                          },
+                          is_surfacing_animal=True,
+                          dive_detection_sensitivity=None,
+                          minimal_time_between_dives=120,
+                          surface_threshold=0,
+                          at_depth_threshold=0.15):
+    """
+    Profiles an ``xarray.Dataset`` one chunk at a time so the whole dataset
+    never has to be in memory. Each chunk is loaded with ``overlap`` samples
+    on both sides, profiled, and only the dives that start inside the chunk
+    are kept, so dives crossing a chunk boundary are profiled whole and only
+    once. If the dataset is backed by Dask its chunks are used, otherwise the
+    data is read ``chunk_size`` samples at a time.
+
+    :param dataset: an ``xarray.Dataset`` with a time and a depth variable
+    :param chunk_size: the number of samples in a chunk if the dataset is not
+        chunked
+    :param overlap: the number of samples added to both sides of a chunk,
+        this should be longer than the longest dive
+    :param scheduler: the Dask scheduler used to load each chunk
+    :param columns: variable renaming dictionary if needed
+    :param is_surfacing_animal: a boolean indicating whether it's an animal
+        that is gauranteed to surface between dives
+    :param dive_detection_sensitivity: a value bteween 0 and 1 indicating the
+        peak detection threshold, the lower the value the deeper the threshold
+    :param minimal_time_between_dives: the minimum time in seconds that needs
+        to occur before there can be a new dive segement
+    :param surface_threshold: the threshold at which is considered surface for
+        surfacing animals, default is 0
+    :param at_depth_threshold: a value from 0 - 1 indicating distance from the
+        bottom of the dive at which the animal is considered to be at depth
+
+    :return: a generator of the dive profiles and insufficient dives of each
+        chunk
+    """
+    depth = dataset[columns['depth']]
+    dimension = depth.dims[0]
+    length = dataset.sizes[dimension]
+
+    # Detect relative to the whole record so every chunk uses the same
+    # threshold and minimum distance
+    depth_range = (float(depth.min().compute(scheduler=scheduler)),
+                   float(depth.max().compute(scheduler=scheduler)))
+    first_and_last = time_in_seconds(pd.Series(
+        dataset[columns['time']].isel({dimension: [0, -1]}).values))
+    sampling_interval = (first_and_last[1] - first_and_last[0]) / (length - 1)
+
+    if depth.chunks is not None:
+        boundaries = np.cumsum((0, ) + depth.chunks[0])
+    else:
+        boundaries = np.append(np.arange(0, length, chunk_size), length)
+
+    for chunk_start, chunk_end in zip(boundaries[:-1], boundaries[1:]):
+        window_start = max(chunk_start - overlap, 0)
+        window_end = min(chunk_end + overlap, length)
+        window = dataset[[columns['time'], columns['depth']]].isel(
+            {dimension: slice(window_start, window_end)})
+        window = window.load(scheduler=scheduler)
+
+        data = pd.DataFrame()
+        data['time'] = time_in_seconds(
+            pd.Series(window[columns['time']].values))
+        data['depth'] = window[columns['depth']].values
+        core_start = data.time[chunk_start - window_start]
+        core_end = None
+        if chunk_end < length:
+            core_end = data.time[chunk_end - window_start]
+
+        dives, insufficient_dives, data = profile_dives(
+            data,
+            is_surfacing_animal=is_surfacing_animal,
+            dive_detection_sensitivity=dive_detection_sensitivity,
+            minimal_time_between_dives=minimal_time_between_dives,
+            surface_threshold=surface_threshold,
+            at_depth_threshold=at_depth_threshold,
+            depth_range=depth_range,
+            sampling_interval=sampling_interval)
+
+        # Only keep the dives that start in this chunk
+        in_chunk = []
+        for profiles in [dives, insufficient_dives]:
+            if profiles is not None and not profiles.empty:
+                keep = profiles.dive_start >= core_start
+                if core_end is not None:
+                    keep &= profiles.dive_start < core_end
+                profiles = profiles[keep].reset_index(drop=True)
+            in_chunk.append(profiles)
+
+        yield in_chunk[0], in_chunk[1]
+
+
+def profile_dives_from_xarray(dataset,
+                              output_file=None,
+                              chunk_size=1000000,
+                              overlap=10000,
+                              scheduler='threads',
+                              columns={
+                                  'depth': 'depth',
+                                  'time': 'time'
+                              },
+                              is_surfacing_animal=True,
+                              dive_detection_sensitivity=None,
+                              minimal_time_between_dives=120,
+                              surface_threshold=0,
+                              at_depth_threshold=0.15):
+    """
+    Profiles a chunked ``xarray.Dataset`` or a netCDF file with
+    ``profile_xarray_chunks()``. If an ``output_file`` is given the dives of
+    each chunk are appended to it as CSV as soon as they are profiled,
+    including the insufficient dives, and nothing is kept in memory.
+
+    :param dataset: an ``xarray.Dataset`` or the path to a netCDF file with a
+        time and a depth variable
+    :param output_file: a CSV file to write the dives to as they are profiled
+    :param chunk_size: the number of samples in a chunk, also used to chunk
+        the netCDF file when Dask is installed
+    :param overlap: the number of samples added to both sides of a chunk,
+        this should be longer than the longest dive
+    :param scheduler: the Dask scheduler used to load each chunk
+    :param columns: variable renaming dictionary if needed
+    :param is_surfacing_animal: a boolean indicating whether it's an animal
+        that is gauranteed to surface between dives
+    :param dive_detection_sensitivity: a value bteween 0 and 1 indicating the
+        peak detection threshold, the lower the value the deeper the threshold
+    :param minimal_time_between_dives: the minimum time in seconds that needs
+        to occur before there can be a new dive segement
+    :param surface_threshold: the threshold at which is considered surface for
+        surfacing animals, default is 0
+    :param at_depth_threshold: a value from 0 - 1 indicating distance from the
+        bottom of the dive at which the animal is considered to be at depth
+
+    :return: the dive profiles and insufficient dives, or the
+        ``output_file`` if the dives were written to it
+    """
+    # A file opened here is closed once profiled, a dataset passed in is left
+    # open for the caller
+    opened_dataset = None
+    if isinstance(dataset, str):
+        dataset = opened_dataset = xr.open_dataset(dataset)
+
+    try:
+        # Without Dask xarray still only reads the indexed window
+        if opened_dataset is not None and dask is not None:
+            dataset = dataset.chunk(
+                {dataset[columns['depth']].dims[0]: chunk_size})
+
+        chunks = profile_xarray_chunks(
+            dataset,
+            chunk_size=chunk_size,
+            overlap=overlap,
+            scheduler=scheduler,
+            columns=columns,
+            is_surfacing_animal=is_surfacing_animal,
+            dive_detection_sensitivity=dive_detection_sensitivity,
+            minimal_time_between_dives=minimal_time_between_dives,
+            surface_threshold=surface_threshold,
+            at_depth_threshold=at_depth_threshold)
+
+        if output_file is not None:
+            if os.path.exists(output_file):
+                os.remove(output_file)
+            for dives, insufficient_dives in chunks:
+                profiles = pd.concat([dives, insufficient_dives],
+                                     ignore_index=True, sort=False)
+                profiles.to_csv(output_file, mode='a', index=False,
+                                header=not os.path.exists(output_file))
+            return output_file
+
+        all_dives = []
+        all_insufficient_dives = []
+        for dives, insufficient_dives in chunks:
+            all_dives.append(dives)
+            if insufficient_dives is not None:
+                all_insufficient_dives.append(insufficient_dives)
+
+        dives = pd.concat(all_dives, ignore_index=True, sort=False)
+        insufficient_dives = None
+        if all_insufficient_dives:
+            insufficient_dives = pd.concat(all_insufficient_dives,
+                                           ignore_index=True, sort=False)
+        return dives, insufficient_dives
+    finally:
+        if opened_dataset is not None:
+            opened_dataset.close()
+
+
+def profile_at_depth_thresholds(data,
+                                at_depth_thresholds=[0.1, 0.15, 0.2, 0.25],
+                                columns={
+                                    'depth': 'depth',
+                                    'time': 'time'
+                                },
+                                is_surfacing_animal=True,
+                                dive_detection_sensitivity=None,
+                                minimal_time_between_dives=120,
+                                surface_threshold=0):
+    """
+    Profiles the dives at several ``at_depth_threshold`` values to test how
+    sensitive the profiles are to the threshold. The dives are detected once
+    and the threshold independent values of each dive (sorting, differences,
+    cumulative statistics, and max depth) are computed once and shared by
+    every threshold.
+
+    :param data: a dataframe needing a time and a depth column
+    :param at_depth_thresholds: a list of values from 0 - 1 indicating
+        distance from the bottom of the dive at which the animal is considered
+        to be at depth
+    :param columns: column renaming dictionary if needed
+    :param is_surfacing_animal: a boolean indicating whether it's an animal
+        that is gauranteed to surface between dives
+    :param dive_detection_sensitivity: a value bteween 0 and 1 indicating the
+        peak detection threshold, the lower the value the deeper the threshold
+    :param minimal_time_between_dives: the minimum time in seconds that needs
+        to occur before there can be a new dive segement
+    :param surface_threshold: the threshold at which is considered surface for
+        surfacing animals, default is 0
+
+    :return: a dataframe of the dive profiles with one row per
+        ``at_depth_threshold`` and ``dive_id``
+    """
+    data = prepare_dive_data(data, columns=columns)
+    starts = get_dive_starting_points(
+        data,
+        is_surfacing_animal=is_surfacing_animal,
+        minimal_time_between_dives=minimal_time_between_dives,
+        dive_detection_sensitivity=dive_detection_sensitivity,
+        surface_threshold=surface_threshold)
+
+    profiles = []
+    for index, row in starts.iterrows():
+        dive_data = data[starts.loc[index, 'start_block']:starts.loc[
+            index, 'end_block']]
+        for i, at_depth_threshold in enumerate(at_depth_thresholds):
+            if i == 0 and is_surfacing_animal:
+                dive_profile = Dive(dive_data,
+                                    surface_threshold=surface_threshold,
+                                    at_depth_threshold=at_depth_threshold)
+            elif i == 0:
+                dive_profile = DeepDive(dive_data,
+                                        at_depth_threshold=at_depth_threshold)
+            else:
+                dive_profile.profile(at_depth_threshold)
+            profile = {'at_depth_threshold': at_depth_threshold,
+                       'dive_id': index + 1}
+            profile.update(dive_profile.to_dict())
+            profiles.append(profile)
+
+    return pd.DataFrame(profiles)
+
+
 def profile_cluster_export(data,
                            folder=None,
                            columns={
@@ -539,7 +2231,12 @@ def profile_cluster_export(data,
                            dive_detection_sensitivity=None,
                            minimal_time_between_dives=120,
                            surface_threshold=0,
-                           at_depth_threshold=0.15):
+                           at_depth_threshold=0.15,
+                           encoding='default',
+                           checkpoint_folder=None,
+                           checkpoint_batch_size=1000,
+                           attributes=None,
+                           features=None):
     """
     Calls `profile_dives`, `cluster_dives`, and `export_to_netcdf`
 
@@ -554,6 +2251,15 @@ def profile_cluster_export(data,
         to occur before there can be a new dive segement
     :param surface_threshold: the threshold at which is considered surface for
         surfacing animals, default is 0
+    :param encoding: the netCDF encoding preset or dictionary, see
+        ``preprocessing.get_encoding_policy()``
+    :param checkpoint_folder: a folder to save the profiles to in batches so
+        an interrupted run can be started again, see ``profile_dives()``
+    :param checkpoint_batch_size: the number of dives in a saved batch
+    :param attributes: a list of the columns to cluster on, see
+        ``cluster_dives()``
+    :param features: a list of the features to profile, defaults to the
+        ``attributes``, see ``profile_dives()``
 
     :return: two dataframes for the dive profiles and the original data
     """
@@ -562,8 +2268,11 @@ def profile_cluster_export(data,
                                                     minimal_time_between_dives=minimal_time_between_dives,
                                                     dive_detection_sensitivity=dive_detection_sensitivity,
                                                     surface_threshold=surface_threshold,
-                                                    columns=columns)
-    dives, loadings, pca_output_matrix = cluster_dives(dives)
+                                                    columns=columns,
+                                                    checkpoint_folder=checkpoint_folder,
+                                                    checkpoint_batch_size=checkpoint_batch_size,
+                                                    features=attributes if features is None else features)
+    dives, loadings, pca_output_matrix = cluster_dives(dives, attributes=attributes)
     export_to_netcdf(folder, data, dives, loadings,
-                     pca_output_matrix, insufficient_dives)
+                     pca_output_matrix, insufficient_dives, encoding=encoding)
     return data, dives, loadings, pca_output_matrix, insufficient_dives
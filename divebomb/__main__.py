@@ -0,0 +1,3 @@
+from divebomb.cli import main
+
+main()
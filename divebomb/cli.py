@@ -0,0 +1,470 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import xarray as xr
+
+import divebomb
+from divebomb import (cluster_dives, export_to_csv, export_to_netcdf,
+                      get_dive_starting_points, profile_dives,
+                      profile_segments)
+from divebomb.IngestService import IngestService
+from divebomb.plotting import export_html_report
+from divebomb.preprocessing import (correct_depth_offset, encoding_presets,
+                                    get_xarray_encoding)
+
+formats = ['csv', 'netcdf', 'parquet', 'json']
+
+
+def get_format(filename, file_format=None):
+    """
+    :param filename: the path to a file, ``-`` for stdin or stdout
+    :param file_format: an explicit format that overrides the extension
+
+    :return: the format of the file, one of ``csv``, ``netcdf``, ``parquet``,
+        or ``json``
+    """
+    if file_format is not None:
+        return file_format
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in ['.nc', '.nc4', '.cdf']:
+        return 'netcdf'
+    if extension in ['.parquet', '.pq']:
+        return 'parquet'
+    if extension == '.json':
+        return 'json'
+    return 'csv'
+
+
+def read_table(filename, file_format=None, chunksize=100000):
+    """
+    Reads a table from a file or from stdin (``-``). CSV input is streamed
+    in chunks.
+
+    :param filename: the path to the file, ``-`` for stdin
+    :param file_format: the format of the file, inferred from the extension
+        if not provided
+    :param chunksize: the number of CSV rows read at a time
+
+    :return: a Pandas DataFrame
+    """
+    file_format = get_format(filename, file_format)
+    source = sys.stdin if filename == '-' else filename
+    if file_format == 'netcdf':
+        dataset = xr.open_dataset(filename)
+        data = dataset.to_dataframe()
+        # Tables written by divebomb use an unnamed dim_0 row dimension
+        data = data.reset_index(drop=data.index.name == 'dim_0')
+        dataset.close()
+        return data
+    if file_format == 'parquet':
+        return pd.read_parquet(filename)
+    if file_format == 'json':
+        return pd.read_json(source, orient='records', lines=True)
+    return pd.concat(pd.read_csv(source, chunksize=chunksize),
+                     ignore_index=True)
+
+
+def write_table(data, filename, file_format=None, encoding='default'):
+    """
+    Writes a table to a file or to stdout (``-``).
+
+    :param data: a Pandas DataFrame
+    :param filename: the path to the file, ``-`` for stdout
+    :param file_format: the format of the file, inferred from the extension
+        if not provided
+    :param encoding: the netCDF encoding preset
+    """
+    file_format = get_format(filename, file_format)
+    target = sys.stdout if filename == '-' else filename
+    if file_format == 'netcdf':
+        xarray_data = xr.Dataset(data.reset_index(drop=True))
+        xarray_data.to_netcdf(filename, mode='w',
+                              encoding=get_xarray_encoding(
+                                  xarray_data, encoding))
+        xarray_data.close()
+    elif file_format == 'parquet':
+        data.to_parquet(filename, index=False)
+    elif file_format == 'json':
+        data.to_json(target, orient='records', lines=True)
+    else:
+        data.to_csv(target, index=False)
+
+
+def get_columns(args):
+    """
+    :param args: the parsed arguments
+
+    :return: the column renaming dictionary
+    """
+    return {'depth': args.depth_column, 'time': args.time_column}
+
+
+def run_correct(args, report):
+    """
+    Corrects the depth offset of the input data.
+    """
+    data = timed(report, 'read', read_table, args.input, args.input_format)
+    corrected_data = timed(report,
+                           'correct',
+                           correct_depth_offset,
+                           data,
+                           window=args.window,
+                           columns=get_columns(args),
+                           aux_file=args.aux_file,
+                           method=args.method,
+                           surface_threshold=args.surface_threshold,
+                           encoding=args.encoding)
+    report['rows'] = {'input': len(data), 'output': len(corrected_data)}
+    timed(report, 'write', write_table, corrected_data, args.output,
+          args.format, args.encoding)
+
+
+def run_detect(args, report):
+    """
+    Detects the dive starts in the input data.
+    """
+    data = timed(report, 'read', read_table, args.input, args.input_format)
+    starts = timed(report,
+                   'detect',
+                   get_dive_starting_points,
+                   data,
+                   args.dive_detection_sensitivity,
+                   is_surfacing_animal=not args.deep,
+                   minimal_time_between_dives=args.minimal_time_between_dives,
+                   surface_threshold=args.surface_threshold,
+                   columns=get_columns(args))
+    report['rows'] = {'input': len(data), 'output': len(starts)}
+    timed(report, 'write', write_table, starts, args.output, args.format,
+          args.encoding)
+
+
+def run_profile(args, report):
+    """
+    Profiles the dives in the input data. With more than one job the data is
+    split at gaps and the segments are profiled in parallel.
+    """
+    data = timed(report, 'read', read_table, args.input, args.input_format)
+    kwargs = {
+        'columns': get_columns(args),
+        'is_surfacing_animal': not args.deep,
+        'dive_detection_sensitivity': args.dive_detection_sensitivity,
+        'minimal_time_between_dives': args.minimal_time_between_dives,
+        'surface_threshold': args.surface_threshold,
+        'at_depth_threshold': args.at_depth_threshold,
+        'checkpoint_folder': args.checkpoint,
+        'checkpoint_batch_size': args.checkpoint_batch_size,
+        'features': args.features.split(',') if args.features else None
+    }
+    if args.jobs != 1 or args.gap_threshold is not None:
+        dives, insufficient_dives, data = timed(
+            report, 'profile', profile_segments, data,
+            gap_threshold=args.gap_threshold, n_jobs=args.jobs, **kwargs)
+    else:
+        dives, insufficient_dives, data = timed(report, 'profile',
+                                                profile_dives, data, **kwargs)
+    report['rows'] = {
+        'input': len(data),
+        'output': len(dives),
+        'insufficient': 0 if insufficient_dives is None
+        else len(insufficient_dives)
+    }
+    timed(report, 'write', write_table, dives, args.output, args.format,
+          args.encoding)
+    if args.insufficient_output and insufficient_dives is not None:
+        write_table(insufficient_dives, args.insufficient_output, args.format,
+                    args.encoding)
+
+
+def run_cluster(args, report):
+    """
+    Clusters profiled dives.
+    """
+    dives = timed(report, 'read', read_table, args.input, args.input_format)
+    attributes = args.attributes.split(',') if args.attributes else None
+    dives, loadings, pca_output_matrix = timed(
+        report,
+        'cluster',
+        cluster_dives,
+        dives,
+        pca_components=args.pca_components,
+        n_clusters=args.n_clusters,
+        attributes=attributes)
+    report['rows'] = {'input': len(dives), 'output': len(dives)}
+    timed(report, 'write', write_table, dives, args.output, args.format,
+          args.encoding)
+    if args.loadings_output:
+        write_table(loadings, args.loadings_output, args.format,
+                    args.encoding)
+    if args.pca_output:
+        write_table(pca_output_matrix, args.pca_output, args.format,
+                    args.encoding)
+
+
+def run_export(args, report):
+    """
+    Exports clustered dives and their data to a results folder.
+    """
+    dives = timed(report, 'read', read_table, args.dives, args.input_format)
+    loadings = read_table(args.loadings, args.input_format)
+    pca_output_matrix = read_table(args.pca_output, args.input_format)
+    insufficient_dives = None
+    if args.insufficient:
+        insufficient_dives = read_table(args.insufficient, args.input_format)
+
+    if args.format == 'csv':
+        timed(report, 'export', export_to_csv, args.folder, dives, loadings,
+              pca_output_matrix, insufficient_dives,
+              mode='a' if args.append else 'w')
+    else:
+        data = read_table(args.data, args.input_format)
+        data = divebomb.clean_dive_data(data, columns=get_columns(args))
+        timed(report, 'export', export_to_netcdf, args.folder, data, dives,
+              loadings, pca_output_matrix, insufficient_dives,
+              encoding=args.encoding, mode='a' if args.append else 'w')
+    report['rows'] = {'input': len(dives), 'output': len(dives)}
+
+
+def run_report(args, report):
+    """
+    Writes the HTML pages of the dives of a results folder.
+    """
+    clusters = None
+    if args.clusters:
+        clusters = [int(cluster) for cluster in args.clusters.split(',')]
+    pages = timed(report, 'report', export_html_report, args.folder,
+                  output_folder=args.output, clusters=clusters,
+                  sample_size=args.sample,
+                  type='deepdive' if args.deep else 'dive',
+                  n_jobs=args.jobs, random_state=args.seed,
+                  at_depth_threshold=args.at_depth_threshold,
+                  max_points=args.max_points)
+    report['rows'] = {'input': len(pages), 'output': len(pages)}
+
+
+def run_serve(args, report):
+    """
+    Runs the ingest service until it is interrupted. With more than one job
+    the dives are profiled in worker processes.
+    """
+    executor = None
+    if args.jobs != 1:
+        executor = ProcessPoolExecutor(
+            max_workers=args.jobs if args.jobs > 0 else None,
+            mp_context=multiprocessing.get_context('spawn'))
+    service = IngestService(
+        is_surfacing_animal=not args.deep,
+        dive_detection_sensitivity=args.dive_detection_sensitivity,
+        minimal_time_between_dives=args.minimal_time_between_dives,
+        surface_threshold=args.surface_threshold,
+        at_depth_threshold=args.at_depth_threshold,
+        features=args.features.split(',') if args.features else None,
+        model=pd.read_pickle(args.model) if args.model else None,
+        executor=executor)
+    print('Listening on http://%s:%d' % (args.host, args.port))
+    timed(report, 'serve', service.serve, args.host, args.port)
+    report['rows'] = {'tags': len(service.tags),
+                      'output': sum(state.dives
+                                    for state in service.tags.values())}
+
+
+def timed(report, step, function, *args, **kwargs):
+    """
+    Runs a function and records how long it took in the report.
+
+    :param report: the run report dictionary
+    :param step: the name of the step
+    :param function: the function to run
+
+    :return: the result of the function
+    """
+    start = time.time()
+    result = function(*args, **kwargs)
+    report['timings'][step] = time.time() - start
+    return result
+
+
+def add_detection_arguments(parser):
+    """
+    Adds the dive detection arguments to a parser.
+    """
+    parser.add_argument('--deep', action='store_true',
+                        help='the animal does not surface between dives')
+    parser.add_argument('--dive-detection-sensitivity', type=float,
+                        default=None)
+    parser.add_argument('--minimal-time-between-dives', type=float,
+                        default=120)
+    parser.add_argument('--surface-threshold', type=float, default=0)
+
+
+def get_parser():
+    """
+    :return: the argument parser for the ``divebomb`` command
+    """
+    parser = argparse.ArgumentParser(
+        prog='divebomb', description='divebomb dive classification')
+    parser.add_argument('--version', action='version',
+                        version=divebomb.__version__)
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='the number of processes to use')
+    parser.add_argument('--format', choices=formats, default=None,
+                        help='the output format, inferred from the output '
+                        'file extension if not provided')
+    parser.add_argument('--input-format', choices=formats, default=None,
+                        help='the input format, inferred from the input file '
+                        'extension if not provided')
+    parser.add_argument('--encoding', choices=list(encoding_presets),
+                        default='default',
+                        help='the netCDF encoding preset, speed writes faster '
+                        'and size writes smaller files')
+    parser.add_argument('--report', default=None,
+                        help='write a JSON run report with timings to this '
+                        'file, - for stderr')
+    parser.add_argument('--time-column', default='time')
+    parser.add_argument('--depth-column', default='depth')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    correct = subparsers.add_parser('correct',
+                                    help='correct the depth offset')
+    correct.add_argument('input', help='the input data, - for stdin')
+    correct.add_argument('output', help='the output file, - for stdout')
+    correct.add_argument('--window', type=int, default=3600)
+    correct.add_argument('--method', choices=['max', 'mean'], default='max')
+    correct.add_argument('--surface-threshold', type=float, default=4)
+    correct.add_argument('--aux-file',
+                         default='corrected_depth_auxillary_data.nc')
+    correct.set_defaults(function=run_correct)
+
+    detect = subparsers.add_parser('detect', help='detect the dive starts')
+    detect.add_argument('input', help='the input data, - for stdin')
+    detect.add_argument('output', help='the output file, - for stdout')
+    add_detection_arguments(detect)
+    detect.set_defaults(function=run_detect)
+
+    profile = subparsers.add_parser('profile', help='profile the dives')
+    profile.add_argument('input', help='the input data, - for stdin')
+    profile.add_argument('output', help='the output file, - for stdout')
+    add_detection_arguments(profile)
+    profile.add_argument('--at-depth-threshold', type=float, default=0.15)
+    profile.add_argument('--gap-threshold', type=float, default=None,
+                         help='split the data at gaps longer than this many '
+                         'seconds')
+    profile.add_argument('--insufficient-output', default=None)
+    profile.add_argument('--checkpoint', default=None,
+                         help='save the profiles to this folder in batches, '
+                         'an interrupted run started again with the same '
+                         'folder skips the saved batches')
+    profile.add_argument('--checkpoint-batch-size', type=int, default=1000)
+    profile.add_argument('--features', default=None,
+                         help='a comma separated list of the features to '
+                         'compute, such as the cluster attributes, the other '
+                         'costly features are skipped')
+    profile.set_defaults(function=run_profile)
+
+    cluster = subparsers.add_parser('cluster', help='cluster profiled dives')
+    cluster.add_argument('input', help='the profiled dives, - for stdin')
+    cluster.add_argument('output', help='the output file, - for stdout')
+    cluster.add_argument('--pca-components', type=int, default=8)
+    cluster.add_argument('--n-clusters', type=int, default=None)
+    cluster.add_argument('--attributes', default=None,
+                         help='a comma separated list of attributes')
+    cluster.add_argument('--loadings-output', default=None)
+    cluster.add_argument('--pca-output', default=None)
+    cluster.set_defaults(function=run_cluster)
+
+    export = subparsers.add_parser('export',
+                                   help='export clustered dives to a folder')
+    export.add_argument('folder', help='the results folder')
+    export.add_argument('--dives', required=True)
+    export.add_argument('--loadings', required=True)
+    export.add_argument('--pca-output', required=True)
+    export.add_argument('--insufficient', default=None)
+    export.add_argument('--data', default=None,
+                        help='the original data, needed for netCDF exports')
+    export.add_argument('--append', action='store_true',
+                        help='add the dives to a previous export instead of '
+                        'overwriting the folder')
+    export.set_defaults(function=run_export)
+
+    html_report = subparsers.add_parser(
+        'report', help='write an HTML page of each dive of a results folder')
+    html_report.add_argument('folder', help='the results folder')
+    html_report.add_argument('--output', default=None,
+                             help='the report folder, defaults to a report '
+                             'folder in the results folder')
+    html_report.add_argument('--clusters', default=None,
+                             help='a comma separated list of clusters')
+    html_report.add_argument('--sample', type=int, default=None,
+                             help='the number of dives picked at random '
+                             'from each cluster')
+    html_report.add_argument('--seed', type=int, default=None)
+    html_report.add_argument('--deep', action='store_true',
+                             help='plot the dives as deep dives')
+    html_report.add_argument('--at-depth-threshold', type=float,
+                             default=0.15)
+    html_report.add_argument('--max-points', type=int, default=None,
+                             help='the maximum number of points per phase')
+    html_report.set_defaults(function=run_report)
+
+    serve = subparsers.add_parser(
+        'serve', help='profile the dives of depth samples sent over HTTP')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8080)
+    add_detection_arguments(serve)
+    serve.add_argument('--at-depth-threshold', type=float, default=0.15)
+    serve.add_argument('--features', default=None,
+                       help='a comma separated list of the features to '
+                       'compute')
+    serve.add_argument('--model', default=None,
+                       help='a pickled model from fit_incremental_clusters '
+                       'to assign the clusters of the dives')
+    serve.set_defaults(function=run_serve)
+    return parser
+
+
+def main(argv=None):
+    """
+    The entry point of the ``divebomb`` command.
+
+    :param argv: the command line arguments, defaults to ``sys.argv``
+    """
+    args = get_parser().parse_args(argv)
+    if args.command == 'export' and args.format is None:
+        args.format = 'netcdf'
+    if args.command == 'export' and args.format not in ['csv', 'netcdf']:
+        sys.exit('divebomb export only supports the csv and netcdf formats')
+    if args.command == 'export' and args.format == 'netcdf' and \
+            args.data is None:
+        sys.exit('divebomb export needs --data for netCDF exports')
+
+    report = {
+        'command': args.command,
+        'arguments': {
+            key: value
+            for key, value in vars(args).items() if key != 'function'
+        },
+        'version': divebomb.__version__,
+        'python': platform.python_version(),
+        'timings': {}
+    }
+    start = time.time()
+    args.function(args, report)
+    report['timings']['total'] = time.time() - start
+
+    if args.report == '-':
+        json.dump(report, sys.stderr, indent=2)
+        sys.stderr.write('\n')
+    elif args.report is not None:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
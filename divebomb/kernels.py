@@ -0,0 +1,271 @@
+import os
+import warnings
+
+import numpy as np
+import peakutils as pku
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+backends = ['numpy', 'numba']
+
+
+def _expanding_std_loop(values):
+    out = np.empty(values.size)
+    first = values[0] if values.size else 0.0
+    sum_1 = 0.0
+    sum_2 = 0.0
+    for i in range(values.size):
+        value = values[i] - first
+        sum_1 += value
+        sum_2 += value * value
+        variance = (sum_2 - sum_1 * sum_1 / (i + 1)) / (i + 1)
+        if variance < 0:
+            variance = 0.0
+        out[i] = np.sqrt(variance)
+    return out
+
+
+def _expanding_std_numpy(values):
+    if not values.size:
+        return np.empty(0)
+    shifted = values - values[0]
+    n = np.arange(1, values.size + 1)
+    sum_1 = np.cumsum(shifted)
+    sum_2 = np.cumsum(shifted * shifted)
+    variance = (sum_2 - sum_1 * sum_1 / n) / n
+    variance[variance < 0] = 0.0
+    return np.sqrt(variance)
+
+
+def _find_crest_loop(depth, surface_threshold):
+    for i in range(depth.size - 1, 0, -1):
+        if depth[i - 1] > surface_threshold:
+            return i
+    return -1
+
+
+def _find_crest_numpy(depth, surface_threshold):
+    below_surface = np.flatnonzero(depth[:-1] > surface_threshold)
+    if not len(below_surface):
+        return -1
+    return below_surface[-1] + 1
+
+
+def _find_bottom_start_loop(candidates, depth, cut):
+    for i in range(depth.size - 1):
+        if candidates[i] and depth[i] > cut:
+            return i
+    return depth.size - 1
+
+
+def _find_bottom_start_numpy(candidates, depth, cut):
+    bottom = candidates & (depth > cut)
+    bottom[-1] = True
+    return np.argmax(bottom)
+
+
+def _find_bottom_end_loop(candidates, depth, end_index, cut, deep_cut):
+    for i in range(end_index - 1, 0, -1):
+        if (candidates[i] and depth[i] > cut) or depth[i] > deep_cut:
+            return i
+    if not candidates[0]:
+        return -2
+    if depth[0] > cut or depth[0] > deep_cut:
+        return 0
+    return -1
+
+
+def _find_bottom_end_numpy(candidates, depth, end_index, cut, deep_cut):
+    bottom = (candidates & (depth[:end_index] > cut)) | \
+        (depth[:end_index] > deep_cut)
+    hits = np.flatnonzero(bottom[1:])
+    if len(hits):
+        return hits[-1] + 1
+    if not candidates[0]:
+        return -2
+    if bottom[0]:
+        return 0
+    return -1
+
+
+def _suppress_peaks_loop(peaks, order, min_dist):
+    removed = np.zeros(peaks.size, dtype=np.bool_)
+    kept = np.zeros(peaks.size, dtype=np.bool_)
+    for i in order:
+        if not removed[i]:
+            j = i
+            while j >= 0 and peaks[i] - peaks[j] <= min_dist:
+                removed[j] = True
+                j -= 1
+            j = i + 1
+            while j < peaks.size and peaks[j] - peaks[i] <= min_dist:
+                removed[j] = True
+                j += 1
+            kept[i] = True
+    return kept
+
+
+def _suppress_peaks_numpy(peaks, order, min_dist):
+    removed = np.zeros(peaks.size, dtype=bool)
+    kept = np.zeros(peaks.size, dtype=bool)
+    for i in order:
+        if not removed[i]:
+            low = np.searchsorted(peaks, peaks[i] - min_dist, 'left')
+            high = np.searchsorted(peaks, peaks[i] + min_dist, 'right')
+            removed[low:high] = True
+            kept[i] = True
+    return kept
+
+
+_kernels = {
+    'numpy': {
+        'expanding_std': _expanding_std_numpy,
+        'find_crest': _find_crest_numpy,
+        'find_bottom_start': _find_bottom_start_numpy,
+        'find_bottom_end': _find_bottom_end_numpy,
+        'suppress_peaks': _suppress_peaks_numpy
+    }
+}
+
+if numba is not None:
+    _kernels['numba'] = {
+        'expanding_std': numba.njit(cache=True)(_expanding_std_loop),
+        'find_crest': numba.njit(cache=True)(_find_crest_loop),
+        'find_bottom_start': numba.njit(cache=True)(_find_bottom_start_loop),
+        'find_bottom_end': numba.njit(cache=True)(_find_bottom_end_loop),
+        'suppress_peaks': numba.njit(cache=True)(_suppress_peaks_loop)
+    }
+
+_backend = 'numba' if numba is not None else 'numpy'
+
+
+def set_backend(backend):
+    """
+    Selects the implementation of the per sample loops used to profile the
+    dives and detect the peaks. Both backends give identical results.
+
+    :param backend: either ``numpy`` or ``numba``, ``numba`` compiles the loops
+        and needs numba to be installed
+    """
+    global _backend
+    if backend not in backends:
+        raise ValueError('backend must be one of %s' % ', '.join(backends))
+    if backend not in _kernels:
+        raise ImportError('numba is needed for the numba backend')
+    _backend = backend
+
+
+# The environment variable is checked like set_backend(), an unknown or
+# unavailable backend keeps the default instead of stopping the import
+if os.environ.get('DIVEBOMB_BACKEND'):
+    try:
+        set_backend(os.environ['DIVEBOMB_BACKEND'])
+    except (ValueError, ImportError) as e:
+        warnings.warn('DIVEBOMB_BACKEND is ignored, %s, using the %s backend'
+                      % (e, _backend))
+
+
+def get_backend():
+    """
+    :return: the name of the backend in use, ``numpy`` or ``numba``
+    """
+    return _backend
+
+
+def _get_kernel(name):
+    return _kernels[get_backend()][name]
+
+
+def expanding_std(values):
+    """
+    :param values: a numpy array
+
+    :return: the population standard deviation of the values from the first
+        value up to each value
+    """
+    return _get_kernel('expanding_std')(
+        np.ascontiguousarray(values, dtype=np.float64))
+
+
+def find_crest(depth, surface_threshold=0):
+    """
+    :param depth: the depths of the dive
+    :param surface_threshold: the depth at which the animal is at the surface
+
+    :return: the index of the point after the last point below the surface,
+        ``-1`` if the animal never leaves the surface
+    """
+    return int(_get_kernel('find_crest')(
+        np.ascontiguousarray(depth, dtype=np.float64),
+        float(surface_threshold)))
+
+
+def find_bottom_start(candidates, depth, cut):
+    """
+    :param candidates: a boolean array of the possible bottom starts
+    :param depth: the depths of the dive
+    :param cut: the depth the bottom start has to be deeper than
+
+    :return: the index of the first candidate deeper than ``cut``, the last
+        index if there is none
+    """
+    return int(_get_kernel('find_bottom_start')(
+        np.ascontiguousarray(candidates, dtype=bool),
+        np.ascontiguousarray(depth, dtype=np.float64), float(cut)))
+
+
+def find_bottom_end(candidates, depth, end_index, cut, deep_cut):
+    """
+    :param candidates: a boolean array of the possible bottom ends before
+        ``end_index``
+    :param depth: the depths of the dive
+    :param end_index: the index of the crest of the ascent
+    :param cut: the depth a candidate has to be deeper than
+    :param deep_cut: the depth past which any point is at the bottom
+
+    :return: the index of the last point of the bottom, ``-1`` if there is
+        none and ``-2`` if the first point would have to be compared to the
+        point before it
+    """
+    return int(_get_kernel('find_bottom_end')(
+        np.ascontiguousarray(candidates, dtype=bool),
+        np.ascontiguousarray(depth, dtype=np.float64), int(end_index),
+        float(cut), float(deep_cut)))
+
+
+def suppress_peaks(peaks, heights, min_dist):
+    """
+    :param peaks: the sorted indices of the peaks
+    :param heights: the values of the signal at the peaks
+    :param min_dist: the minimum distance in samples between two peaks
+
+    :return: the indices of the peaks that are kept, favouring the highest
+        peaks when two are closer than ``min_dist``
+    """
+    peaks = np.ascontiguousarray(peaks, dtype=np.int64)
+    min_dist = int(min_dist)
+    if peaks.size < 2 or min_dist <= 1:
+        return peaks
+    order = np.ascontiguousarray(np.argsort(heights)[::-1])
+    return peaks[_get_kernel('suppress_peaks')(peaks, order, min_dist)]
+
+
+def peak_indexes(y, thres=0.3, min_dist=1, thres_abs=False):
+    """
+    Finds the same peaks as ``peakutils.indexes()`` with the minimum distance
+    rule applied by the selected backend.
+
+    :param y: the signal
+    :param thres: the threshold, normalized between 0 and 1 unless
+        ``thres_abs`` is set
+    :param min_dist: the minimum distance in samples between two peaks
+    :param thres_abs: whether ``thres`` is an absolute value
+
+    :return: an array of the indices of the peaks
+    """
+    y = np.asarray(y)
+    peaks = pku.indexes(y, thres=thres, min_dist=1, thres_abs=thres_abs)
+    return suppress_peaks(peaks, y[peaks], min_dist)
@@ -1,11 +1,164 @@
+import html
 import os
+from concurrent.futures import ProcessPoolExecutor
 
 import colorlover as cl
+import numpy as np
 import pandas as pd
 import plotly.graph_objs as go
 import plotly.offline as py
+from plotly.io.json import to_json_plotly
 import xarray as xr
-from netCDF4 import Dataset, num2date
+from netCDF4 import Dataset
+
+from divebomb.DepthPyramid import DepthPyramid
+from divebomb.DiveArchive import get_dive_archive
+from divebomb.preprocessing import datetime_to_num, num_to_datetime
+
+# Traces with more points than this are drawn with WebGL
+webgl_threshold = 1000
+
+# The plotly.js bundle and layout template shared by the pages of a report
+plotlyjs_filename = 'plotly.min.js'
+template_filename = 'template.js'
+
+report_page = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>%(title)s</title>
+<script src="../%(plotlyjs)s"></script>
+<script src="../%(template)s"></script>
+</head>
+<body>
+<div id="dive" style="height:95vh"></div>
+<script>
+var figure = %(figure)s;
+figure.layout.template = template;
+Plotly.newPlot('dive', figure.data, figure.layout, {responsive: true});
+</script>
+</body>
+</html>
+'''
+
+
+def downsample_lttb(x, y, max_points):
+    """
+    Downsamples a line with the Largest-Triangle-Three-Buckets algorithm,
+    which keeps the points that preserve the visual shape of the line.
+
+    :param x: a numpy array of the x values, sorted
+    :param y: a numpy array of the y values
+    :param max_points: the number of points to keep
+
+    :return: the indices of the points to keep
+    """
+    n = len(x)
+    if max_points >= n or max_points < 3:
+        return np.arange(n)
+
+    every = (n - 2) / (max_points - 2)
+    edges = (np.arange(max_points - 1) * every).astype(int) + 1
+    edges = np.append(edges, n)
+
+    keep = np.zeros(max_points, dtype=int)
+    a = 0
+    for i in range(max_points - 2):
+        start, end = edges[i], edges[i + 1]
+        # The average of the next bucket, the last bucket is the last point
+        average_x = x[end:edges[i + 2]].mean()
+        average_y = y[end:edges[i + 2]].mean()
+
+        area = np.abs((x[a] - average_x) * (y[start:end] - y[a]) -
+                      (x[a] - x[start:end]) * (average_y - y[a]))
+        if not np.isnan(area).all():
+            a = start + np.nanargmax(area)
+        else:
+            a = start
+        keep[i + 1] = a
+
+    keep[-1] = n - 1
+    return keep
+
+
+def downsample_minmax(y, max_points):
+    """
+    Downsamples a line by keeping the minimum and maximum of evenly sized
+    bins, which keeps every spike in the line.
+
+    :param y: a numpy array of the y values
+    :param max_points: the number of points to keep
+
+    :return: the indices of the points to keep
+    """
+    n = len(y)
+    bins = max(max_points // 2, 1)
+    if max_points >= n:
+        return np.arange(n)
+
+    width = int(np.ceil(n / bins))
+    padded = np.full(bins * width, np.nan)
+    padded[:n] = y
+    padded = padded.reshape(bins, width)
+    has_values = ~np.isnan(padded).all(axis=1)
+    padded = padded[has_values]
+    offsets = np.flatnonzero(has_values) * width
+    keep = np.concatenate([offsets + np.nanargmin(padded, axis=1),
+                           offsets + np.nanargmax(padded, axis=1)])
+    return np.unique(keep)
+
+
+def downsample(x, y, max_points=None, method='lttb'):
+    """
+    :param x: the x values of the line
+    :param y: the y values of the line
+    :param max_points: the maximum number of points to keep, ``None`` keeps
+        every point
+    :param method: either ``lttb`` or ``minmax``
+
+    :return: the downsampled x and y values as numpy arrays
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if max_points is None or len(x) <= max_points:
+        return x, y
+    if method == 'minmax':
+        keep = downsample_minmax(y, max_points)
+    else:
+        keep = downsample_lttb(x, y, max_points)
+    return x[keep], y[keep]
+
+
+def get_phase_trace(time,
+                    depth,
+                    name,
+                    units,
+                    mode='lines',
+                    max_points=None,
+                    method='lttb'):
+    """
+    Builds the plotly trace for a phase of a dive. The phase is downsampled
+    before the times are converted and WebGL is used for large traces, so
+    the size of the figure is bounded by ``max_points``.
+
+    :param time: the times of the phase in ``units``
+    :param depth: the depths of the phase
+    :param name: the name of the trace
+    :param units: the time units, e.g. ``seconds since 1970-01-01``
+    :param mode: the plotly scatter mode
+    :param max_points: the maximum number of points in the trace, ``None``
+        keeps every point
+    :param method: the downsampling method, either ``lttb`` or ``minmax``
+
+    :return: a plotly ``Scatter`` or ``Scattergl`` trace
+    """
+    time, depth = downsample(time, depth, max_points, method)
+    trace = go.Scattergl if len(time) > webgl_threshold else go.Scatter
+    return trace(
+        x=num_to_datetime(time, units=units),
+        y=depth,
+        mode=mode,
+        name=name)
 
 
 def plot_from_nc(folder,
@@ -14,7 +167,9 @@ def plot_from_nc(folder,
                  ipython_display=True,
                  type='dive',
                  filename='index.html',
-                 at_depth_threshold=0.15):
+                 at_depth_threshold=0.15,
+                 max_points=None,
+                 downsample_method='lttb'):
     """
     :param folder: the path to the results folder contianing the cluster
         folders
@@ -27,16 +182,53 @@ def plot_from_nc(folder,
         notebook
     :param at_depth_threshold: a value from 0 - 1 indicating distance from the
         bottom of the dive at which the animal is considered to be at depth
+    :param max_points: the maximum number of points per phase, ``None``
+        plots every point
+    :param downsample_method: either ``lttb`` or ``minmax``
 
     :return: a plotly line chart of the dive
 
     """
     if type == 'deepdive':
         return plot_deepdive_from_nc(folder, cluster, dive_id, ipython_display,
-                                     filename, at_depth_threshold)
+                                     filename, at_depth_threshold,
+                                     max_points=max_points,
+                                     downsample_method=downsample_method)
     else:
         return plot_dive_from_nc(folder, cluster, dive_id, ipython_display,
-                                 filename)
+                                 filename, max_points=max_points,
+                                 downsample_method=downsample_method)
+
+
+def get_figure_from_nc(folder,
+                       cluster,
+                       dive_id,
+                       type='dive',
+                       at_depth_threshold=0.15,
+                       max_points=None,
+                       downsample_method='lttb'):
+    """
+    :param folder: the path to the results folder contianing the cluster
+        folders
+    :param cluster: the number of the cluster of the dive
+    :param dive_id: the number of of the dive
+    :param type: a string of either either ``dive`` or ``deepdive``
+    :param at_depth_threshold: a value from 0 - 1 indicating distance from the
+        bottom of the dive at which the animal is considered to be at depth
+    :param max_points: the maximum number of points per phase, ``None``
+        plots every point
+    :param downsample_method: either ``lttb`` or ``minmax``
+
+    :return: a plotly ``Figure`` of the dive
+    """
+    if type == 'deepdive':
+        return get_deepdive_figure_from_nc(
+            folder, cluster, dive_id, at_depth_threshold,
+            max_points=max_points, downsample_method=downsample_method)
+    else:
+        return get_dive_figure_from_nc(folder, cluster, dive_id,
+                                       max_points=max_points,
+                                       downsample_method=downsample_method)
 
 
 def plot_dive_from_nc(folder,
@@ -45,7 +237,9 @@ def plot_dive_from_nc(folder,
                       ipython_display=True,
                       filename='index.html',
                       at_depth_threshold=0.15,
-                      title='Clusters'):
+                      title='Clusters',
+                      max_points=None,
+                      downsample_method='lttb'):
     """
     :param folder: the path to the results folder contianing the cluster
         folders
@@ -58,68 +252,89 @@ def plot_dive_from_nc(folder,
     :param at_depth_threshold: a value from 0 - 1 indicating distance from the
         bottom of the dive at which the animal is considered to be at depth
     :param title: string title of plot
+    :param max_points: the maximum number of points per phase, ``None``
+        plots every point
+    :param downsample_method: either ``lttb`` or ``minmax``
 
     :return: a plotly line chart of the dive
 
     """
-    dive_file = '%s/cluster_%d/dive_%05d.nc' % (folder, cluster, dive_id)
-    rootgrp = Dataset(dive_file)
-    data = pd.DataFrame()
-    data['time'] = rootgrp.variables['time'][:]
-    data['depth'] = rootgrp.variables['depth'][:]
+    fig = get_dive_figure_from_nc(folder, cluster, dive_id,
+                                  at_depth_threshold=at_depth_threshold,
+                                  title=title, max_points=max_points,
+                                  downsample_method=downsample_method)
+
+    if ipython_display:
+        py.init_notebook_mode()
+        return py.iplot(fig)
+    else:
+        return py.plot(fig, filename=filename)
+
+
+def get_dive_figure_from_nc(folder,
+                            cluster,
+                            dive_id,
+                            at_depth_threshold=0.15,
+                            title='Clusters',
+                            max_points=None,
+                            downsample_method='lttb'):
+    """
+    :param folder: the path to the results folder contianing the cluster
+        folders
+    :param cluster: the number of the cluster of the dive
+    :param dive_id: the number of of the dive
+    :param at_depth_threshold: a value from 0 - 1 indicating distance from the
+        bottom of the dive at which the animal is considered to be at depth
+    :param title: string title of plot
+    :param max_points: the maximum number of points per phase, ``None``
+        plots every point
+    :param downsample_method: either ``lttb`` or ``minmax``
+
+    :return: a plotly ``Figure`` of the dive split into its phases
+    """
+    dive = get_dive_archive(folder).read_dive(cluster, dive_id)
+    attributes = dive['attributes']
+    data = pd.DataFrame({'time': dive['time'], 'depth': dive['depth']})
+    units = attributes['time_units']
 
     # Get and set the surface data
     surface_data = data[data.time >= (
-        data.time.max() - rootgrp.td_surface_duration)]
+        data.time.max() - attributes['td_surface_duration'])]
 
-    surface = go.Scatter(
-        x=num2date(surface_data.time.tolist(), units=rootgrp.time_units),
-        y=surface_data.depth,
-        mode='lines',
-        name='Surface')
+    surface = get_phase_trace(surface_data.time, surface_data.depth, 'Surface',
+                              units, max_points=max_points,
+                              method=downsample_method)
 
     # Get and set the bottom data
-    bottom_data = data[(data.time >= rootgrp.bottom_start) & (
-        data.time <= (rootgrp.bottom_start + rootgrp.td_bottom_duration))]
-    bottom = go.Scatter(
-        x=num2date(bottom_data.time.tolist(), units=rootgrp.time_units),
-        y=bottom_data.depth,
-        mode='lines',
-        name='Bottom')
+    bottom_end = attributes['bottom_start'] + attributes['td_bottom_duration']
+    bottom_data = data[(data.time >= attributes['bottom_start'])
+                       & (data.time <= bottom_end)]
+    bottom = get_phase_trace(bottom_data.time, bottom_data.depth, 'Bottom',
+                             units, max_points=max_points,
+                             method=downsample_method)
 
     descent_data = data[data.time <= bottom_data.time.min()]
-    descent = go.Scatter(
-        x=num2date(descent_data.time.tolist(), units=rootgrp.time_units),
-        y=descent_data.depth,
-        mode='lines',
-        name='Descent')
+    descent = get_phase_trace(descent_data.time, descent_data.depth, 'Descent',
+                              units, max_points=max_points,
+                              method=downsample_method)
 
     # Get and set the ascent data
     ascent_data = data[
         (data.time >= bottom_data.time.max()) &
         (data.time <= surface_data.time.min())
     ]
-    ascent = go.Scatter(
-        x=num2date(ascent_data.time.tolist(), units=rootgrp.time_units),
-        y=ascent_data.depth,
-        mode='lines',
-        name='Ascent')
+    ascent = get_phase_trace(ascent_data.time, ascent_data.depth, 'Ascent',
+                             units, max_points=max_points,
+                             method=downsample_method)
 
     layout = go.Layout(
-        title='Dive {} from Cluster {}'.format(rootgrp.dive_id,
-                                               rootgrp.cluster),
+        title='Dive {} from Cluster {}'.format(attributes['dive_id'],
+                                               attributes['cluster']),
         xaxis=dict(title='Time'),
         yaxis=dict(title='Depth in Meters', autorange='reversed'))
-    rootgrp.close()
 
     plot_data = [descent, bottom, ascent, surface]
-    fig = go.Figure(data=plot_data, layout=layout)
-
-    if ipython_display:
-        py.init_notebook_mode()
-        return py.iplot(fig)
-    else:
-        return py.plot(fig, filename=filename)
+    return go.Figure(data=plot_data, layout=layout)
 
 
 def plot_deepdive_from_nc(folder,
@@ -127,7 +342,9 @@ def plot_deepdive_from_nc(folder,
                           dive_id,
                           ipython_display=True,
                           filename='index.html',
-                          at_depth_threshold=0.15):
+                          at_depth_threshold=0.15,
+                          max_points=None,
+                          downsample_method='lttb'):
     """
     :param folder: the path to the results folder contianing the cluster
         folders
@@ -139,16 +356,47 @@ def plot_deepdive_from_nc(folder,
         notebook
     :param at_depth_threshold: a value from 0 - 1 indicating distance from the
         bottom of the dive at which the animal is considered to be at depth
+    :param max_points: the maximum number of points per phase, ``None``
+        plots every point
+    :param downsample_method: either ``lttb`` or ``minmax``
 
     :return: a plotly line chart of the dive
 
     """
-    dive_file = '%s/cluster_%d/dive_%05d.nc' % (folder, cluster, dive_id)
-    rootgrp = Dataset(dive_file)
-    data = pd.DataFrame()
-    data['time'] = rootgrp.variables['time'][:]
-    data['depth'] = rootgrp.variables['depth'][:]
-    units = rootgrp.variables['time'].units
+    fig = get_deepdive_figure_from_nc(folder, cluster, dive_id,
+                                      at_depth_threshold=at_depth_threshold,
+                                      max_points=max_points,
+                                      downsample_method=downsample_method)
+    if ipython_display:
+        py.init_notebook_mode()
+        return py.iplot(fig)
+    else:
+        return py.plot(fig, filename=filename)
+
+
+def get_deepdive_figure_from_nc(folder,
+                                cluster,
+                                dive_id,
+                                at_depth_threshold=0.15,
+                                max_points=None,
+                                downsample_method='lttb'):
+    """
+    :param folder: the path to the results folder contianing the cluster
+        folders
+    :param cluster: the number of the cluster of the dive
+    :param dive_id: the number of of the dive
+    :param at_depth_threshold: a value from 0 - 1 indicating distance from the
+        bottom of the dive at which the animal is considered to be at depth
+    :param max_points: the maximum number of points per phase, ``None``
+        plots every point
+    :param downsample_method: either ``lttb`` or ``minmax``
+
+    :return: a plotly ``Figure`` of the dive split into its phases
+    """
+    dive = get_dive_archive(folder).read_dive(cluster, dive_id)
+    attributes = dive['attributes']
+    data = pd.DataFrame({'time': dive['time'], 'depth': dive['depth']})
+    units = attributes['time_units']
     at_depth_data = data[data.depth > (data.depth.max() - (
         (data.depth.max() - data.depth.min()) * at_depth_threshold))]
     pre_depth_data = data[(data.depth < (data.depth.max() - (
@@ -158,41 +406,31 @@ def plot_deepdive_from_nc(folder,
         (data.depth.max() - data.depth.min()) * at_depth_threshold))) &
         (data.time >= at_depth_data.time.max())]
 
-    pre_depth_data = pre_depth_data.append(at_depth_data.head(1))
-    post_depth_data = post_depth_data.append(at_depth_data.tail(1))
+    pre_depth_data = pd.concat([pre_depth_data, at_depth_data.head(1)])
+    post_depth_data = pd.concat([post_depth_data, at_depth_data.tail(1)])
     post_depth_data.sort_values('time', inplace=True)
 
-    pre_depth = go.Scatter(
-        x=num2date(pre_depth_data.time.tolist(), units=units),
-        y=pre_depth_data.depth,
-        mode='lines+markers',
-        name='Pre Depth')
+    pre_depth = get_phase_trace(pre_depth_data.time, pre_depth_data.depth,
+                                'Pre Depth', units, mode='lines+markers',
+                                max_points=max_points,
+                                method=downsample_method)
 
-    at_depth = go.Scatter(
-        x=num2date(at_depth_data.time.tolist(), units=units),
-        y=at_depth_data.depth,
-        mode='lines+markers',
-        name='At Depth')
+    at_depth = get_phase_trace(at_depth_data.time, at_depth_data.depth,
+                               'At Depth', units, mode='lines+markers',
+                               max_points=max_points, method=downsample_method)
 
-    post_depth = go.Scatter(
-        x=num2date(post_depth_data.time.tolist(), units=units),
-        y=post_depth_data.depth,
-        mode='lines+markers',
-        name='Post Depth')
+    post_depth = get_phase_trace(post_depth_data.time, post_depth_data.depth,
+                                 'Post Depth', units, mode='lines+markers',
+                                 max_points=max_points,
+                                 method=downsample_method)
 
     layout = go.Layout(
-        title='Dive {} from Cluster {}'.format(rootgrp.dive_id,
-                                               rootgrp.cluster),
+        title='Dive {} from Cluster {}'.format(attributes['dive_id'],
+                                               attributes['cluster']),
         xaxis=dict(title='Time'),
         yaxis=dict(title='Depth in Meters', autorange='reversed'))
-    rootgrp.close()
     plot_data = [pre_depth, post_depth, at_depth]
-    fig = go.Figure(data=plot_data, layout=layout)
-    if ipython_display:
-        py.init_notebook_mode()
-        return py.iplot(fig)
-    else:
-        return py.plot(fig, filename=filename)
+    return go.Figure(data=plot_data, layout=layout)
 
 
 def cluster_summary_plot(folder,
@@ -216,10 +454,12 @@ def cluster_summary_plot(folder,
 
     """
 
-    dataset = xr.open_dataset(os.path.join(folder, 'all_profiled_dives.nc'))
-    df = dataset.to_dataframe().reset_index(drop=True)
+    with xr.open_dataset(os.path.join(folder,
+                                      'all_profiled_dives.nc')) as dataset:
+        df = dataset.load().to_dataframe().reset_index(drop=True)
+    if 'dive_id' not in df:
+        df['dive_id'] = df.index + 1
     df.sort_values('dive_start', inplace=True)
-    df['dive_id'] = df.index + 1
 
     xaxis = 'time'
     xaxis_title = 'Time in Seconds into Dive'
@@ -227,33 +467,28 @@ def cluster_summary_plot(folder,
     yaxis = 'depth'
     yaxis_title = 'Depth in Meters'
 
-    dive_data = pd.DataFrame()
-    for group, data in df.groupby('cluster'):
-        for index, row in data.iterrows():
-            dive_file = '%s/cluster_%d/dive_%05d.nc' % (folder, row.cluster,
-                                                        row.dive_id)
-            rootgrp = Dataset(dive_file)
-            single_dive_data = pd.DataFrame()
-            single_dive_data['depth'] = rootgrp.variables['depth'][:]
-            single_dive_data['time'] = rootgrp.variables['time'][:]
-            single_dive_data['time'] = single_dive_data['time'] - \
-                single_dive_data['time'].min()
-            if 'time' in scale.keys() and scale['time']:
-                single_dive_data['progress_into_dive'] = round(
-                    single_dive_data.time / single_dive_data.time.max() * 100,
-                    0)
-                xaxis = 'progress_into_dive'
-                xaxis_title = 'Progress Through Dive (%)'
-
-            if 'depth' in scale.keys() and scale['depth']:
-                single_dive_data['dive_relative_depth_percentage'] = round(
-                    single_dive_data.depth / single_dive_data.depth.max() *
-                    100, 0)
-                yaxis = 'dive_relative_depth_percentage'
-                yaxis_title = 'Depth (%) Relative to the Dive'
-            single_dive_data['cluster'] = rootgrp.cluster
-            dive_data = dive_data.append(single_dive_data)
-            rootgrp.close()
+    dives = get_dive_archive(folder).read_dives(df.cluster.astype(int),
+                                                 df.dive_id)
+    dive_data = []
+    for dive in dives:
+        single_dive_data = pd.DataFrame()
+        single_dive_data['depth'] = dive['depth']
+        single_dive_data['time'] = dive['time'] - dive['time'].min()
+        if 'time' in scale.keys() and scale['time']:
+            single_dive_data['progress_into_dive'] = round(
+                single_dive_data.time / single_dive_data.time.max() * 100, 0)
+            xaxis = 'progress_into_dive'
+            xaxis_title = 'Progress Through Dive (%)'
+
+        if 'depth' in scale.keys() and scale['depth']:
+            single_dive_data['dive_relative_depth_percentage'] = round(
+                single_dive_data.depth / single_dive_data.depth.max() * 100,
+                0)
+            yaxis = 'dive_relative_depth_percentage'
+            yaxis_title = 'Depth (%) Relative to the Dive'
+        single_dive_data['cluster'] = dive['attributes']['cluster']
+        dive_data.append(single_dive_data)
+    dive_data = pd.concat(dive_data, ignore_index=True)
 
     aggregated_data = dive_data.groupby([xaxis, 'cluster']).agg(
         ['min', 'mean', 'max', 'median', 'count']).reset_index(level=[0, 1])
@@ -310,3 +545,334 @@ def cluster_summary_plot(folder,
         return py.iplot(fig)
     else:
         return py.plot(fig, filename=filename)
+
+
+def get_phase_intervals(dives):
+    """
+    :param dives: a Pandas DataFrame of the profiled dives from
+        ``profile_dives()``, of surfacing or deep dives
+
+    :return: a dictionary of the name of each phase to the start and end
+        times of the phase in every dive
+    """
+    start = dives.dive_start.values
+    end = dives.dive_end.values
+    if 'bottom_start' in dives.columns:
+        bottom_start = dives.bottom_start.values
+        bottom_end = bottom_start + dives.td_bottom_duration.values
+        surface_start = end - dives.td_surface_duration.values
+        return {
+            'Descent': (start, bottom_start),
+            'Bottom': (bottom_start, bottom_end),
+            'Ascent': (bottom_end, surface_start),
+            'Surface': (surface_start, end)
+        }
+    at_depth_start = start + dives.td_time_pre_depth.values
+    at_depth_end = at_depth_start + dives.td_time_at_depth.values
+    return {
+        'Pre Depth': (start, at_depth_start),
+        'At Depth': (at_depth_start, at_depth_end),
+        'Post Depth': (at_depth_end, end)
+    }
+
+
+def get_band_trace(start, end, name, color, units):
+    """
+    Builds one filled trace of rectangles over the whole height of the plot,
+    so thousands of bands are drawn as a single trace instead of a layout
+    shape each.
+
+    :param start: the start times of the bands in ``units``
+    :param end: the end times of the bands in ``units``
+    :param name: the name of the trace
+    :param color: the ``rgb(...)`` color of the bands
+    :param units: the time units, e.g. ``seconds since 1970-01-01``
+
+    :return: a plotly ``Scatter`` trace on the ``y2`` axis
+    """
+    start = np.asarray(start, dtype=np.float64)
+    end = np.asarray(end, dtype=np.float64)
+    gaps = np.full(len(start), np.nan)
+    # Each band is a closed rectangle followed by a gap
+    x = np.column_stack([start, start, end, end, start, gaps]).ravel()
+    y = np.tile([0, 1, 1, 0, 0, np.nan], len(start))
+    return go.Scatter(
+        x=num_to_datetime(x, units=units),
+        y=y,
+        yaxis='y2',
+        fill='toself',
+        mode='none',
+        hoverinfo='name',
+        name=name,
+        fillcolor=color.replace(')', ',0.3)').replace('rgb', 'rgba'))
+
+
+def get_deployment_figure(pyramid,
+                          dives=None,
+                          color_by='cluster',
+                          time_range=None,
+                          max_points=2000,
+                          title='Deployment'):
+    """
+    Builds the overview figure of a whole deployment. The depth is read from
+    the coarsest level of the pyramid that still has ``max_points`` bins in
+    the shown range, and drawn as the band between the minimum and maximum
+    depth of each bin, or as a line once the samples themselves fit.
+
+    :param pyramid: a ``DepthPyramid`` or the folder it was saved in
+    :param dives: an optional Pandas DataFrame of the profiled dives, with
+        times in the units of the pyramid
+    :param color_by: ``cluster`` to color the dives by their ``cluster``
+        column or ``phase`` to color the phases of each dive
+    :param time_range: an optional start and end time, as numbers of the
+        units of the pyramid or datetimes, to zoom in on
+    :param max_points: the maximum number of bins of the depth traces
+    :param title: the title of the plot
+
+    :return: a plotly ``Figure``
+    """
+    if not isinstance(pyramid, DepthPyramid):
+        pyramid = DepthPyramid.load(pyramid)
+    units = pyramid.units
+    start, end = pyramid.time_range
+    if time_range is not None:
+        start, end = datetime_to_num(list(time_range), units=units)
+
+    time, minimum, maximum = pyramid.get_range(start, end, max_points)
+    trace = go.Scattergl if len(time) > webgl_threshold else go.Scatter
+    x = num_to_datetime(time, units=units)
+    if np.array_equal(minimum, maximum, equal_nan=True):
+        plot_data = [
+            trace(x=x, y=minimum, mode='lines', name='Depth',
+                  line=dict(color='rgb(31,119,180)'))
+        ]
+    else:
+        plot_data = [
+            trace(x=x, y=minimum, mode='lines', name='Min Depth',
+                  legendgroup='depth', line=dict(color='rgb(31,119,180)')),
+            trace(x=x, y=maximum, mode='lines', name='Max Depth',
+                  legendgroup='depth', fill='tonexty',
+                  line=dict(color='rgb(31,119,180)'))
+        ]
+
+    if dives is not None and len(dives):
+        dives = dives[(dives.dive_end >= start) & (dives.dive_start <= end)]
+        colors = cl.scales['12']['qual']['Paired']
+        bands = []
+        if color_by == 'phase':
+            for name, (band_start, band_end) in get_phase_intervals(
+                    dives).items():
+                bands.append((name, band_start, band_end))
+        elif color_by == 'cluster' and 'cluster' not in dives.columns:
+            bands.append(('Dives', dives.dive_start.values,
+                          dives.dive_end.values))
+        elif color_by == 'cluster':
+            for cluster in np.unique(dives.cluster.values):
+                in_cluster = dives[dives.cluster == cluster]
+                bands.append(('Cluster ' + str(cluster),
+                              in_cluster.dive_start.values,
+                              in_cluster.dive_end.values))
+        else:
+            raise ValueError('color_by must be cluster or phase')
+
+        for i, (name, band_start, band_end) in enumerate(bands):
+            valid = np.isfinite(band_start) & np.isfinite(band_end)
+            plot_data.insert(
+                i,
+                get_band_trace(band_start[valid], band_end[valid], name,
+                               colors[i % len(colors)], units))
+
+    layout = go.Layout(
+        title=title,
+        xaxis=dict(title='Time',
+                   range=list(num_to_datetime([start, end], units=units))),
+        yaxis=dict(title='Depth in Meters', autorange='reversed'),
+        yaxis2=dict(range=[0, 1], overlaying='y', visible=False))
+    return go.Figure(data=plot_data, layout=layout)
+
+
+def plot_deployment(pyramid,
+                    dives=None,
+                    color_by='cluster',
+                    time_range=None,
+                    max_points=2000,
+                    ipython_display=True,
+                    filename='index.html',
+                    title='Deployment'):
+    """
+    Plots the depth of a whole deployment with the dives as coloured bands,
+    see ``get_deployment_figure()``.
+
+    :param pyramid: a ``DepthPyramid`` or the folder it was saved in
+    :param dives: an optional Pandas DataFrame of the profiled dives, with
+        times in the units of the pyramid
+    :param color_by: ``cluster`` to color the dives by their ``cluster``
+        column or ``phase`` to color the phases of each dive
+    :param time_range: an optional start and end time, as numbers of the
+        units of the pyramid or datetimes, to zoom in on
+    :param max_points: the maximum number of bins of the depth traces
+    :param ipython_display: a boolean indicating whether or not to show the
+        plot in a notebook
+    :param filename: the filename to save the plot to if it is not shown in a
+        notebook
+    :param title: the title of the plot
+
+    :return: a plotly line chart of the deployment
+    """
+    fig = get_deployment_figure(pyramid, dives=dives, color_by=color_by,
+                                time_range=time_range, max_points=max_points,
+                                title=title)
+    if ipython_display:
+        py.init_notebook_mode()
+        return py.iplot(fig)
+    else:
+        return py.plot(fig, filename=filename)
+
+
+def _write_report_pages(folder, output_folder, dives, kwargs):
+    """
+    Writes the report pages of a batch of dives, used by
+    ``export_html_report()`` so it can be sent to a worker process.
+
+    :param folder: the path to the results folder
+    :param output_folder: the path to the report folder
+    :param dives: a list of the ``cluster`` and ``dive_id`` of the dives
+    :param kwargs: the keyword arguments for ``get_figure_from_nc()``
+
+    :return: a list of the cluster, dive id, and path of each page relative
+        to the report folder
+    """
+    pages = []
+    for cluster, dive_id in dives:
+        fig = get_figure_from_nc(folder, cluster, dive_id, **kwargs)
+        page = 'cluster_%d/dive_%05d.html' % (cluster, dive_id)
+        # The template is most of the figure, it is shared with the bundle
+        figure = fig.to_plotly_json()
+        figure['layout'].pop('template', None)
+        with open(os.path.join(output_folder, page), 'w') as f:
+            f.write(report_page % {
+                'title': 'Dive %d from Cluster %d' % (dive_id, cluster),
+                'plotlyjs': plotlyjs_filename,
+                'template': template_filename,
+                'figure': to_json_plotly(figure)
+            })
+        pages.append((cluster, dive_id, page))
+    return pages
+
+
+def export_html_report(folder,
+                       output_folder=None,
+                       clusters=None,
+                       sample_size=None,
+                       type='dive',
+                       n_jobs=None,
+                       batch_size=50,
+                       random_state=None,
+                       at_depth_threshold=0.15,
+                       max_points=None,
+                       downsample_method='lttb'):
+    """
+    Writes an HTML page of each dive of an export folder, or of a sample of
+    the dives of each cluster, and an ``index.html`` linking to them. The
+    pages are rendered in batches by a pool of processes and all of them
+    load a single ``plotly.min.js`` and layout template from the report
+    folder, so each page only holds the data of its dive.
+
+    :param folder: the path to the results folder contianing the cluster
+        folders
+    :param output_folder: the path to write the report to, defaults to a
+        ``report`` folder in ``folder``
+    :param clusters: an optional list of the clusters to include
+    :param sample_size: the number of dives picked at random from each
+        cluster, ``None`` includes every dive
+    :param type: a string of either either ``dive`` or ``deepdive``
+    :param n_jobs: the number of processes to use, ``None`` uses every CPU
+        and ``1`` renders the pages in this process
+    :param batch_size: the number of dives rendered by a process at a time
+    :param random_state: the seed of the sample
+    :param at_depth_threshold: a value from 0 - 1 indicating distance from the
+        bottom of the dive at which the animal is considered to be at depth
+    :param max_points: the maximum number of points per phase, ``None``
+        plots every point
+    :param downsample_method: either ``lttb`` or ``minmax``
+
+    :return: a Pandas DataFrame of the ``cluster``, ``dive_id``, and ``page``
+        of every page, relative to the report folder
+    """
+    if output_folder is None:
+        output_folder = os.path.join(folder, 'report')
+
+    dives = get_dive_archive(folder).list_dives()
+    if clusters is not None:
+        dives = dives[dives.cluster.isin(clusters)]
+    if sample_size is not None:
+        dives = dives.groupby('cluster', group_keys=False).apply(
+            lambda cluster: cluster.sample(min(len(cluster), sample_size),
+                                           random_state=random_state))
+    dives = dives.sort_values(['cluster', 'dive_id'])
+
+    for cluster in dives.cluster.unique():
+        os.makedirs(os.path.join(output_folder, 'cluster_%d' % cluster),
+                    exist_ok=True)
+    with open(os.path.join(output_folder, plotlyjs_filename), 'w') as f:
+        f.write(py.get_plotlyjs())
+    with open(os.path.join(output_folder, template_filename), 'w') as f:
+        f.write('var template = %s;\n' %
+                to_json_plotly(go.Figure().layout.template))
+
+    kwargs = {
+        'type': type,
+        'at_depth_threshold': at_depth_threshold,
+        'max_points': max_points,
+        'downsample_method': downsample_method
+    }
+    dives = list(zip(dives.cluster.astype(int), dives.dive_id.astype(int)))
+    batches = [
+        dives[batch:batch + batch_size]
+        for batch in range(0, len(dives), batch_size)
+    ]
+    if n_jobs == 1:
+        results = [
+            _write_report_pages(folder, output_folder, batch, kwargs)
+            for batch in batches
+        ]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(
+                executor.map(_write_report_pages,
+                             [folder] * len(batches),
+                             [output_folder] * len(batches), batches,
+                             [kwargs] * len(batches)))
+
+    pages = pd.DataFrame([page for result in results for page in result],
+                         columns=['cluster', 'dive_id', 'page'])
+    write_report_index(output_folder, pages)
+    return pages
+
+
+def write_report_index(output_folder, pages, title='Dive Report'):
+    """
+    Writes the ``index.html`` of a report, linking to the page of each dive
+    grouped by cluster.
+
+    :param output_folder: the path to the report folder
+    :param pages: a Pandas DataFrame of the ``cluster``, ``dive_id``, and
+        ``page`` of each page
+    :param title: the title of the index
+    """
+    lines = [
+        '<!DOCTYPE html>', '<html>', '<head>', '<meta charset="utf-8">',
+        '<title>%s</title>' % html.escape(title), '</head>', '<body>',
+        '<h1>%s</h1>' % html.escape(title)
+    ]
+    for cluster, cluster_pages in pages.groupby('cluster'):
+        lines.append('<h2>Cluster %d (%d dives)</h2>' %
+                     (cluster, len(cluster_pages)))
+        lines.append('<ul>')
+        for row in cluster_pages.itertuples():
+            lines.append('<li><a href="%s">Dive %d</a></li>' %
+                         (html.escape(row.page), row.dive_id))
+        lines.append('</ul>')
+    lines.extend(['</body>', '</html>'])
+    with open(os.path.join(output_folder, 'index.html'), 'w') as f:
+        f.write('\n'.join(lines) + '\n')
@@ -3,7 +3,115 @@ import math
 import numpy as np
 import pandas as pd
 import xarray as xr
-from netCDF4 import Dataset, date2num, num2date
+from netCDF4 import Dataset
+
+time_units = 'seconds since 1970-01-01'
+
+# The length of each CF time unit in nanoseconds
+unit_nanoseconds = {
+    'nanoseconds': 1,
+    'microseconds': 1000,
+    'milliseconds': 1000000,
+    'seconds': 1000000000,
+    'minutes': 60000000000,
+    'hours': 3600000000000,
+    'days': 86400000000000
+}
+
+# The netCDF encoding presets. ``complevel`` is the zlib compression level
+# (0 disables compression), ``chunk_size`` is the largest chunk in values and
+# variables smaller than ``contiguous_size`` bytes are stored contiguously.
+encoding_presets = {
+    'default': {
+        'complevel': 4,
+        'shuffle': True,
+        'chunk_size': 65536,
+        'contiguous_size': 8192
+    },
+    'speed': {
+        'complevel': 1,
+        'shuffle': False,
+        'chunk_size': 262144,
+        'contiguous_size': 65536
+    },
+    'size': {
+        'complevel': 9,
+        'shuffle': True,
+        'chunk_size': 65536,
+        'contiguous_size': 1024
+    }
+}
+
+
+def get_encoding_policy(encoding='default'):
+    """
+    :param encoding: the name of a preset in ``encoding_presets`` (``default``,
+        ``speed``, or ``size``) or a dictionary of settings overriding the
+        ``default`` preset
+
+    :return: a dictionary of the ``complevel``, ``shuffle``, ``chunk_size``,
+        and ``contiguous_size`` settings
+    """
+    if encoding is None:
+        encoding = 'default'
+    if isinstance(encoding, str):
+        if encoding not in encoding_presets:
+            raise ValueError('encoding must be one of %s' %
+                             ', '.join(encoding_presets))
+        return dict(encoding_presets[encoding])
+    policy = dict(encoding_presets['default'])
+    policy.update(encoding)
+    return policy
+
+
+def get_variable_encoding(size, itemsize=8, encoding='default',
+                          unlimited=False):
+    """
+    Applies the encoding policy to one variable. Small variables are stored
+    contiguously and larger ones are compressed in chunks along the time
+    dimension, so a whole dive or column is read with few chunk reads.
+
+    :param size: the number of values in the variable
+    :param itemsize: the size of a value in bytes
+    :param encoding: a preset name or dictionary, see
+        ``get_encoding_policy()``
+    :param unlimited: whether the dimension of the variable is unlimited,
+        these variables cannot be stored contiguously
+
+    :return: a dictionary of the storage keyword arguments for
+        ``netCDF4.Dataset.createVariable`` or an xarray encoding
+    """
+    policy = get_encoding_policy(encoding)
+    if not unlimited and size * itemsize <= policy['contiguous_size']:
+        return {'contiguous': True}
+
+    variable_encoding = {
+        'chunksizes': (int(max(1, min(size, policy['chunk_size']))), )
+    }
+    if policy['complevel'] > 0:
+        variable_encoding.update({
+            'zlib': True,
+            'complevel': policy['complevel'],
+            'shuffle': policy['shuffle']
+        })
+    return variable_encoding
+
+
+def get_xarray_encoding(ds, encoding='default'):
+    """
+    :param ds: an xarray Dataset with one dimensional variables
+    :param encoding: a preset name or dictionary, see
+        ``get_encoding_policy()``
+
+    :return: an encoding dictionary for ``Dataset.to_netcdf`` applying the
+        encoding policy to every numeric variable
+    """
+    return {
+        var: get_variable_encoding(ds[var].size, ds[var].dtype.itemsize,
+                                   encoding)
+        for var in ds.data_vars
+        if ds[var].ndim == 1 and ds[var].dtype.kind in 'biuf'
+    }
 
 
 def zlib_encoding(ds):
@@ -13,11 +121,284 @@ def zlib_encoding(ds):
 
     :param ds: an xarray Dataset
 
-    :return: A dictionary indicating zlib compression for all variables
+    :return: A dictionary of the ``default`` encoding policy for all variables,
+        see ``get_xarray_encoding()``
+    """
+    return get_xarray_encoding(ds)
+
+
+def get_sampling_interval(data, columns={'depth': 'depth', 'time': 'time'}):
+    """
+    Gets the sampling interval of the data in seconds. If the data has been
+    through ``regularize_dive_data()`` the tagged ``sampling_interval`` is
+    used, otherwise the mean time difference is used.
+
+    :param data: a Pandas DataFrame with a time column
+    :param columns: column renaming dictionary if needed
+
+    :return: the sampling interval in seconds
+    """
+    if 'sampling_interval' in data.columns:
+        return data.sampling_interval.median()
+
+    interval = data[columns['time']].diff().mean()
+    if isinstance(interval, pd.Timedelta):
+        interval = interval.total_seconds()
+    return interval
+
+
+def parse_time_units(units=time_units):
+    """
+    :param units: CF time units, e.g. ``seconds since 1970-01-01``
+
+    :return: the length of one unit in nanoseconds and the epoch as a
+        ``numpy.datetime64`` in nanoseconds
+    """
+    unit, _, epoch = units.partition(' since ')
+    unit = unit.strip().lower()
+    if not unit.endswith('s'):
+        unit = unit + 's'
+    if unit not in unit_nanoseconds or not epoch.strip():
+        raise ValueError('unsupported time units %s' % units)
+    epoch = pd.Timestamp(epoch.strip())
+    if epoch.tz is not None:
+        epoch = epoch.tz_convert(None)
+    return unit_nanoseconds[unit], epoch.to_datetime64().astype(
+        'datetime64[ns]')
+
+
+def datetime_to_num(time, units=time_units):
+    """
+    Converts datetimes to numbers of ``units`` in bulk, like
+    ``netCDF4.date2num()`` but on the datetime64 values directly instead of a
+    list of Python datetimes. Numbers are assumed to be in ``units`` already.
+
+    :param time: a Pandas Series, index, or array of datetimes, datetime
+        strings, or numbers
+    :param units: CF time units, e.g. ``seconds since 1970-01-01``
+
+    :return: a numpy float64 array, missing times are ``NaN``
+    """
+    if np.issubdtype(np.asarray(time).dtype, np.number):
+        return np.asarray(time, dtype=np.float64)
+
+    unit, epoch = parse_time_units(units)
+    time = pd.DatetimeIndex(pd.to_datetime(time))
+    if time.tz is not None:
+        time = time.tz_convert(None)
+    nanoseconds = time.asi8 - epoch.astype(np.int64)
+    # Split off the whole units so large values keep their precision
+    whole, remainder = np.divmod(nanoseconds, unit)
+    values = whole + remainder / unit
+    values[time.isna()] = np.nan
+    return values
+
+
+def num_to_datetime(values, units=time_units):
+    """
+    Converts numbers of ``units`` to datetimes in bulk, like
+    ``netCDF4.num2date()`` but returning datetime64 values that plotly and
+    Pandas use natively.
+
+    :param values: a number or an array of numbers of ``units``
+    :param units: CF time units, e.g. ``seconds since 1970-01-01``
+
+    :return: a numpy ``datetime64[ns]`` array, or a ``numpy.datetime64`` for
+        a single number, missing values are ``NaT``
+    """
+    unit, epoch = parse_time_units(units)
+    values = np.asarray(values, dtype=np.float64)
+    missing = np.isnan(values)
+    values = np.where(missing, 0, values)
+    # Split off the whole units so large values keep their precision
+    whole = np.floor(values)
+    nanoseconds = whole.astype(np.int64) * unit + np.round(
+        (values - whole) * unit).astype(np.int64)
+    time = epoch + nanoseconds.astype('timedelta64[ns]')
+    time = np.where(missing, np.datetime64('NaT'), time)
+    return time[()] if time.ndim == 0 else time
+
+
+def time_in_seconds(time):
+    """
+    :param time: a Pandas Series of datetimes or of seconds since 1970-01-01
+
+    :return: a numpy array of seconds since 1970-01-01
     """
-    comp = dict(zlib=True)
-    encoding = {var: comp for var in ds.data_vars}
-    return encoding
+    return datetime_to_num(time, units=time_units)
+
+
+def get_sampling_segments(data,
+                          gap_threshold=None,
+                          tolerance=0.1,
+                          window=5,
+                          columns={
+                              'depth': 'depth',
+                              'time': 'time'
+                          }):
+    """
+    Splits the data into contiguous segments with a constant sampling rate.
+    A new segment starts at every gap longer than ``gap_threshold`` and
+    wherever the local sampling interval changes by more than ``tolerance``.
+
+    :param data: a Pandas DataFrame sorted by time with a time column
+    :param gap_threshold: the time (in seconds) between two samples that is
+        considered a gap, defaults to 10 times the 90th percentile of the time
+        differences so that the slowest rate of a mixed rate record is not
+        considered a gap
+    :param tolerance: the relative change in the sampling interval that
+        starts a new segment
+    :param window: the number of samples used for the rolling median of the
+        sampling interval, segments shorter than this are merged into the
+        previous segment
+    :param columns: column renaming dictionary if needed
+
+    :return: a Pandas DataFrame with the ``segment`` number, ``start_index``,
+        ``end_index`` (exclusive), ``start_time``, ``end_time``,
+        ``sampling_interval`` (in seconds), and ``number_of_samples`` of each
+        segment
+    """
+    time = time_in_seconds(data[columns['time']])
+    time_diff = np.diff(time)
+    if gap_threshold is None:
+        gap_threshold = 10 * np.percentile(time_diff, 90) \
+            if len(time_diff) else 0
+
+    # Only look at the rate within a segment, gaps are split separately
+    is_gap = time_diff > gap_threshold
+    interval = pd.Series(np.where(is_gap, np.nan, time_diff)).rolling(
+        window, center=True, min_periods=1).median().ffill().bfill().values
+
+    rate_change = np.abs(np.diff(interval)) > (tolerance * interval[:-1])
+    boundaries = np.flatnonzero(is_gap) + 1
+    rate_boundaries = np.flatnonzero(rate_change) + 2
+    boundaries = np.union1d(boundaries, rate_boundaries)
+    boundaries = boundaries[(boundaries > 0) & (boundaries < len(time))]
+
+    # Merge any short segments caused by a rate transition, gaps are kept
+    if len(boundaries):
+        keep = np.ones(len(boundaries), dtype=bool)
+        previous = 0
+        for i, boundary in enumerate(boundaries):
+            if boundary - previous < window and not is_gap[boundary - 1]:
+                keep[i] = False
+            else:
+                previous = boundary
+        boundaries = boundaries[keep]
+
+    start_index = np.insert(boundaries, 0, 0)
+    end_index = np.append(boundaries, len(time))
+
+    segments = pd.DataFrame()
+    segments['segment'] = np.arange(len(start_index))
+    segments['start_index'] = start_index
+    segments['end_index'] = end_index
+    segments['start_time'] = time[start_index]
+    segments['end_time'] = time[end_index - 1]
+    segments['sampling_interval'] = [
+        np.median(time_diff[start:end - 1]) if end - start > 1 else np.nan
+        for start, end in zip(start_index, end_index)
+    ]
+    segments['number_of_samples'] = end_index - start_index
+    return segments
+
+
+def split_on_gaps(data,
+                  gap_threshold=None,
+                  columns={
+                      'depth': 'depth',
+                      'time': 'time'
+                  }):
+    """
+    Splits the data into independent contiguous segments wherever the time
+    between two samples is longer than ``gap_threshold``.
+
+    :param data: a Pandas DataFrame with a time column
+    :param gap_threshold: the time (in seconds) between two samples that is
+        considered a gap, see ``get_sampling_segments()``
+    :param columns: column renaming dictionary if needed
+
+    :return: a list of Pandas DataFrames, one per segment, sorted by time
+    """
+    data = data.sort_values(columns['time']).reset_index(drop=True)
+    time_diff = np.diff(time_in_seconds(data[columns['time']]))
+    if gap_threshold is None:
+        gap_threshold = 10 * np.percentile(time_diff, 90) \
+            if len(time_diff) else 0
+
+    boundaries = np.flatnonzero(time_diff > gap_threshold) + 1
+    starts = np.insert(boundaries, 0, 0)
+    ends = np.append(boundaries, len(data))
+    return [
+        data[start:end].reset_index(drop=True)
+        for start, end in zip(starts, ends)
+    ]
+
+
+def regularize_dive_data(data,
+                         sampling_interval=None,
+                         gap_threshold=None,
+                         aggregation='mean',
+                         columns={
+                             'depth': 'depth',
+                             'time': 'time'
+                         }):
+    """
+    Detects the sampling rate and gaps of the data once, decimates any
+    segment sampled faster than ``sampling_interval`` by aggregating the
+    depth into regular time bins, and tags each sample with its ``segment``
+    and ``sampling_interval``. The tagged interval is used by the detection
+    and profiling instead of recalculating it from the time differences.
+
+    :param data: a Pandas DataFrame with a time and a depth column
+    :param sampling_interval: the target sampling interval in seconds, if
+        ``None`` the data is only tagged and not decimated
+    :param gap_threshold: the time (in seconds) between two samples that is
+        considered a gap, see ``get_sampling_segments()``
+    :param aggregation: how the depth is aggregated within a time bin, any
+        Pandas aggregation such as ``mean``, ``median``, ``max``, or ``min``
+    :param columns: column renaming dictionary if needed
+
+    :return: a Pandas DataFrame with ``time``, ``depth``, ``segment``, and
+        ``sampling_interval`` columns, with ``time`` in the same format as the
+        input
+    """
+    data = data.sort_values(columns['time']).reset_index(drop=True)
+    is_datetime = not np.issubdtype(data[columns['time']].dtype, np.number)
+    time = time_in_seconds(data[columns['time']])
+    depth = data[columns['depth']].values
+    segments = get_sampling_segments(data,
+                                     gap_threshold=gap_threshold,
+                                     columns=columns)
+
+    regularized = []
+    for segment, start, end, interval in zip(segments.segment,
+                                             segments.start_index,
+                                             segments.end_index,
+                                             segments.sampling_interval):
+        segment_time = time[start:end]
+        segment_data = pd.DataFrame({
+            'time': segment_time,
+            'depth': depth[start:end]
+        })
+        if sampling_interval is not None and (np.isnan(interval) or
+                                              interval < sampling_interval):
+            bins = np.floor((segment_time - segment_time[0]) /
+                            sampling_interval)
+            segment_data = segment_data.groupby(bins).depth.agg(
+                aggregation).reset_index()
+            segment_data.columns = ['time', 'depth']
+            segment_data['time'] = segment_time[0] + \
+                segment_data.time * sampling_interval
+            interval = sampling_interval
+        segment_data['segment'] = segment
+        segment_data['sampling_interval'] = interval
+        regularized.append(segment_data)
+
+    regularized = pd.concat(regularized, ignore_index=True)
+    if is_datetime:
+        regularized['time'] = pd.to_datetime(regularized.time, unit='s')
+    return regularized
 
 
 def calculate_window_mean(window, surface_threshold, df):
@@ -48,7 +429,8 @@ def correct_depth_offset(data,
                          },
                          aux_file='corrected_depth_auxillary_data.nc',
                          method='max',
-                         surface_threshold=4):
+                         surface_threshold=4,
+                         encoding='default'):
     """
     :param data: The dataset consisting of a time and a depth column
     :param window: time window (in seconds) to use in the calculation
@@ -59,6 +441,8 @@ def correct_depth_offset(data,
         default is max
     :param surface_threshold: maximum values (in meters) to use when using the
         mean the calculate
+    :param encoding: the netCDF encoding preset or dictionary of the aux file,
+        see ``get_encoding_policy()``
 
     :return: A DataFrame with a corrected depth
     """
@@ -78,7 +462,7 @@ def correct_depth_offset(data,
         data['corrected_depth'] = data.depth - data.depth_offset
     else:
         data['offset'] = data.depth.rolling(
-            int(window / data.time.diff().mean().total_seconds())).min()
+            int(window / get_sampling_interval(data))).min()
         data.offset.fillna(data.offset.min(), inplace=True)
         data['corrected_depth'] = data.depth - data.offset
 
@@ -87,8 +471,7 @@ def correct_depth_offset(data,
     corrected_data['time'] = data.time
     corrected_data['depth'] = data.corrected_depth
 
-    time_units = 'seconds since 1970-01-01'
-    data.time = date2num(pd.to_datetime(data.time).tolist(), units=time_units)
+    data.time = datetime_to_num(data.time, units=time_units)
     xarray_data = xr.Dataset(data)
     xarray_data.variables['time'].attrs = {'units': time_units}
     xarray_data.variables['depth'].attrs = {
@@ -100,7 +483,8 @@ def correct_depth_offset(data,
         'positive': 'down'
     }
     xarray_data.to_netcdf(
-        aux_file, mode='w', encoding=zlib_encoding(xarray_data))
+        aux_file, mode='w',
+        encoding=get_xarray_encoding(xarray_data, encoding))
     xarray_data.close()
 
     return corrected_data
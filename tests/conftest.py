@@ -0,0 +1,15 @@
+import os
+
+import pandas as pd
+import pytest
+
+sample_filename = os.path.join(os.path.dirname(__file__), '..', 'docs',
+                               '_static', 'seal_dive_data.csv')
+
+
+@pytest.fixture(scope='session')
+def seal_data():
+    """
+    The first part of the sample seal record, a few hundred dives.
+    """
+    return pd.read_csv(sample_filename, nrows=20000)
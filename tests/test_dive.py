@@ -0,0 +1,48 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from divebomb.Dive import Dive, InsufficientDiveData
+
+
+def get_dive_data(depth):
+    return pd.DataFrame({
+        'time': 1e9 + 10.0 * np.arange(len(depth)),
+        'depth': np.asarray(depth, dtype=np.float64)
+    })
+
+
+def test_sufficient_dive():
+    depth = [0, 5, 10, 20, 30, 31, 30.5, 31, 30, 20, 10, 5, 0, 0]
+    dive = Dive(get_dive_data(depth))
+    assert not dive.insufficient_data
+    assert dive.max_depth == 31
+    assert dive.td_total_duration == 130
+
+
+@pytest.mark.parametrize('depth', [
+    [0, 0, 0, 0],
+    [4.5, 0.6, 0.9, 2.6, 7.7],
+])
+def test_insufficient_dive(depth):
+    dive = Dive(get_dive_data(depth), surface_threshold=1)
+    assert dive.insufficient_data
+
+
+def test_insufficient_ascent_is_raised():
+    dive = Dive(get_dive_data([0, 0, 0, 0]))
+    with pytest.raises(InsufficientDiveData):
+        dive.get_ascent_duration()
+
+
+def test_features_do_not_change_insufficient_dives():
+    random = np.random.RandomState(0)
+    for size in random.randint(3, 40, 500):
+        depth = np.round(np.abs(np.cumsum(random.normal(0, 2, size))), 1)
+        data = get_dive_data(depth)
+        dive = Dive(data)
+        light_dive = Dive(data, features=['max_depth'])
+        assert dive.insufficient_data == light_dive.insufficient_data
+        if not dive.insufficient_data:
+            assert dive.td_bottom_duration >= 0
+            assert light_dive.td_bottom_duration == dive.td_bottom_duration
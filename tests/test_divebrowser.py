@@ -0,0 +1,42 @@
+import threading
+
+import pytest
+
+from divebomb import get_dive_starting_points, prepare_dive_data
+from divebomb.DiveBrowser import DiveBrowser
+
+
+@pytest.fixture
+def browser(seal_data):
+    data = prepare_dive_data(seal_data)
+    starts = get_dive_starting_points(data, None)
+    browser = DiveBrowser(data, starts, prefetch=2)
+    yield browser
+    browser.close()
+
+
+def test_scrubbing_bounds_the_prefetches(browser):
+    for index in range(0, 40, 3):
+        dive_profile, figure = browser.get_dive(index)
+        assert dive_profile.data.time.iloc[0] == \
+            browser.data.time[browser.starts.loc[index, 'start_block']]
+        # The window around the dive and at most one stale running profile
+        assert len(browser._pending) <= 2 * browser.prefetch + 1
+        assert all(abs(pending - index) <= browser.prefetch
+                   for pending, future in browser._pending.items()
+                   if not future.running())
+
+
+def test_queued_dive_is_profiled_inline(browser):
+    release = threading.Event()
+    # Keep the background thread busy so the prefetches stay queued
+    blocker = browser._executor.submit(release.wait, 60)
+    browser._prefetch(10)
+    assert 11 in browser._pending
+
+    dive_profile, figure = browser.get_dive(11)
+    assert not blocker.done()
+    assert 11 in browser._cache
+    # Moving to 11 cancelled the queued prefetch of 8, outside its window
+    assert 8 not in browser._pending
+    release.set()
@@ -0,0 +1,126 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+from netCDF4 import Dataset
+
+from divebomb import (cluster_dives, export_to_csv, export_to_netcdf,
+                      get_export_changes, prepare_dive_data, profile_dives,
+                      read_export_manifest, read_export_pca_output,
+                      read_export_summary)
+
+
+@pytest.fixture(scope='module')
+def clustered(seal_data):
+    dives, insufficient_dives, data = profile_dives(seal_data)
+    dives, loadings, pca_output_matrix = cluster_dives(dives, n_clusters=3)
+    return prepare_dive_data(seal_data), dives, loadings, pca_output_matrix
+
+
+def test_export_changes_with_repeated_starts(clustered):
+    data, dives, loadings, pca_output_matrix = clustered
+    dives = dives.assign(dive_id=dives.index + 1)
+    manifest = read_export_manifest('missing_folder')
+    manifest = pd.concat([manifest, dives.reindex(columns=manifest.columns)])
+    # A legacy summary listing the first dive twice
+    repeated = manifest.iloc[[0]].assign(dive_id=len(dives) + 1)
+    manifest = pd.concat([manifest, repeated], ignore_index=True)
+
+    changed_dives, changed, manifest, moved_dives = get_export_changes(
+        dives.drop(columns='dive_id'), manifest)
+    assert changed_dives.dive_id.iloc[0] == len(dives) + 1
+    assert (changed_dives.dive_id.iloc[1:] == dives.dive_id.iloc[1:]).all()
+
+
+def test_csv_append_with_repeated_starts(clustered, tmp_path):
+    data, dives, loadings, pca_output_matrix = clustered
+    folder = str(tmp_path / 'results')
+    export_to_csv(folder, dives.iloc[:10].copy(), loadings,
+                  pca_output_matrix.iloc[:10])
+    # Summaries written before the manifest could repeat a dive
+    os.remove(os.path.join(folder, 'export_manifest.csv'))
+    summary = pd.read_csv(os.path.join(folder, 'all_profiled_dives.csv'))
+    pd.concat([summary, summary.iloc[[3]]]).to_csv(
+        os.path.join(folder, 'all_profiled_dives.csv'), index=False)
+
+    export_to_csv(folder, dives.iloc[5:20].copy(), loadings,
+                  pca_output_matrix.iloc[5:20], mode='a')
+    summary = pd.read_csv(os.path.join(folder, 'all_profiled_dives.csv'))
+    assert len(summary) == 20
+    assert summary.dive_start.is_unique
+
+
+def test_netcdf_append_with_truncated_starts(clustered, tmp_path):
+    data, dives, loadings, pca_output_matrix = clustered
+    folder = str(tmp_path / 'results')
+    first = dives.iloc[:10].copy()
+    # Two dives whose starts are the same second once cast to int
+    first.loc[first.index[1], 'dive_start'] = first.dive_start.iloc[0] + 0.5
+    export_to_netcdf(folder, data, first, loadings,
+                     pca_output_matrix.iloc[:10], shape_points=None)
+    assert read_export_manifest(folder).dive_start.duplicated().any()
+
+    export_to_netcdf(folder, data, dives.iloc[5:15], loadings,
+                     pca_output_matrix.iloc[5:15], mode='a',
+                     shape_points=None)
+    manifest = read_export_manifest(folder)
+    assert manifest.dive_id.is_unique
+    assert set(dives.dive_start.iloc[5:15].astype(int)) <= \
+        set(manifest.dive_start)
+
+
+def test_netcdf_pca_matrices(clustered, tmp_path):
+    data, dives, loadings, pca_output_matrix = clustered
+    folder = str(tmp_path / 'results')
+    export_to_netcdf(folder, data, dives.iloc[:5], loadings,
+                     pca_output_matrix.iloc[:5], shape_points=None)
+
+    filename = os.path.join(folder, 'pca_matrices_data.nc')
+    with Dataset(filename) as pca_group:
+        pca_output = pca_group.groups['pca_output']
+        assert list(pca_output.variables) == \
+            ['dive_id'] + list(pca_output_matrix.columns)
+        assert list(pca_output['dive_id'][:]) == [1, 2, 3, 4, 5]
+        for column in pca_output_matrix.columns:
+            np.testing.assert_allclose(pca_output[column][:],
+                                       pca_output_matrix[column].values[:5])
+        pca_loadings = pca_group.groups['pca_loadings']
+        assert list(pca_loadings['component'][:]) == \
+            list(loadings.component)
+        for column in loadings.columns[1:]:
+            np.testing.assert_allclose(pca_loadings[column][:],
+                                       loadings[column].values)
+
+
+@pytest.mark.parametrize('export', ['csv', 'netcdf'])
+def test_append_merges_pca_output(clustered, tmp_path, export):
+    data, dives, loadings, pca_output_matrix = clustered
+    folder = str(tmp_path / 'results')
+    if export == 'csv':
+        def export_dives(start, end, mode):
+            export_to_csv(folder, dives.iloc[start:end].copy(), loadings,
+                          pca_output_matrix.iloc[start:end], mode=mode)
+    else:
+        def export_dives(start, end, mode):
+            export_to_netcdf(folder, data, dives.iloc[start:end], loadings,
+                             pca_output_matrix.iloc[start:end], mode=mode,
+                             shape_points=None)
+    export_dives(0, 10, 'w')
+    export_dives(5, 20, 'a')
+
+    summary = read_export_summary(folder)
+    output = read_export_pca_output(folder)
+    assert list(output.dive_id) == list(summary.dive_id)
+    np.testing.assert_allclose(output.iloc[:, 1:].values,
+                               pca_output_matrix.iloc[:20].values)
+
+
+
+def test_export_pca_output_needs_a_row_per_dive(clustered, tmp_path):
+    data, dives, loadings, pca_output_matrix = clustered
+    folder = str(tmp_path / 'results')
+    with pytest.raises(ValueError):
+        export_to_csv(folder, dives.iloc[:5].copy(), loadings,
+                      pca_output_matrix)
+    assert not os.path.exists(folder)
@@ -0,0 +1,155 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+import peakutils as pku
+import pytest
+
+from divebomb import kernels, prepare_dive_data, profile_dives
+
+requires_numba = pytest.mark.skipif(kernels.numba is None,
+                                    reason='numba is not installed')
+
+
+@pytest.fixture
+def restore_backend():
+    backend = kernels.get_backend()
+    yield
+    kernels.set_backend(backend)
+
+
+def run_backends(function, *args, **kwargs):
+    """
+    :return: the result of the function with the numpy and with the numba
+        backend
+    """
+    results = []
+    for backend in ['numpy', 'numba']:
+        kernels.set_backend(backend)
+        results.append(function(*args, **kwargs))
+    return results
+
+
+def get_depths(random, size):
+    """
+    :return: a random dive like signal with repeated values
+    """
+    return np.round(np.abs(np.cumsum(random.normal(0, 2, size))), 1)
+
+
+@requires_numba
+@pytest.mark.usefixtures('restore_backend')
+def test_expanding_std():
+    random = np.random.RandomState(0)
+    for size in [0, 1, 2, 50, 1000]:
+        values = random.normal(100, 5, size)
+        numpy_std, numba_std = run_backends(kernels.expanding_std, values)
+        np.testing.assert_array_equal(numpy_std, numba_std)
+
+
+@requires_numba
+@pytest.mark.usefixtures('restore_backend')
+def test_find_crest():
+    random = np.random.RandomState(1)
+    for size in [1, 2, 10, 200]:
+        depth = get_depths(random, size)
+        for surface_threshold in [0, 1, 5, 1000]:
+            numpy_crest, numba_crest = run_backends(kernels.find_crest,
+                                                    depth, surface_threshold)
+            assert numpy_crest == numba_crest
+
+
+@requires_numba
+@pytest.mark.usefixtures('restore_backend')
+def test_find_bottom_start():
+    random = np.random.RandomState(2)
+    for size in [1, 2, 10, 200]:
+        depth = get_depths(random, size)
+        for density in [0, 0.1, 0.9]:
+            candidates = random.random_sample(size) < density
+            for cut in [0, np.median(depth), depth.max()]:
+                numpy_start, numba_start = run_backends(
+                    kernels.find_bottom_start, candidates, depth, cut)
+                assert numpy_start == numba_start
+
+
+@requires_numba
+@pytest.mark.usefixtures('restore_backend')
+def test_find_bottom_end():
+    random = np.random.RandomState(3)
+    for size in [1, 2, 10, 200]:
+        depth = get_depths(random, size)
+        for end_index in {1, size // 2 or 1, size}:
+            for density in [0, 0.1, 0.9]:
+                candidates = random.random_sample(end_index) < density
+                for cut in [0, np.median(depth), depth.max()]:
+                    numpy_end, numba_end = run_backends(
+                        kernels.find_bottom_end, candidates, depth,
+                        end_index, cut, cut * 1.5)
+                    assert numpy_end == numba_end
+
+
+@requires_numba
+@pytest.mark.usefixtures('restore_backend')
+def test_suppress_peaks():
+    random = np.random.RandomState(4)
+    for size in [0, 1, 2, 100]:
+        peaks = np.sort(random.choice(10 * size + 1, size, replace=False))
+        heights = np.round(random.normal(0, 1, size), 1)
+        for min_dist in [1, 2, 5, 30]:
+            numpy_peaks, numba_peaks = run_backends(kernels.suppress_peaks,
+                                                    peaks, heights, min_dist)
+            np.testing.assert_array_equal(numpy_peaks, numba_peaks)
+
+
+@pytest.mark.parametrize('backend', [
+    'numpy', pytest.param('numba', marks=requires_numba)])
+@pytest.mark.usefixtures('restore_backend')
+def test_peak_indexes_match_peakutils(seal_data, backend):
+    kernels.set_backend(backend)
+    random = np.random.RandomState(5)
+    signals = [
+        -prepare_dive_data(seal_data).depth.values,
+        -get_depths(random, 5000),
+        np.round(random.normal(0, 1, 5000), 1)
+    ]
+    for y in signals:
+        for thres in [0.3, 0.9]:
+            for min_dist in [2, 12, 60]:
+                np.testing.assert_array_equal(
+                    kernels.peak_indexes(y, thres=thres, min_dist=min_dist),
+                    pku.indexes(y, thres=thres, min_dist=min_dist))
+
+
+@requires_numba
+@pytest.mark.parametrize('is_surfacing_animal', [True, False])
+@pytest.mark.usefixtures('restore_backend')
+def test_profile_dives(seal_data, is_surfacing_animal):
+    numpy_profiles, numba_profiles = run_backends(
+        profile_dives, seal_data, is_surfacing_animal=is_surfacing_animal)
+    for numpy_dives, numba_dives in zip(numpy_profiles[:2],
+                                        numba_profiles[:2]):
+        if numpy_dives is None:
+            assert numba_dives is None
+        else:
+            pd.testing.assert_frame_equal(numpy_dives, numba_dives)
+
+
+@pytest.mark.usefixtures('restore_backend')
+def test_set_backend():
+    with pytest.raises(ValueError):
+        kernels.set_backend('fortran')
+    kernels.set_backend('numpy')
+    assert kernels.get_backend() == 'numpy'
+
+
+def test_unknown_backend_variable():
+    environment = dict(os.environ, DIVEBOMB_BACKEND='fortran')
+    result = subprocess.run(
+        [sys.executable, '-W', 'always', '-c',
+         'from divebomb import kernels; print(kernels.get_backend())'],
+        env=environment, capture_output=True, text=True, check=True)
+    assert result.stdout.strip() in kernels.backends
+    assert 'DIVEBOMB_BACKEND is ignored' in result.stderr
@@ -0,0 +1,31 @@
+import numpy as np
+
+from divebomb.Pipeline import Pipeline
+
+
+def test_rerun_after_export(seal_data, tmp_path):
+    pipeline = Pipeline(seal_data, folder=str(tmp_path / 'results'),
+                        n_clusters=4)
+    pipeline.run()
+    data = pipeline.get_data()
+
+    # The export must not change the cached data the next stages profile
+    assert data.time.dtype == np.float64
+    assert (data.index == np.arange(len(data))).all()
+
+    pipeline.set_params(at_depth_threshold=0.2)
+    data, dives, loadings, pca_output_matrix, insufficient_dives = \
+        pipeline.run()
+    assert pipeline.executed == ['profile', 'cluster', 'export']
+    assert len(dives) > 4
+    assert dives.cluster.nunique() == 4
+
+
+def test_cached_stages_are_reused(seal_data, tmp_path):
+    pipeline = Pipeline(seal_data, cache_folder=str(tmp_path / 'cache'))
+    pipeline.run('profile')
+    assert pipeline.executed == ['detect', 'profile']
+
+    pipeline = Pipeline(seal_data, cache_folder=str(tmp_path / 'cache'))
+    pipeline.run('profile')
+    assert pipeline.executed == []
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+import divebomb
+from divebomb import cluster_dives, cluster_stability, profile_dives
+
+
+@pytest.fixture(scope='module')
+def clustered_dives(seal_data):
+    dives, insufficient_dives, data = profile_dives(seal_data)
+    return cluster_dives(dives, n_clusters=4)[0]
+
+
+@pytest.mark.parametrize('replace', [False, True])
+def test_replicates_cluster_the_draws(clustered_dives, monkeypatch, replace):
+    fitted = []
+    clustering = divebomb.AgglomerativeClustering
+
+    class RecordingClustering(clustering):
+        def fit_predict(self, X, y=None):
+            fitted.append(len(X) - len(np.unique(X, axis=0)))
+            return super().fit_predict(X)
+
+    monkeypatch.setattr(divebomb, 'AgglomerativeClustering',
+                        RecordingClustering)
+    dives, stability = cluster_stability(clustered_dives, n_replicates=5,
+                                         replace=replace, n_jobs=1)
+    assert len(fitted) == 5
+    # A bootstrap keeps the repeated draws, a subsample has none
+    repeated = sum(fitted)
+    assert repeated > 0 if replace else repeated == 0
+
+    # The dives never drawn with a peer have no co-assignment
+    assert dives.co_assignment.dropna().between(0, 1).all()
+    assert stability.stability.between(0, 1).all()
+    assert stability.dives.sum() == len(clustered_dives)
+
+
+def test_results_do_not_depend_on_jobs(clustered_dives):
+    single = cluster_stability(clustered_dives, n_replicates=4, replace=True,
+                               n_jobs=1)
+    pooled = cluster_stability(clustered_dives, n_replicates=4, replace=True,
+                               n_jobs=2)
+    np.testing.assert_array_equal(single[0].co_assignment,
+                                  pooled[0].co_assignment)
+    np.testing.assert_array_equal(single[1].stability, pooled[1].stability)
@@ -0,0 +1,41 @@
+import xarray as xr
+from xarray.backends.file_manager import FILE_CACHE
+
+from divebomb import prepare_dive_data, profile_dives_from_xarray
+
+
+def write_dataset(seal_data, tmp_path):
+    data = prepare_dive_data(seal_data)
+    filename = str(tmp_path / 'dives.nc')
+    xr.Dataset({
+        'depth': ('obs', data.depth.values),
+        'time': ('obs', data.time.values)
+    }).to_netcdf(filename)
+    return filename
+
+
+def test_opened_file_is_closed(seal_data, tmp_path, monkeypatch):
+    filename = write_dataset(seal_data, tmp_path)
+    # Keep the opened dataset so collecting it does not close the file
+    opened = []
+    open_dataset = xr.open_dataset
+
+    def keep_dataset(*args, **kwargs):
+        opened.append(open_dataset(*args, **kwargs))
+        return opened[-1]
+
+    monkeypatch.setattr(xr, 'open_dataset', keep_dataset)
+    open_files = len(FILE_CACHE)
+    dives, insufficient_dives = profile_dives_from_xarray(filename)
+    assert len(opened) == 1
+    assert len(dives) > 0
+    assert len(FILE_CACHE) == open_files
+
+
+def test_dataset_passed_in_is_left_open(seal_data, tmp_path):
+    filename = write_dataset(seal_data, tmp_path)
+    with xr.open_dataset(filename) as dataset:
+        open_files = len(FILE_CACHE)
+        profile_dives_from_xarray(dataset)
+        assert len(FILE_CACHE) == open_files
+        assert len(dataset.depth.values) == len(seal_data)